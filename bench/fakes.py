@@ -0,0 +1,508 @@
+"""Local stand-ins for Discord and MongoDB used by the benchmarks.
+
+FakeDiscord answers the bot's REST calls and interaction webhooks without
+touching the network and builds gateway payloads for guilds, members and
+interactions, which are then fed through discord.py's own parsers."""
+import asyncio
+import builtins
+import collections
+import datetime
+import importlib
+import itertools
+import os
+import time
+from unittest import mock
+
+import discord
+from discord.webhook import async_ as webhook_async
+
+DISCORD_EPOCH = 1420070400000
+ALL_PERMISSIONS = str(discord.Permissions.all().value)
+MEMBER_PERMISSIONS = str(discord.Permissions.general().value
+                         | discord.Permissions.text().value
+                         | discord.Permissions.voice().value)
+DB_OPERATIONS = frozenset(
+    ("find_one", "find", "insert_one", "insert_many", "update_one",
+     "update_many", "replace_one", "delete_one", "delete_many", "aggregate",
+     "count_documents", "find_one_and_update", "bulk_write", "distinct"))
+MUSIC_CONFIG = "settings/music-config.json"
+MUSIC_CONFIG_EXAMPLE = "settings/music-config-example.json"
+
+
+class CountingCollection:
+    """Counts operations issued against a Motor compatible collection"""
+
+    def __init__(self, collection, counter):
+        self._collection = collection
+        self._counter = counter
+
+    def __getattr__(self, name):
+        attr = getattr(self._collection, name)
+        if name in DB_OPERATIONS:
+            counter = self._counter
+
+            def operation(*args, **kwargs):
+                counter[name] += 1
+                return attr(*args, **kwargs)
+
+            return operation
+        if type(attr).__module__.startswith("mongomock."):
+            # mongomock-motor hands out sub-collections, like
+            # statistics.commands, without wrapping them in its async API
+            attr = self._collection.database.get_collection(attr.name)
+        if type(attr).__name__.endswith("Collection"):
+            return CountingCollection(attr, self._counter)
+        return attr
+
+    def __getitem__(self, name):
+        return CountingCollection(self._collection[name], self._counter)
+
+
+class CountingDatabase(CountingCollection):
+    pass
+
+
+def mongo_client(uri=None):
+    """Returns a client for uri, or an in-process mongomock-motor client"""
+    if uri:
+        from motor.motor_asyncio import AsyncIOMotorClient
+        return AsyncIOMotorClient(uri)
+    try:
+        from mongomock_motor import AsyncMongoMockClient
+    except ImportError:
+        raise SystemExit("Install mongomock-motor (see bench/requirements.txt)"
+                         " or pass --mongo with a MongoDB URI")
+    return AsyncMongoMockClient()
+
+
+async def create_bot(*, rest_latency=0.0, mongo=None):
+    """Creates a Toothy instance wired to FakeDiscord and a database
+    stand-in, with its watchdog and load governor running. Returns the
+    bot, the FakeDiscord and the database operation counter"""
+    # Importing Toothy reads settings/config.json
+    from toothy.toothy import Toothy
+    bot = Toothy(shard_count=1, chunk_guilds_at_startup=False)
+    await bot._async_setup_hook()
+    fake = FakeDiscord(bot, latency=rest_latency)
+    fake.install()
+    client = mongo_client(mongo)
+    if mongo:
+        await client.drop_database("toothy_bench")
+    db_ops = use_database(bot, client)
+    bot.watchdog.start()
+    bot.governor.start()
+    return bot, fake, db_ops
+
+
+def import_music():
+    """Imports the music cog, reading settings/music-config-example.json
+    when there is no settings/music-config.json"""
+    if os.path.exists(MUSIC_CONFIG):
+        return importlib.import_module("cogs.music")
+    real_open = builtins.open
+
+    def open_example(file, *args, **kwargs):
+        if file == MUSIC_CONFIG:
+            file = MUSIC_CONFIG_EXAMPLE
+        return real_open(file, *args, **kwargs)
+
+    with mock.patch("builtins.open", open_example):
+        return importlib.import_module("cogs.music")
+
+
+def use_music_without_nodes():
+    """Imports the music cog with its Lavalink nodes removed"""
+    music = import_music()
+    music.CONFIG["nodes"] = []
+    return music
+
+
+def use_database(bot, client, name="toothy_bench"):
+    """Points bot.database at client, counting every operation. Must be
+    called before the extensions are loaded, as cogs keep references to
+    their collections. Returns the operation counter"""
+    counter = collections.Counter()
+    database = bot.database
+    database.client = client
+    database.db = CountingDatabase(client[name], counter)
+    database.users = database.db.users
+    database.guilds = database.db.guilds
+    database.channels = database.db.channels
+    database.configs = database.db.configs
+    return counter
+
+
+class FakeAdapter:
+    """Replaces discord.py's webhook adapter, which sends interaction
+    responses and followups"""
+
+    def __init__(self, fake):
+        self.fake = fake
+
+    async def create_interaction_response(self, interaction_id, token, *,
+                                          params, **kwargs):
+        await self.fake.respond(token, "callback")
+        payload = params.payload or {}
+        response_type = payload.get("type", 4)
+        message = self.fake.message(None, payload.get("data") or {})
+        interaction = {
+            "id": str(interaction_id),
+            "type": 2,
+            "response_message_id": message["id"],
+            "response_message_loading": response_type == 5,
+            "response_message_ephemeral": False
+        }
+        resource = {"type": response_type}
+        if response_type in (4, 7):
+            resource["message"] = message
+        return {"interaction": interaction, "resource": resource}
+
+    async def execute_webhook(self, webhook_id, token, *, payload=None,
+                              **kwargs):
+        await self.fake.respond(token, "followup")
+        return self.fake.message(None, payload or {})
+
+    async def get_original_interaction_response(self, application_id, token,
+                                                **kwargs):
+        await self.fake.respond(token, "get_original")
+        return self.fake.message(None, {})
+
+    async def edit_original_interaction_response(self, application_id, token,
+                                                 *, payload=None, **kwargs):
+        await self.fake.respond(token, "edit_original")
+        return self.fake.message(None, payload or {})
+
+    async def delete_original_interaction_response(self, application_id,
+                                                   token, **kwargs):
+        await self.fake.respond(token, "delete_original")
+
+    async def get_webhook_message(self, webhook_id, token, message_id,
+                                  **kwargs):
+        await self.fake.respond(token, "get_message")
+        return self.fake.message(None, {}, message_id=message_id)
+
+    async def edit_webhook_message(self, webhook_id, token, message_id, *,
+                                   payload=None, **kwargs):
+        await self.fake.respond(token, "edit_message")
+        return self.fake.message(None, payload or {}, message_id=message_id)
+
+    async def delete_webhook_message(self, webhook_id, token, message_id,
+                                     **kwargs):
+        await self.fake.respond(token, "delete_message")
+
+
+class FakeDiscord:
+    """Stands in for the Discord API.
+
+    REST requests and interaction responses are answered locally after
+    latency seconds. The time from dispatching an interaction to its first
+    response is recorded in latencies, keyed by interaction token.
+    Commands whose handler raised are recorded in failed, even though the
+    error handler answers them."""
+
+    def __init__(self, bot, *, latency=0.0):
+        self.bot = bot
+        self.latency = latency
+        self.rest_calls = collections.Counter()
+        self.responses = collections.Counter()
+        self.latencies = {}
+        self.failed = set()
+        self.pending = {}
+        self._ids = itertools.count(
+            (int(time.time() * 1000) - DISCORD_EPOCH) << 22)
+        self.application_id = self.snowflake()
+        self.user = self.user_payload(self.application_id, "Toothy", bot=True)
+
+    def snowflake(self):
+        return next(self._ids)
+
+    def install(self):
+        """Routes the bot's REST requests and interaction responses here.
+        Call from within the task that runs the benchmark, as the webhook
+        adapter is looked up through a context variable"""
+        state = self.bot._connection
+        state.user = discord.ClientUser(state=state, data=self.user)
+        state.application_id = self.application_id
+        rest = getattr(self.bot, "rest", None)
+        if rest is not None and rest._request is not None:
+            # Keep the REST tracker in front of the fake
+            rest._request = self.request
+        else:
+            self.bot.http.request = self.request
+        webhook_async.async_context.set(FakeAdapter(self))
+        tree = self.bot.tree
+        on_error = tree.on_error
+
+        async def record_failure(interaction, error):
+            if isinstance(error, discord.app_commands.CommandInvokeError):
+                self.failed.add(interaction.token)
+            await on_error(interaction, error)
+
+        tree.on_error = record_failure
+
+    def succeeded(self):
+        """Returns the response latencies of interactions that didn't
+        fail"""
+        return [
+            latency for token, latency in self.latencies.items()
+            if token not in self.failed
+        ]
+
+    async def request(self, route, *, files=None, form=None, **kwargs):
+        self.rest_calls[route.key] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        path = route.path
+        if "/messages" not in path or route.method == "DELETE":
+            return None
+        payload = kwargs.get("json") or {}
+        if route.method == "POST" and path.endswith("/messages"):
+            return self.message(route.channel_id, payload)
+        if path.endswith("{message_id}") and route.method in ("GET", "PATCH"):
+            message_id = int(route.url.rsplit("/", 1)[-1])
+            return self.message(route.channel_id,
+                                payload,
+                                message_id=message_id)
+        return None
+
+    async def respond(self, token, kind):
+        self.responses[kind] += 1
+        sent = self.pending.pop(token, None)
+        if sent is not None:
+            self.latencies[token] = time.perf_counter() - sent
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+    def timestamp(self):
+        return datetime.datetime.now(datetime.timezone.utc).isoformat()
+
+    def user_payload(self, user_id, name, *, bot=False):
+        return {
+            "id": str(user_id),
+            "username": name,
+            "global_name": name,
+            "discriminator": "0",
+            "avatar": None,
+            "bot": bot
+        }
+
+    def role_payload(self, role_id, name, position, permissions="0"):
+        return {
+            "id": str(role_id),
+            "name": name,
+            "permissions": permissions,
+            "position": position,
+            "color": 0,
+            "hoist": False,
+            "managed": False,
+            "mentionable": False,
+            "flags": 0
+        }
+
+    def member_payload(self, user, roles=(), permissions=None):
+        payload = {
+            "user": user,
+            "roles": [str(role_id) for role_id in roles],
+            "joined_at": self.timestamp(),
+            "deaf": False,
+            "mute": False,
+            "flags": 0
+        }
+        if permissions is not None:
+            payload["permissions"] = permissions
+        return payload
+
+    def message(self, channel_id, payload, *, message_id=None):
+        return {
+            "id": str(message_id or self.snowflake()),
+            "channel_id": str(channel_id or 0),
+            "author": self.user,
+            "content": payload.get("content") or "",
+            "timestamp": self.timestamp(),
+            "edited_timestamp": None,
+            "tts": False,
+            "mention_everyone": False,
+            "mentions": [],
+            "mention_roles": [],
+            "attachments": [],
+            "embeds": payload.get("embeds") or [],
+            "components": payload.get("components") or [],
+            "pinned": False,
+            "type": 0,
+            "flags": payload.get("flags") or 0
+        }
+
+    def guild(self, *, members=10, roles=5, channels=2, voice=0, online=0):
+        """Creates a guild in the bot's cache. The bot has a role above
+        every other role with all permissions. The first voice members are
+        in the voice channel and the first online members have a
+        presence"""
+        guild_id = self.snowflake()
+        role_payloads = [self.role_payload(guild_id, "@everyone", 0)]
+        for position in range(1, roles + 1):
+            role_payloads.append(
+                self.role_payload(self.snowflake(), "role-{}".format(position),
+                                  position))
+        bot_role = self.snowflake()
+        role_payloads.append(
+            self.role_payload(bot_role, "Toothy", roles + 1, ALL_PERMISSIONS))
+        channel_payloads = []
+        for position in range(channels):
+            channel_payloads.append({
+                "id": str(self.snowflake()),
+                "type": 0,
+                "guild_id": str(guild_id),
+                "name": "channel-{}".format(position),
+                "position": position,
+                "permission_overwrites": [],
+                "nsfw": False,
+                "parent_id": None
+            })
+        voice_channel = self.snowflake()
+        channel_payloads.append({
+            "id": str(voice_channel),
+            "type": 2,
+            "guild_id": str(guild_id),
+            "name": "voice",
+            "position": channels,
+            "permission_overwrites": [],
+            "bitrate": 64000,
+            "user_limit": 0,
+            "parent_id": None
+        })
+        member_payloads = [self.member_payload(self.user, [bot_role])]
+        for index in range(members):
+            user = self.user_payload(self.snowflake(),
+                                     "member-{}".format(index))
+            member_payloads.append(self.member_payload(user))
+        voice_states = [{
+            "user_id": member["user"]["id"],
+            "channel_id": str(voice_channel),
+            "session_id": "session-{}".format(member["user"]["id"]),
+            "deaf": False,
+            "mute": False,
+            "self_deaf": False,
+            "self_mute": False,
+            "self_video": False,
+            "suppress": False,
+            "request_to_speak_timestamp": None
+        } for member in member_payloads[1:voice + 1]]
+        presences = [{
+            "user": {
+                "id": member["user"]["id"]
+            },
+            "status": "online",
+            "client_status": {
+                "desktop": "online"
+            },
+            "activities": [{
+                "name": "game-{}".format(index),
+                "type": 0,
+                "created_at": int(time.time() * 1000)
+            }]
+        } for index, member in enumerate(member_payloads[1:online + 1])]
+        payload = {
+            "id": str(guild_id),
+            "name": "guild-{}".format(guild_id),
+            "owner_id": member_payloads[-1]["user"]["id"],
+            "member_count": len(member_payloads),
+            "roles": role_payloads,
+            "channels": channel_payloads,
+            "members": member_payloads,
+            "voice_states": voice_states,
+            "presences": presences,
+            "emojis": [],
+            "stickers": [],
+            "features": []
+        }
+        return self.bot._connection._add_guild_from_data(payload)
+
+    def interaction(self,
+                    guild,
+                    member,
+                    interaction_type,
+                    data,
+                    *,
+                    channel=None,
+                    message=None):
+        """Builds an interaction payload for member in guild"""
+        channel = channel or guild.text_channels[0]
+        interaction_id = self.snowflake()
+        payload = {
+            "id": str(interaction_id),
+            "application_id": str(self.application_id),
+            "type": interaction_type,
+            "data": data,
+            "guild_id": str(guild.id),
+            "channel": {
+                "id": str(channel.id),
+                "type": 0,
+                "guild_id": str(guild.id),
+                "name": channel.name,
+                "position": channel.position,
+                "permission_overwrites": []
+            },
+            "channel_id": str(channel.id),
+            "member": self.member_payload(
+                self.user_payload(member.id, member.name),
+                [role.id for role in member.roles[1:]], MEMBER_PERMISSIONS),
+            "token": "token-{}".format(interaction_id),
+            "version": 1,
+            "app_permissions": ALL_PERMISSIONS,
+            "attachment_size_limit": 8 * 1024 * 1024,
+            "locale": "en-US",
+            "guild_locale": "en-US",
+            "entitlements": [],
+            "authorizing_integration_owners": {},
+            "context": 0
+        }
+        if message is not None:
+            payload["message"] = message
+        return payload
+
+    def slash(self, guild, member, command, options=()):
+        """Builds a slash command interaction. command is the qualified
+        name and options a list of option payloads"""
+        names = command.split()
+        nested = list(options)
+        # Subcommands are type 1 options, subcommand groups type 2
+        for depth, name in enumerate(reversed(names[1:])):
+            nested = [{
+                "name": name,
+                "type": 1 if depth == 0 else 2,
+                "options": nested
+            }]
+        data = {
+            "id": str(self.snowflake()),
+            "name": names[0],
+            "type": 1,
+            "options": nested
+        }
+        return self.interaction(guild, member, 2, data)
+
+    def component(self,
+                  guild,
+                  member,
+                  message,
+                  custom_id,
+                  *,
+                  component_type=2,
+                  values=None):
+        """Builds a component interaction on a message payload"""
+        data = {"custom_id": custom_id, "component_type": component_type}
+        if values is not None:
+            data["values"] = [str(value) for value in values]
+        return self.interaction(guild, member, 3, data, message=message)
+
+    def dispatch(self, payload):
+        """Feeds an interaction to the bot like the gateway would"""
+        self.pending[payload["token"]] = time.perf_counter()
+        self.bot._connection.parse_interaction_create(payload)
+
+    async def drain(self, timeout=30):
+        """Waits until every dispatched interaction got a response.
+        Returns how many never did"""
+        deadline = time.monotonic() + timeout
+        while self.pending and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        return len(self.pending)
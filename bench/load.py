@@ -0,0 +1,236 @@
+"""Synthetic load generator.
+
+Runs Toothy against FakeDiscord and an in-process MongoDB stand-in and
+drives a mix of slash commands, role menu clicks and music controls over
+many simulated guilds. Run from the repository root with a valid
+settings/config.json, whose token is never used:
+
+    python -m bench.load --guilds 2000 --interactions 20000
+
+mongomock-motor is used unless --mongo points at a real server. Music
+controls are clicked by members that aren't in a voice channel, as there
+is no Lavalink node, so they measure dispatch and the rejection path."""
+import argparse
+import asyncio
+import logging
+import random
+import time
+import tracemalloc
+
+from bench.fakes import create_bot
+from bench.fakes import use_music_without_nodes
+
+DEFAULT_MIX = "slash=1,rolemenu=3,clear=1,music=1"
+ROLES_PER_MENU = 5
+
+
+def parse_mix(mix):
+    weights = {}
+    for part in mix.split(","):
+        kind, _, weight = part.partition("=")
+        weights[kind.strip()] = float(weight or 1)
+    return weights
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    last = len(values) - 1
+    return values[min(last, int(round(p / 100 * last)))]
+
+
+class LoadTest:
+
+    def __init__(self, args):
+        self.args = args
+        self.mix = parse_mix(args.mix)
+        self.random = random.Random(args.seed)
+        self.guilds = []
+        self.menus = {}
+        self.music_messages = {}
+
+    async def setup(self):
+        args = self.args
+        self.bot, self.fake, self.db_ops = await create_bot(
+            rest_latency=args.rest_latency / 1000, mongo=args.mongo)
+        bot = self.bot
+        await self.populate()
+        extensions = ["cogs.statistics", "cogs.rolemenu"]
+        if "music" in self.mix:
+            use_music_without_nodes()
+            extensions.append("cogs.music")
+        start = time.perf_counter()
+        await bot.load_extensions(extensions)
+        self.load_time = time.perf_counter() - start
+        bot._ready.set()
+        if "music" in self.mix:
+            self.add_music_views()
+
+    async def populate(self):
+        args = self.args
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        for _ in range(args.guilds):
+            self.guilds.append(
+                self.fake.guild(members=args.members,
+                                roles=ROLES_PER_MENU,
+                                channels=2))
+        self.memory_per_guild = ((tracemalloc.get_traced_memory()[0] - before)
+                                 / max(args.guilds, 1))
+        tracemalloc.stop()
+        docs = []
+        for guild in self.guilds:
+            channel = guild.text_channels[0]
+            message_id = self.fake.snowflake()
+            roles = [role for role in guild.roles[1:-1]]
+            docs.append({
+                "message_id": message_id,
+                "name": "menu",
+                "mode": 2,
+                "channel_id": channel.id,
+                "guild_id": guild.id,
+                "color": 0,
+                "placeholder": "Pick roles",
+                "description": None,
+                "roles": [{
+                    "id": role.id,
+                    "emoji": None,
+                    "description": None
+                } for role in roles]
+            })
+            self.menus[guild.id] = (self.fake.message(channel.id, {},
+                                                      message_id=message_id),
+                                    roles)
+        if docs:
+            await self.bot.database.db.rolemenus.insert_many(docs)
+        self.db_ops.clear()
+
+    def add_music_views(self):
+        from cogs.music import MusicControllerView
+        state = self.bot._connection
+        for guild in self.guilds:
+            message = self.fake.message(guild.text_channels[0].id, {})
+            view = MusicControllerView(guild, None)
+            # The controller view has a timeout, so it can't be added as a
+            # persistent view. Attach it to the message like sending it
+            # would
+            state.store_view(view, int(message["id"]))
+            self.music_messages[guild.id] = message
+
+    def payload(self, kind):
+        fake = self.fake
+        guild = self.random.choice(self.guilds)
+        member = self.random.choice(guild.members[1:])
+        if kind == "slash":
+            return fake.slash(guild, member, "statistics user")
+        if kind == "rolemenu":
+            message, roles = self.menus[guild.id]
+            picked = self.random.sample(roles, self.random.randint(1, 2))
+            return fake.component(guild,
+                                  member,
+                                  message,
+                                  "rolemenu:dropdown",
+                                  component_type=3,
+                                  values=[role.id for role in picked])
+        if kind == "clear":
+            message, _ = self.menus[guild.id]
+            return fake.component(guild, member, message,
+                                  "rolemenu:clear_roles")
+        if kind == "music":
+            return fake.component(guild, member,
+                                  self.music_messages[guild.id],
+                                  self.random.choice(
+                                      ["pause_resume", "next", "volup"]))
+        raise ValueError("Unknown interaction kind {}".format(kind))
+
+    async def drive(self):
+        args = self.args
+        kinds = list(self.mix)
+        weights = [self.mix[kind] for kind in kinds]
+        interval = 1 / args.rate if args.rate else 0
+        start = time.perf_counter()
+        for index in range(args.interactions):
+            kind = self.random.choices(kinds, weights)[0]
+            self.fake.dispatch(self.payload(kind))
+            if interval:
+                await asyncio.sleep(interval)
+            elif index % 100 == 99:
+                await asyncio.sleep(0)
+        self.unanswered = await self.fake.drain(args.timeout)
+        self.elapsed = time.perf_counter() - start
+
+    def report(self):
+        fake = self.fake
+        latencies = fake.succeeded()
+        answered = len(latencies)
+        metrics = self.bot.metrics
+        lines = [
+            "guilds:               {}".format(len(self.guilds)),
+            "extension load:       {:.3f}s".format(self.load_time),
+            "memory per guild:     {:.1f} KiB".format(
+                self.memory_per_guild / 1024),
+            "interactions:         {} answered, {} failed, {} "
+            "unanswered".format(answered, len(fake.failed), self.unanswered),
+            "throughput:           {:.1f}/s".format(answered / self.elapsed),
+            "first response p50:   {:.1f}ms".format(
+                percentile(latencies, 50) * 1000),
+            "first response p90:   {:.1f}ms".format(
+                percentile(latencies, 90) * 1000),
+            "first response p99:   {:.1f}ms".format(
+                percentile(latencies, 99) * 1000),
+            "db ops/interaction:   {:.2f}".format(
+                sum(self.db_ops.values()) / max(answered, 1)),
+            "rest calls:           {}".format(sum(fake.rest_calls.values())),
+            "loop lag p99:         {:.1f}ms".format(
+                metrics.percentiles("loop.lag").get(99, 0) * 1000),
+            "load tier:            {}".format(self.bot.governor.tier_name),
+            "rescued/shed/rejected: {}/{}/{}".format(
+                metrics.counters["interactions.rescued"],
+                metrics.counters["interactions.shed"],
+                metrics.counters["interactions.rejected"])
+        ]
+        lines.append("db operations:")
+        lines.extend("  {:<20}{:>8}".format(name, count)
+                     for name, count in self.db_ops.most_common())
+        lines.append("rest routes:")
+        lines.extend("  {:<56}{:>8}".format(route, count)
+                     for route, count in fake.rest_calls.most_common(10))
+        return "\n".join(lines)
+
+    async def run(self):
+        await self.setup()
+        try:
+            await self.drive()
+            print(self.report())
+        finally:
+            await self.bot.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--guilds", type=int, default=1000)
+    parser.add_argument("--members", type=int, default=20,
+                        help="Members per guild")
+    parser.add_argument("--interactions", type=int, default=10000)
+    parser.add_argument("--rate", type=float, default=0,
+                        help="Interactions per second, 0 for as fast as "
+                        "possible")
+    parser.add_argument("--mix", default=DEFAULT_MIX,
+                        help="Weights of slash, rolemenu, clear and music "
+                        "interactions")
+    parser.add_argument("--rest-latency", type=float, default=0,
+                        help="Simulated Discord API latency in ms")
+    parser.add_argument("--mongo", help="MongoDB URI to use instead of "
+                        "mongomock-motor")
+    parser.add_argument("--timeout", type=float, default=60,
+                        help="Seconds to wait for responses after the "
+                        "last interaction")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+    asyncio.run(LoadTest(args).run())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+"""Measures the cache memory of each memory profile.
+
+Guilds are built by FakeDiscord and fed through discord.py's guild
+parser with the client options of each profile, followed by a few
+messages per guild. Memory is traced with tracemalloc and reported per
+1000 guilds. Payloads hold every member, as they would after chunking, so
+the difference comes from what each profile keeps. Run from the
+repository root:
+
+    python -m bench.memory_profile --guilds 1000 --members 100
+
+Intents are read from settings/config.json, or the example config if
+there is none."""
+import argparse
+import asyncio
+import gc
+import json
+import os
+import tracemalloc
+
+import discord
+from discord.ext import commands
+
+from bench.fakes import FakeDiscord
+from toothy.profiles import PROFILES
+from toothy.profiles import client_options
+
+CONFIGS = ("settings/config.json", "settings/config-example.json")
+
+
+def configured_intents():
+    for path in CONFIGS:
+        if os.path.exists(path):
+            with open(path, encoding="utf-8") as f:
+                return discord.Intents(**json.load(f)["INTENTS"])
+    return discord.Intents.default()
+
+
+async def measure(profile, args):
+    options = client_options(profile, configured_intents())
+    options.setdefault("chunk_guilds_at_startup", False)
+    bot = commands.AutoShardedBot(command_prefix=">",
+                                  shard_count=1,
+                                  **options)
+    await bot._async_setup_hook()
+    fake = FakeDiscord(bot)
+    state = bot._connection
+    state.user = discord.ClientUser(state=state, data=fake.user)
+    parse_message = state.parsers["MESSAGE_CREATE"]
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    for _ in range(args.guilds):
+        guild = fake.guild(members=args.members,
+                           roles=args.roles,
+                           channels=2,
+                           voice=args.voice,
+                           online=int(args.members * args.online))
+        author = fake.member_payload(
+            fake.user_payload(fake.snowflake(), "author"))
+        for _ in range(args.messages):
+            message = fake.message(guild.text_channels[0].id,
+                                   {"content": "x" * 40})
+            message["guild_id"] = str(guild.id)
+            message["author"] = author["user"]
+            message["member"] = author
+            parse_message(message)
+    # Let the on_message handlers finish
+    await asyncio.sleep(0.1)
+    gc.collect()
+    used = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    result = {
+        "profile": profile,
+        "per_1k": used / args.guilds * 1000,
+        "members": sum(len(guild.members) for guild in bot.guilds),
+        "users": len(bot.users),
+        "messages": len(bot.cached_messages)
+    }
+    await bot.close()
+    return result
+
+
+async def run(args):
+    results = []
+    for profile in args.profiles.split(","):
+        results.append(await measure(profile, args))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--guilds", type=int, default=1000)
+    parser.add_argument("--members", type=int, default=100,
+                        help="Members per guild")
+    parser.add_argument("--voice", type=int, default=2,
+                        help="Members per guild in a voice channel")
+    parser.add_argument("--online", type=float, default=0.2,
+                        help="Share of members with a presence")
+    parser.add_argument("--roles", type=int, default=10)
+    parser.add_argument("--messages", type=int, default=2,
+                        help="Messages received per guild")
+    parser.add_argument("--profiles", default=",".join(PROFILES))
+    args = parser.parse_args()
+    results = asyncio.run(run(args))
+    print("{} guilds, {} members, {} in voice, {:.0%} online, {} messages "
+          "each".format(args.guilds, args.members, args.voice, args.online,
+                        args.messages))
+    print("{:<10}{:>16}{:>10}{:>10}{:>10}".format("profile", "MiB/1k guilds",
+                                                  "members", "users",
+                                                  "messages"))
+    for result in results:
+        print("{:<10}{:>16.1f}{:>10}{:>10}{:>10}".format(
+            result["profile"], result["per_1k"] / 1024 / 1024,
+            result["members"], result["users"], result["messages"]))
+
+
+if __name__ == "__main__":
+    main()
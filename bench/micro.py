@@ -0,0 +1,310 @@
+"""Micro-benchmarks for hot path helpers.
+
+Each benchmark is timed with timeit and compared to bench/baselines.json.
+Timings are normalised by a pure Python calibration loop measured in the
+same process, so baselines recorded on one machine remain usable on
+another. Each benchmark keeps its fastest short sample, and the median over
+a few fresh worker processes is compared. Run from the repository
+root:
+
+    python -m bench.micro             # compare against the baselines
+    python -m bench.micro --update    # record new baselines
+
+Benchmarks whose modules can't be imported, for example because the
+music cog's dependencies are missing, are skipped."""
+import argparse
+import asyncio
+import collections
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+import timeit
+import types
+
+BASELINES = os.path.join(os.path.dirname(__file__), "baselines.json")
+BENCHMARKS = {}
+
+
+def benchmark(name):
+    """Registers a setup function returning the callable to time"""
+
+    def decorator(setup):
+        BENCHMARKS[name] = setup
+        return setup
+
+    return decorator
+
+
+def calibration():
+    total = 0
+    for i in range(1000):
+        total += i * i
+    return total
+
+
+def fake_guild(roles=25):
+    import discord
+    from discord.ext import commands
+    from bench.fakes import FakeDiscord
+    bot = commands.Bot(command_prefix=">", intents=discord.Intents.default())
+    fake = FakeDiscord(bot)
+    bot._connection.user = discord.ClientUser(state=bot._connection,
+                                              data=fake.user)
+    return fake.guild(members=1, roles=roles)
+
+
+def menu_doc(guild):
+    return {
+        "_id": 1,
+        "name": "Roles",
+        "mode": 2,
+        "message_id": 1,
+        "channel_id": guild.text_channels[0].id,
+        "color": 0,
+        "placeholder": "Pick your roles",
+        "description": "Role menu",
+        "roles": [{
+            "id": role.id,
+            "emoji": "⭐",
+            "description": "Role {}".format(role.name)
+        } for role in reversed(guild.roles[1:-1])]
+    }
+
+
+def command_counts():
+    names = ["play", "skip", "queue", "lyrics", "stop", "pause",
+             "rolemenu create", "statistics user", "volume", "download"]
+    return [{"_id": name, "count": 1000 // (i + 1)}
+            for i, name in enumerate(names)]
+
+
+@benchmark("music.generate_progress_bar")
+def bench_progress_bar():
+    from bench.fakes import import_music
+    generate_progress_bar = import_music().generate_progress_bar
+    return lambda: generate_progress_bar(47)
+
+
+@benchmark("music.get_track_choice_name")
+def bench_track_choice_name():
+    from bench.fakes import import_music
+    get_track_choice_name = import_music().get_track_choice_name
+    track = types.SimpleNamespace(title="A rather long song title " * 4,
+                                  duration=4000)
+    return lambda: get_track_choice_name(track)
+
+
+@benchmark("music.round_to_base")
+def bench_round_to_base():
+    from bench.fakes import import_music
+    round_to_base = import_music().round_to_base
+    return lambda: round_to_base(0.4321)
+
+
+@benchmark("statistics.generate_commands")
+def bench_generate_commands():
+    from cogs.statistics import Statistics
+    counts = command_counts()
+    return lambda: Statistics.generate_commands(None, counts)
+
+
+@benchmark("statistics.generate_diagram")
+def bench_generate_diagram():
+    from cogs.statistics import Statistics
+    counts = command_counts()
+    percentages = Statistics.calc_percentage(None, counts, 5000)
+    return lambda: Statistics.generate_diagram(None, percentages)
+
+
+@benchmark("statistics.calc_percentage")
+def bench_calc_percentage():
+    from cogs.statistics import Statistics
+    counts = command_counts()
+    return lambda: Statistics.calc_percentage(None, counts, 5000)
+
+
+@benchmark("database.dot_notation")
+def bench_dot_notation():
+    from toothy.database import MongoController
+    cog = types.SimpleNamespace()
+    settings = {"volume": 0.5, "shuffle": True, "repeat": False}
+    return lambda: MongoController.dot_notation(None, cog, settings)
+
+
+@benchmark("rolemenu.Menu")
+def bench_menu():
+    from cogs.rolemenu import Menu
+    guild = fake_guild()
+    doc = menu_doc(guild)
+    cog = types.SimpleNamespace(bot=types.SimpleNamespace(
+        get_emoji=lambda emoji_id: None))
+    return lambda: Menu(cog, guild, doc)
+
+
+@benchmark("rolemenu.Menu.compile")
+def bench_menu_compile():
+    from cogs.rolemenu import Menu
+    guild = fake_guild()
+    cog = types.SimpleNamespace(bot=types.SimpleNamespace(
+        get_emoji=lambda emoji_id: None))
+    menu = Menu(cog, guild, menu_doc(guild))
+    return menu.compile
+
+
+@benchmark("rolemenu.RoleMenuView.from_menu")
+def bench_view_from_menu():
+    from cogs.rolemenu import Menu
+    from cogs.rolemenu import RoleMenuView
+    guild = fake_guild()
+    cog = types.SimpleNamespace(bot=types.SimpleNamespace(
+        get_emoji=lambda emoji_id: None))
+    menu = Menu(cog, guild, menu_doc(guild))
+    options = menu.render.options
+    return lambda: RoleMenuView.from_menu(menu, options)
+
+
+def sample_timer(func, sample_time=0.01):
+    """Returns a Timer for func and the number of calls taking about
+    sample_time seconds"""
+    timer = timeit.Timer(func)
+    number, time_taken = timer.autorange()
+    return timer, max(1, int(number * sample_time / time_taken))
+
+
+async def run(args):
+    timers = {"calibration": sample_timer(calibration)}
+    skipped = {}
+    for name, setup in BENCHMARKS.items():
+        if args.filter and args.filter not in name:
+            continue
+        try:
+            timers[name] = sample_timer(setup())
+        except (ImportError, OSError) as e:
+            skipped[name] = "{}: {}".format(type(e).__name__, e)
+    # Short samples interleaved over every benchmark see the same quiet
+    # moments of a busy machine, and only the fastest sample of each is kept
+    results = {}
+    end = time.perf_counter() + args.duration
+    while time.perf_counter() < end:
+        for name, (timer, number) in timers.items():
+            value = timer.timeit(number) / number * 1e9
+            results[name] = min(results.get(name, value), value)
+    return results, skipped
+
+
+def run_workers(args):
+    """Runs the benchmarks in args.processes fresh processes one after
+    another, returning the results of each and the skipped benchmarks"""
+    command = [
+        sys.executable, "-m", "bench.micro", "--worker", "--duration",
+        str(args.duration)
+    ]
+    if args.filter:
+        command += ["--filter", args.filter]
+    runs = []
+    skipped = {}
+    for _ in range(args.processes):
+        output = subprocess.run(command,
+                                check=True,
+                                stdout=subprocess.PIPE,
+                                text=True).stdout
+        worker = json.loads(output.splitlines()[-1])
+        runs.append(worker["results"])
+        skipped.update(worker["skipped"])
+    return runs, skipped
+
+
+def combine(runs):
+    """Returns the median timings over runs. Each run is normalised by its
+    own calibration first, then scaled by the median calibration"""
+    relative = collections.defaultdict(list)
+    for results in runs:
+        for name, value in results.items():
+            relative[name].append(value / results["calibration"])
+    calibration_ns = statistics.median(
+        results["calibration"] for results in runs)
+    return {
+        name: statistics.median(values) * calibration_ns
+        for name, values in relative.items()
+    }
+
+
+def compare(results, baselines, threshold):
+    """Returns report lines and the names of regressed benchmarks"""
+    scale = results["calibration"] / baselines.get("calibration",
+                                                   results["calibration"])
+    lines = ["{:<36}{:>12}{:>12}{:>9}".format("benchmark", "ns/call",
+                                               "baseline", "change")]
+    regressions = []
+    for name, value in results.items():
+        if name == "calibration":
+            continue
+        baseline = baselines.get(name)
+        if baseline is None:
+            lines.append("{:<36}{:>12.0f}{:>12}".format(name, value, "-"))
+            continue
+        expected = baseline * scale
+        change = value / expected - 1
+        flag = ""
+        if change > threshold:
+            regressions.append(name)
+            flag = "  REGRESSION"
+        lines.append("{:<36}{:>12.0f}{:>12.0f}{:>8.1%}{}".format(
+            name, value, expected, change, flag))
+    return lines, regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--update", action="store_true",
+                        help="Write the measured timings as new baselines")
+    parser.add_argument("--threshold", type=float, default=0.25,
+                        help="Relative slowdown that counts as a regression")
+    parser.add_argument("--processes", type=int, default=3,
+                        help="Worker processes to run, the median counts")
+    parser.add_argument("--duration", type=float, default=5.0,
+                        help="Seconds each process samples the benchmarks "
+                        "for, the fastest sample counts")
+    parser.add_argument("--filter", help="Only run benchmarks whose name "
+                        "contains this")
+    parser.add_argument("--worker", action="store_true",
+                        help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.worker:
+        results, skipped = asyncio.run(run(args))
+        print(json.dumps({"results": results, "skipped": skipped}))
+        return
+    runs, skipped = run_workers(args)
+    results = combine(runs)
+    for name, reason in skipped.items():
+        print("skipped {}: {}".format(name, reason))
+    try:
+        with open(BASELINES, encoding="utf-8") as f:
+            baselines = json.load(f)
+    except FileNotFoundError:
+        baselines = {}
+    if args.update:
+        if "calibration" in baselines:
+            # Keep existing baselines on the same scale
+            scale = baselines["calibration"] / results["calibration"]
+            results = {name: value * scale for name, value in results.items()}
+        baselines.update(
+            {name: round(value, 1) for name, value in results.items()})
+        with open(BASELINES, encoding="utf-8", mode="w") as f:
+            json.dump(baselines, f, indent=4, sort_keys=True)
+            f.write("\n")
+        print("Baselines written to {}".format(BASELINES))
+        return
+    lines, regressions = compare(results, baselines, args.threshold)
+    print("\n".join(lines))
+    if regressions:
+        print("{} benchmarks regressed by more than {:.0%}".format(
+            len(regressions), args.threshold))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
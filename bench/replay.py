@@ -0,0 +1,164 @@
+"""Replays a recorded gateway trace into Toothy.
+
+Traces are recorded by enabling RECORDER in settings/config.json. The
+events are fed through discord.py's parsers like the gateway would, at
+their recorded pace or as fast as possible, against FakeDiscord and a
+MongoDB stand-in. Run from the repository root:
+
+    python -m bench.replay logs/trace-0-20240101-000000.jsonl.gz --speed 0"""
+import argparse
+import asyncio
+import collections
+import logging
+import time
+
+from bench.fakes import create_bot
+from bench.fakes import use_music_without_nodes
+from bench.load import percentile
+from toothy.recorder import read_header
+from toothy.recorder import read_trace
+
+DEFAULT_EXTENSIONS = "cogs.statistics,cogs.rolemenu"
+
+
+def replace_id(value, old, new):
+    """Returns value with every occurrence of the snowflake old, as a
+    string, integer or key, replaced by new"""
+    if isinstance(value, dict):
+        return {
+            new if k == old else k: replace_id(v, old, new)
+            for k, v in value.items()
+        }
+    if isinstance(value, list):
+        return [replace_id(v, old, new) for v in value]
+    if value == old:
+        return new
+    if isinstance(value, int) and str(value) == old:
+        return int(new)
+    return value
+
+
+class Replay:
+
+    def __init__(self, args):
+        self.args = args
+        self.events = collections.Counter()
+        self.parse_time = collections.Counter()
+        self.unknown = collections.Counter()
+
+    async def setup(self):
+        args = self.args
+        self.bot, self.fake, self.db_ops = await create_bot(
+            rest_latency=args.rest_latency / 1000, mongo=args.mongo)
+        extensions = args.extensions.split(",")
+        if "cogs.music" in extensions:
+            use_music_without_nodes()
+        await self.bot.load_extensions(extensions)
+        self.bot._ready.set()
+        # The bot's own id was pseudonymized like any other, so map it to
+        # the fake user or guild.me would be missing
+        self.recorded_user = read_header(args.trace).get("user")
+
+    async def replay(self):
+        args = self.args
+        parsers = self.bot._connection.parsers
+        start = time.perf_counter()
+        for index, record in enumerate(read_trace(args.trace)):
+            if args.limit and index >= args.limit:
+                break
+            if args.speed:
+                delay = record["t"] / args.speed - (time.perf_counter() -
+                                                    start)
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            elif index % 100 == 99:
+                await asyncio.sleep(0)
+            event = record["e"]
+            try:
+                parser = parsers[event]
+            except KeyError:
+                self.unknown[event] += 1
+                continue
+            data = record["d"]
+            if self.recorded_user:
+                data = replace_id(data, self.recorded_user,
+                                  str(self.fake.application_id))
+            if event == "INTERACTION_CREATE":
+                self.fake.pending[data["token"]] = time.perf_counter()
+            parse_start = time.perf_counter()
+            try:
+                parser(data)
+            except Exception as e:
+                logging.getLogger(__name__).warning(
+                    "Failed to replay {}: {}".format(event, e))
+            self.parse_time[event] += time.perf_counter() - parse_start
+            self.events[event] += 1
+        self.unanswered = await self.fake.drain(args.timeout)
+        # Let listeners scheduled by the last events finish
+        await asyncio.sleep(0.5)
+        self.elapsed = time.perf_counter() - start
+
+    def report(self):
+        fake = self.fake
+        latencies = fake.succeeded()
+        total = sum(self.events.values())
+        metrics = self.bot.metrics
+        lines = [
+            "events:               {} in {:.2f}s ({:.0f}/s)".format(
+                total, self.elapsed, total / self.elapsed),
+            "interactions:         {} answered, {} failed, {} "
+            "unanswered".format(len(latencies), len(fake.failed),
+                                self.unanswered),
+            "first response p50:   {:.1f}ms".format(
+                percentile(latencies, 50) * 1000),
+            "first response p99:   {:.1f}ms".format(
+                percentile(latencies, 99) * 1000),
+            "db ops:               {}".format(sum(self.db_ops.values())),
+            "rest calls:           {}".format(sum(fake.rest_calls.values())),
+            "loop lag p99:         {:.1f}ms".format(
+                metrics.percentiles("loop.lag").get(99, 0) * 1000),
+            "event{}count  parse total".format(" " * 28)
+        ]
+        for event, count in self.events.most_common():
+            lines.append("{:<32}{:>7}{:>10.1f}ms".format(
+                event, count, self.parse_time[event] * 1000))
+        for event, count in self.unknown.most_common():
+            lines.append("{:<32}{:>7}  unknown".format(event, count))
+        lines.append("db operations:")
+        lines.extend("  {:<20}{:>8}".format(name, count)
+                     for name, count in self.db_ops.most_common())
+        return "\n".join(lines)
+
+    async def run(self):
+        await self.setup()
+        try:
+            await self.replay()
+            print(self.report())
+        finally:
+            await self.bot.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("trace", help="Trace recorded by TraceRecorder")
+    parser.add_argument("--speed", type=float, default=1,
+                        help="Replay speed, 1 for the recorded pace and 0 "
+                        "for as fast as possible")
+    parser.add_argument("--extensions", default=DEFAULT_EXTENSIONS,
+                        help="Comma separated extensions to load")
+    parser.add_argument("--limit", type=int, default=0,
+                        help="Only replay this many events")
+    parser.add_argument("--rest-latency", type=float, default=0,
+                        help="Simulated Discord API latency in ms")
+    parser.add_argument("--mongo", help="MongoDB URI to use instead of "
+                        "mongomock-motor")
+    parser.add_argument("--timeout", type=float, default=60,
+                        help="Seconds to wait for interaction responses "
+                        "after the last event")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+    asyncio.run(Replay(args).run())
+
+
+if __name__ == "__main__":
+    main()
@@ -2,6 +2,7 @@ import json
 import logging
 
 from discord.ext import commands
+from toothy.webclient import WebClientError
 
 log = logging.getLogger(__name__)
 
@@ -25,15 +26,17 @@ class BotSite:
         for key, value in payload_template.items():
             if key in self.template:
                 payload[self.template[key]] = value
-        headers = {
-            "Authorization": self.token,
-            "Content-Type": "application/json"
-        }
-        async with self.bot.session.post(self.url,
-                                         data=json.dumps(payload),
-                                         headers=headers) as r:
-            log.info("Url: {} Payload: {} Response: {}".format(
-                self.url, payload, r.status))
+        try:
+            response = await self.bot.web.post(
+                self.url,
+                json_body=payload,
+                headers={"Authorization": self.token},
+                retries=2)
+        except WebClientError as e:
+            log.warning("Failed to post stats to {}: {}".format(self.url, e))
+            return
+        log.info("Url: {} Payload: {} Response: {}".format(
+            self.url, payload, response.status))
 
 
 class ListingSites(commands.Cog):
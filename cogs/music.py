@@ -10,20 +10,24 @@ import time
 import urllib.parse
 from pathlib import Path
 
-import aiocache
 import async_timeout
 import discord
-import sponsorblock
 import wavelink
 from discord import ButtonStyle, InteractionResponse, app_commands
 from discord.ext import commands, tasks
-from wavelink.ext import spotify
-from yt_dlp import YoutubeDL
-from yt_dlp.utils import YoutubeDLError
+from toothy.deferral import GuardedView
+from toothy.webclient import WebClientError
 
 log = logging.getLogger(__name__)
 
 LYRICS_URL = "https://some-random-api.ml/lyrics?title={}"
+LYRICS_CACHE_TTL = 600
+SPONSORBLOCK_URL = "https://sponsor.ajay.app/api/skipSegments"
+SPONSORBLOCK_CACHE_TTL = 3600
+YOUTUBE_HOSTS = ("youtube.com", "www.youtube.com", "m.youtube.com",
+                 "music.youtube.com")
+# Paths carrying the video id, e.g. /shorts/<id>
+YOUTUBE_ID_PATHS = ("shorts", "embed", "live", "v")
 EMBED_COLORS = {"youtube": discord.Color(0xFF0000)}
 
 PROGRESS_BAR_PART_1 = "<:light:993605820304609280>"  # red line
@@ -46,6 +50,10 @@ async def download_track(track: wavelink.Track):
         return save_path
 
     def wrapped():
+        # yt-dlp pulls in hundreds of extractor modules, so it is only
+        # imported once someone actually downloads something
+        from yt_dlp import YoutubeDL
+        from yt_dlp.utils import YoutubeDLError
 
         def check(info, *, incomplete):
             duration = info.get('duration')
@@ -81,8 +89,11 @@ async def download_track(track: wavelink.Track):
             "ffmpeg_location":
             CONFIG["ffmpeg_location"],
         }
-        with YoutubeDL(ydl_opts) as ydl:
-            return ydl.download([track.uri])
+        try:
+            with YoutubeDL(ydl_opts) as ydl:
+                return ydl.download([track.uri])
+        except YoutubeDLError as e:
+            raise DownloadError(str(e)) from e
 
     code = await asyncio.get_event_loop().run_in_executor(None, wrapped)
     if code == 0:
@@ -96,6 +107,11 @@ class LockedMenuPermissionsError:
     pass
 
 
+class DownloadError(Exception):
+    """The downloader failed to fetch the track."""
+    pass
+
+
 class UserNotInVoiceChannelError(Exception):
     """The user is not in a voice channel."""
     pass
@@ -109,6 +125,37 @@ def user_in_voice_channel(interaction: discord.Interaction) -> bool:
     return interaction.user.voice is not None
 
 
+def count_listeners(channel: discord.VoiceChannel) -> int:
+    """Counts the users in a voice channel that aren't bots.
+
+    Reads the channel's voice states rather than its members, as those are
+    kept without the member cache. Users that aren't cached count as
+    listeners."""
+    guild = channel.guild
+    count = 0
+    for user_id in channel.voice_states:
+        member = guild.get_member(user_id)
+        if member is None or not member.bot:
+            count += 1
+    return count
+
+
+SkipSegment = collections.namedtuple("SkipSegment", "start end")
+
+
+def youtube_video_id(url):
+    """Returns the video id of a YouTube URL, or None"""
+    parsed = urllib.parse.urlparse(url or "")
+    if parsed.hostname == "youtu.be":
+        return parsed.path.lstrip("/") or None
+    if parsed.hostname in YOUTUBE_HOSTS:
+        parts = parsed.path.split("/")
+        if len(parts) > 2 and parts[1] in YOUTUBE_ID_PATHS:
+            return parts[2] or None
+        return urllib.parse.parse_qs(parsed.query).get("v", [None])[0]
+    return None
+
+
 def get_track_choice_name(track: wavelink.Track):
     if hasattr(track, "duration"):
         duration = track.duration
@@ -195,7 +242,7 @@ class SongInputModal(discord.ui.Modal, title='Search song'):
         await self.controller.cog.add_song_via_command(interaction, results)
 
 
-class MusicControllerView(discord.ui.View):
+class MusicControllerView(GuardedView):
 
     def __init__(self, guild: discord.Guild, controller):
         super().__init__(timeout=1200.0)
@@ -464,7 +511,7 @@ class MusicControllerView(discord.ui.View):
             self.controller.cog.download_tasks[track.identifier] = task
             path = await asyncio.wait_for(task, timeout=60)
             del self.controller.cog.download_tasks[track.identifier]
-        except YoutubeDLError as e:
+        except DownloadError as e:
             await interaction.followup.send(
                 "The downloader encountered an error. Please try again later.",
                 ephemeral=True)
@@ -582,7 +629,10 @@ class MusicController:
         self.equalizer_on = False
         self.repeat = False
         self.locked = False
-        self.bot.loop.create_task(self.controller_loop())
+        self.stopped = False
+        self.bot.tasks.spawn(self.controller_loop(),
+                             name="music:controller:{}".format(guild.id),
+                             owner="Music")
 
     async def adjust_volume(self, volume: float):
         volume = round(volume, 2)
@@ -595,10 +645,17 @@ class MusicController:
         return True
 
     async def stop(self):
+        if self.stopped:
+            return
+        self.stopped = True
+        # Cancels the controller loop unless it's the one stopping
+        self.bot.tasks.cancel("music:controller:{}".format(self.guild.id))
+        self.bot.tasks.cancel("music:sponsorblock:{}".format(self.guild.id))
+        self.bot.tasks.cancel("music:menu:{}".format(self.guild.id))
         player: Player = self.guild.voice_client
         if player and player.is_connected():
             await player.disconnect()
-        del self.cog.controllers[self.guild.id]
+        self.cog.controllers.pop(self.guild.id, None)
         if self.menu_message:
             await self.menu_message.delete()
 
@@ -655,6 +712,17 @@ class MusicController:
             channel = self.guild.voice_client.channel
             self.menu_message = await channel.send(embed=embed, view=view)
 
+    def schedule_menu_update(self, delay):
+        """Updates the menu after delay seconds. Scheduling again before
+        then replaces the pending update, so bursts result in one edit"""
+        self.bot.tasks.spawn(self._delayed_menu_update(delay),
+                             name="music:menu:{}".format(self.guild.id),
+                             owner="Music")
+
+    async def _delayed_menu_update(self, delay):
+        await asyncio.sleep(delay)
+        await self.update_menu()
+
     async def previous(self, *, response: InteractionResponse = None):
         player: Player = self.guild.voice_client
         runtime = time.time() - self.song_start_time
@@ -722,22 +790,52 @@ class Music(commands.Cog):
         self.bot = bot
         self.controllers = {}
         self.searches_collection = self.bot.database.db.searches
-        self.sb = sponsorblock.Client()
         self.delete_old_downloads.start()
         self.download_tasks = {}
 
     async def cog_load(self):
+        state = self.bot.pop_cog_state(self)
+        if state:
+            self.import_state(state)
+            # Nodes live in wavelink's pool and survive the reload
+            return
         spotify_client = None
         if CONFIG["spotify"]["client_id"] and CONFIG["spotify"][
                 "client_secret"]:
+            from wavelink.ext import spotify
             spotify_client = spotify.SpotifyClient(**CONFIG["spotify"])
         for node in CONFIG["nodes"]:
             if spotify_client:
                 node["spotify_client"] = spotify_client
             await wavelink.NodePool.create_node(bot=self.bot, **node)
 
+    def memory_usage(self):
+        controllers = self.controllers.values()
+        return {
+            "controllers": len(self.controllers),
+            "queued_tracks": sum(len(c.queue) for c in controllers),
+            "previous_songs": sum(len(c.previous_songs) for c in controllers),
+            "download_tasks": len(self.download_tasks)
+        }
+
+    def export_state(self):
+        return {
+            "controllers": self.controllers,
+            "download_tasks": self.download_tasks
+        }
+
+    def import_state(self, state):
+        self.controllers = state["controllers"]
+        self.download_tasks = state["download_tasks"]
+        for controller in self.controllers.values():
+            controller.cog = self
+            # Let existing controllers run the reloaded code
+            controller.__class__ = MusicController
+
     async def cog_unload(self):
         self.delete_old_downloads.cancel()
+        if self.bot.is_handing_over(self):
+            return
         for voice_state in self.bot.voice_clients:
             await voice_state.disconnect(force=True)
 
@@ -746,32 +844,56 @@ class Music(commands.Cog):
         print(f'Node: <{node.identifier}> is ready!')
 
     async def get_skip_segments(self, url: str):
-
-        def proxy_pass(url):
-            return self.sb.get_skip_segments(url)
-
-        return await self.bot.loop.run_in_executor(None, proxy_pass, url)
+        video_id = youtube_video_id(url)
+        if not video_id:
+            return []
+        response = await self.bot.web.get(SPONSORBLOCK_URL,
+                                          params={"videoID": video_id},
+                                          timeout=5,
+                                          cache_ttl=SPONSORBLOCK_CACHE_TTL)
+        # 404 means there are no segments for the video, and is cached too
+        # so those videos don't hit the API every time they are played
+        if response.status != 200 or not isinstance(response.data, list):
+            return []
+        return [
+            SkipSegment(*segment["segment"]) for segment in response.data
+        ]
 
     @commands.Cog.listener()
     async def on_wavelink_track_start(self, player: wavelink.player,
                                       track: wavelink.Track):
         controller = self.get_controller(player.guild)
         controller.song_start_time = time.time()
-        await controller.update_menu(response=controller.response)
+        # Menu edits not answering an interaction are batched under load
+        delay = self.bot.governor.pick(0, 3, 10)
+        if controller.response or not delay:
+            await controller.update_menu(response=controller.response)
+        else:
+            controller.schedule_menu_update(delay)
         controller.response = None
         try:
             segments = await self.get_skip_segments(track.uri)
         except Exception:
             segments = []
         if segments:
-            while True:
-                if controller.guild.voice_client.source.id != track.id:
-                    break
-                position = player.position
-                for segment in segments:
-                    if position >= segment.start and position <= segment.end:
-                        await player.seek(segment.end * 1000)
-                await asyncio.sleep(0.5)
+            self.bot.tasks.spawn(self.skip_segments_loop(
+                player, track, segments),
+                                 name="music:sponsorblock:{}".format(
+                                     player.guild.id),
+                                 owner="Music")
+
+    async def skip_segments_loop(self, player, track, segments):
+        while True:
+            voice_client = player.guild.voice_client
+            if not voice_client or voice_client.source is None:
+                break
+            if voice_client.source.id != track.id:
+                break
+            position = player.position
+            for segment in segments:
+                if position >= segment.start and position <= segment.end:
+                    await player.seek(segment.end * 1000)
+            await asyncio.sleep(self.bot.governor.pick(0.5, 1, 2))
 
     @commands.Cog.listener()
     async def on_wavelink_track_end(self, player, track, reason):
@@ -829,7 +951,6 @@ class Music(commands.Cog):
                 return []
         elif platform == "spotify":
             return []
-            cls = spotify.SpotifyTrack
         results = await cls.search(query)
         if not results:
             return []
@@ -867,17 +988,17 @@ class Music(commands.Cog):
             return list(reversed(results))
         return await self.get_tracks_by_query(current, **search)
 
-    @aiocache.cached(ttl=600)
     async def get_lyrics(self, track: wavelink.Track):
         title = urllib.parse.quote(track.title)
         url = LYRICS_URL.format(title)
-        async with self.bot.session.get(url) as resp:
-            if resp.status != 200:
-                return None
-            data = await resp.json()
-            if not data:
-                return None
-            return data
+        try:
+            response = await self.bot.web.get(url, cache_ttl=LYRICS_CACHE_TTL)
+        except WebClientError as e:
+            log.warning("Failed to fetch lyrics: {}".format(e))
+            return None
+        if response.status != 200 or not isinstance(response.data, dict):
+            return None
+        return response.data
 
     async def add_song_via_command(self,
                                    interaction: discord.Interaction,
@@ -957,10 +1078,13 @@ class Music(commands.Cog):
             await controller.update_menu()
 
     @app_commands.command(
-        extras={"search": {
-            "search_type": "song",
-            "platform": "youtube"
-        }})
+        extras={
+            "search": {
+                "search_type": "song",
+                "platform": "youtube"
+            },
+            "defer_ephemeral": False
+        })
     @app_commands.guild_only()
     @app_commands.describe(
         query="The URL of the song to play, or a search term.")
@@ -977,16 +1101,20 @@ class Music(commands.Cog):
         await self.add_song_via_command(interaction, results, url=query)
 
     @app_commands.command(
-        extras={"search": {
-            "search_type": "song",
-            "platform": "spotify"
-        }})
+        extras={
+            "search": {
+                "search_type": "song",
+                "platform": "spotify"
+            },
+            "defer_ephemeral": False
+        })
     @app_commands.guild_only()
     @app_commands.describe(
         url="The URL of the song to play, or the Spotify ID.")
     @app_commands.autocomplete(url=song_search_autocomplete)
     async def play_spotify(self, interaction: discord.Interaction, url: str):
         """Search for and add a song to the Queue."""
+        from wavelink.ext import spotify
         if not interaction.user.voice:
             return await interaction.response.send_message(
                 "You are not in a voice channel.")
@@ -1011,10 +1139,13 @@ class Music(commands.Cog):
         await self.add_song_via_command(interaction, results, url=url)
 
     @app_commands.command(
-        extras={"search": {
-            "search_type": "playlist",
-            "platform": "youtube"
-        }})
+        extras={
+            "search": {
+                "search_type": "playlist",
+                "platform": "youtube"
+            },
+            "defer_ephemeral": False
+        })
     @app_commands.guild_only()
     @app_commands.describe(url="The URL of the playlist to play.")
     @app_commands.autocomplete(url=song_search_autocomplete)
@@ -1037,7 +1168,7 @@ class Music(commands.Cog):
         player.pause()
         return True
 
-    @app_commands.command()
+    @app_commands.command(extras={"defer_ephemeral": False})
     @app_commands.guild_only()
     async def pause(self, interaction: discord.Interaction):
         """Pause the playback."""
@@ -1055,7 +1186,7 @@ class Music(commands.Cog):
         else:
             await interaction.response.send_message('Currently not playing.')
 
-    @app_commands.command()
+    @app_commands.command(extras={"defer_ephemeral": False})
     @app_commands.guild_only()
     async def resume(self, interaction: discord.Interaction):
         """Resume the player from a paused state."""
@@ -1071,7 +1202,7 @@ class Music(commands.Cog):
             return await interaction.response.send_message(
                 'Currently not paused.')
 
-    @app_commands.command()
+    @app_commands.command(extras={"defer_ephemeral": False})
     @app_commands.guild_only()
     async def skip(self, interaction: discord.Interaction):
         """Skip the currently playing song."""
@@ -1083,7 +1214,7 @@ class Music(commands.Cog):
         await interaction.response.send_message('Skipping the song!')
         await player.stop()
 
-    @app_commands.command()
+    @app_commands.command(extras={"defer_ephemeral": False})
     @app_commands.guild_only()
     @app_commands.describe(
         volume="The volume, between 0 and 100. Moderators can increase "
@@ -1102,7 +1233,7 @@ class Music(commands.Cog):
         if player:
             await player.set_volume(vol)
 
-    @app_commands.command()
+    @app_commands.command(extras={"defer_ephemeral": False})
     @app_commands.guild_only()
     async def song(self, interaction: discord.Interaction):
         """Retrieve the currently playing song."""
@@ -1114,7 +1245,7 @@ class Music(commands.Cog):
         await interaction.response.send_message(
             f'Now playing: `{player.source}`')
 
-    @app_commands.command()
+    @app_commands.command(extras={"defer_ephemeral": False})
     @app_commands.guild_only()
     async def queue(self, interaction: discord.Interaction):
         """Retrieve information on the next 5 songs from the queue."""
@@ -1131,7 +1262,7 @@ class Music(commands.Cog):
 
         await interaction.response.send_message(embed=embed)
 
-    @app_commands.command()
+    @app_commands.command(extras={"defer_ephemeral": False})
     @app_commands.guild_only()
     async def stop(self, interaction: discord.Interaction):
         """Stop and disconnect the player and controller."""
@@ -1158,8 +1289,7 @@ class Music(commands.Cog):
         if not player:
             return
         if before.channel and before.channel == player.channel:
-            members = [m for m in player.channel.members if not m.bot]
-            if len(members) == 0:
+            if count_listeners(player.channel) == 0:
                 await controller.stop()
                 return await before.channel.send(
                     "All users have left. Stopping playback.")
@@ -1,13 +1,18 @@
 import asyncio
 import copy
-import json
+import datetime
+import io
 import logging
 import random
+import time
 import traceback
 
 import discord
 from discord.ext import commands
 
+from toothy import memory
+from toothy.profiler import SamplingProfiler
+
 log = logging.getLogger(__name__)
 
 STATUSES = {
@@ -25,12 +30,102 @@ ACTIVITY_TYPES = {
 }
 
 
+PRESENCE_DEFAULTS = {
+    "interval": 180,
+    "interval_range": [],
+    "status": "online",
+    "type": "playing",
+    "enabled": False,
+    "randomize": False,
+    "games": []
+}
+
+# Presence changes are spread over up to this many seconds so that
+# every shard doesn't hit the gateway at once
+PRESENCE_JITTER = 30
+
+
+class PresenceManager:
+    """Rotates the bot's activity.
+
+    Settings are kept in memory and changed through update, which wakes
+    the rotation up so changes apply immediately."""
+
+    def __init__(self, bot):
+        self.bot = bot
+        self.settings = dict(PRESENCE_DEFAULTS)
+        self.index = 0
+        self.changed = asyncio.Event()
+
+    def update(self, **settings):
+        self.settings.update(settings)
+        self.changed.set()
+
+    def get_interval(self):
+        interval = self.settings.get("interval")
+        if not interval:
+            interval_range = self.settings.get("interval_range")
+            if interval_range:
+                interval = random.randrange(*interval_range)
+        return interval
+
+    def next_game(self):
+        games = self.settings.get("games", [])
+        if not games:
+            return None
+        if self.settings.get("randomize", False):
+            return random.choice(games)
+        if self.index >= len(games):
+            self.index = 0
+        game = games[self.index]
+        self.index += 1
+        return game
+
+    async def apply(self, interval):
+        game = self.next_game()
+        activity = None
+        if game:
+            activity = discord.Activity(
+                name=game.format(bot=self.bot),
+                type=ACTIVITY_TYPES[self.settings["type"]])
+        status = STATUSES[self.settings["status"]]
+        window = min(PRESENCE_JITTER, interval / 2)
+        offsets = sorted((random.uniform(0, window), shard_id)
+                         for shard_id in self.bot.shards)
+        elapsed = 0
+        for offset, shard_id in offsets:
+            await asyncio.sleep(offset - elapsed)
+            elapsed = offset
+            await self.bot.change_presence(activity=activity,
+                                           status=status,
+                                           shard_id=shard_id)
+
+    async def run(self):
+        await self.bot.wait_until_ready()
+        while True:
+            self.changed.clear()
+            interval = None
+            try:
+                if self.settings.get("enabled"):
+                    interval = self.get_interval()
+                    if interval and self.bot.available:
+                        await self.apply(interval)
+            except Exception as e:
+                log.exception("Error in presence manager", exc_info=e)
+            try:
+                await asyncio.wait_for(self.changed.wait(), interval)
+            except asyncio.TimeoutError:
+                pass
+
+
 class Owner(commands.Cog):
     """Control the bot's global settings"""
 
     def __init__(self, bot):
         self.bot = bot
-        self.presence_manager_current_index = 0
+        self.presence = PresenceManager(bot)
+        self.profiling = False
+        self.snapshots = memory.SnapshotDiff()
 
     async def cog_check(self, ctx):
         return await self.bot.is_owner(ctx.author)
@@ -44,11 +139,7 @@ class Owner(commands.Cog):
         except Exception:
             return await ctx.send("```py\n{}\n```".format(
                 traceback.format_exc()))
-        with open("settings/extensions.json", encoding="utf-8", mode="r") as f:
-            data = json.load(f)
-            data[extension] = True
-        with open("settings/extensions.json", encoding="utf-8", mode="w") as f:
-            f.write(json.dumps(data, indent=4, sort_keys=True))
+        self.bot.extensions_file[extension] = True
         await ctx.send("Extension loaded succesfully")
 
     @commands.command(name="unload")
@@ -62,16 +153,23 @@ class Owner(commands.Cog):
         except Exception:
             return await ctx.send("```py\n{}\n```".format(
                 traceback.format_exc()))
-        with open("settings/extensions.json", encoding="utf-8", mode="r") as f:
-            data = json.load(f)
-            data[extension] = False
-        with open("settings/extensions.json", encoding="utf-8", mode="w") as f:
-            f.write(json.dumps(data, indent=4, sort_keys=True))
+        self.bot.extensions_file[extension] = False
         await ctx.send("Extension unloaded succesfully")
 
     @commands.command(name="reload")
     async def reload_extension(self, ctx, *, name: str):
-        """Reloads an extension"""
+        """Reloads an extension, keeping its cogs' runtime state"""
+        extension = "cogs." + name.strip()
+        try:
+            await self.bot.hot_reload_extension(extension)
+        except Exception:
+            return await ctx.send("```py\n{}\n```".format(
+                traceback.format_exc()))
+        await ctx.send("Extension reloaded succesfully")
+
+    @commands.command(name="coldreload")
+    async def cold_reload_extension(self, ctx, *, name: str):
+        """Reloads an extension from scratch, discarding its state"""
         extension = "cogs." + name.strip()
         try:
             await self.bot.reload_extension(extension)
@@ -89,21 +187,247 @@ class Owner(commands.Cog):
         await self.bot.process_commands(message)
 
     @commands.command()
-    async def sync(self, ctx, guild_only: bool = False):
-        """Sync command tree. TODO: Automatic!"""
+    async def sync(self, ctx, guild_only: bool = False, force: bool = False):
+        """Sync command tree
+
+        The tree is synced automatically on startup when it changes. Only
+        needed to copy global commands to the test guild, or to force it"""
         if guild_only:
             test_guild = discord.Object(id=self.bot.test_guild)
             self.bot.tree.copy_global_to(guild=test_guild)
-            await self.bot.tree.sync(guild=test_guild)
+            synced = await self.bot.sync_command_tree(test_guild, force=force)
         else:
-            await self.bot.tree.sync()
+            synced = await self.bot.sync_command_tree(force=force)
+        if not synced:
+            return await ctx.send("Command tree unchanged, nothing to sync")
         await ctx.send("Synced")
 
+    @commands.group(name="prefix")
+    @commands.guild_only()
+    async def prefix_group(self, ctx):
+        """Manage this server's command prefixes"""
+        if ctx.invoked_subcommand is None:
+            await ctx.send_help(ctx.command)
+            return
+
+    @prefix_group.command(name="set")
+    async def prefix_set(self, ctx, *prefixes):
+        """Sets the prefixes used in this server instead of the global ones
+
+        Separated by spaces, enclosed in double quotes"""
+        if not prefixes:
+            return await ctx.send_help(ctx.command)
+        await self.bot.prefixes.set(self.bot, ctx.guild, prefixes)
+        await ctx.send("Prefixes set")
+
+    @prefix_group.command(name="reset")
+    async def prefix_reset(self, ctx):
+        """Reverts this server to the global prefixes"""
+        await self.bot.prefixes.set(self.bot, ctx.guild, [])
+        await ctx.send("Prefixes reset")
+
+    @commands.group(name="cluster")
+    async def cluster_group(self, ctx):
+        """Commands spanning every cluster process"""
+        if ctx.invoked_subcommand is None:
+            await ctx.send_help(ctx.command)
+            return
+
+    @cluster_group.command(name="stats")
+    async def cluster_stats(self, ctx):
+        """Shows guild and shard counts of every cluster"""
+        if not self.bot.cluster:
+            results = {"0": await self.bot.cluster_stats()}
+        else:
+            results = await self.bot.cluster.request("stats")
+        lines = []
+        totals = {"guilds": 0, "users": 0, "shards": 0}
+        for cluster_id, stats in sorted(results.items()):
+            if not stats:
+                lines.append("Cluster {}: no response".format(cluster_id))
+                continue
+            for key in totals:
+                totals[key] += stats[key]
+            lines.append("Cluster {}: {guilds} guilds, {shards} shards, "
+                         "{latency:.3f}s latency".format(cluster_id, **stats))
+        lines.append("Total: {guilds} guilds, {users} users, "
+                     "{shards} shards".format(**totals))
+        await ctx.send("```\n{}\n```".format("\n".join(lines)[:1900]))
+
+    @cluster_group.command(name="reload")
+    async def cluster_reload(self, ctx, *, name: str):
+        """Reloads an extension on every cluster"""
+        if not self.bot.cluster:
+            return await ctx.send("Not running in cluster mode, use reload")
+        extension = "cogs." + name.strip()
+        results = await self.bot.cluster.request("reload_extension",
+                                                 timeout=30,
+                                                 name=extension)
+        output = "\n".join("Cluster {}: {}".format(cluster_id, result)
+                           for cluster_id, result in sorted(results.items()))
+        await ctx.send("```\n{}\n```".format(output[:1900]))
+
+    @commands.command()
+    async def metrics(self, ctx, prefix: str = ""):
+        """Shows collected metrics, optionally filtered by name prefix"""
+        output = self.bot.metrics.format(prefix)
+        if not output:
+            return await ctx.send("No metrics recorded")
+        await ctx.send("```\n{}\n```".format(output[:1900]))
+
+    @commands.command()
+    async def startup(self, ctx):
+        """Shows how long startup and each extension took"""
+        await ctx.send("```\n{}\n```".format(
+            self.bot.startup.format()[:1900]))
+
+    @commands.command()
+    async def tasks(self, ctx, owner: str = None):
+        """Shows live background tasks per owner, or those of one owner"""
+        if owner is None:
+            counts = self.bot.tasks.counts()
+            if not counts:
+                return await ctx.send("No background tasks running")
+            output = "\n".join("{:<24}{:>6}".format(name, count)
+                               for name, count in counts.most_common())
+        else:
+            entries = self.bot.tasks.owned_by(owner)
+            if not entries:
+                return await ctx.send("{} has no running tasks".format(owner))
+            now = time.monotonic()
+            output = "\n".join(
+                "{:<40}{:>8.0f}s{:>4} restarts".format(
+                    entry.name[:39], now - entry.started, entry.restarts)
+                for entry in sorted(entries, key=lambda e: e.name))
+        await ctx.send("```\n{}\n```".format(output[:1900]))
+
+    @commands.command()
+    async def rest(self, ctx, sort: str = "requests"):
+        """Shows REST requests, rate limits and bucket budget per route
+
+        Sort by requests, errors, ratelimited, exhausted or retry_after"""
+        if sort not in ("requests", "errors", "ratelimited", "exhausted",
+                        "retry_after"):
+            return await ctx.send_help(ctx.command)
+        report = self.bot.rest.report(sort)
+        if not report:
+            return await ctx.send("No REST requests made yet")
+        lines = [
+            "{:<44}{:>7}{:>5}{:>8}{:>8}{:>8}".format("route", "reqs", "429",
+                                                     "drained", "p90 ms",
+                                                     "budget")
+        ]
+        for key, stats, p90 in report:
+            budget = "-"
+            if stats.limit is not None:
+                budget = "{}/{}".format(stats.remaining, stats.limit)
+            lines.append("{:<44}{:>7}{:>5}{:>8}{:>8.0f}{:>8}".format(
+                key[:43], stats.requests, stats.ratelimited, stats.exhausted,
+                p90 * 1000, budget))
+        lines.append("global 429s: {}".format(
+            self.bot.rest.global_ratelimited))
+        await ctx.send("```\n{}\n```".format("\n".join(lines)[:1900]))
+
+    @commands.command()
+    async def stalls(self, ctx, index: int = 0):
+        """Shows the stack sampled during a recent event loop stall
+
+        0 is the most recent one"""
+        stalls = self.bot.watchdog.stalls
+        if not stalls:
+            return await ctx.send("No stalls recorded")
+        try:
+            stall = stalls[-1 - index]
+        except IndexError:
+            return await ctx.send("Only {} stalls recorded".format(
+                len(stalls)))
+        header = "Blocked for {:.3f}s at {:%Y-%m-%d %H:%M:%S} UTC".format(
+            stall["blocked"], stall["time"])
+        await ctx.send("{}\n```py\n{}\n```".format(header,
+                                                   stall["stack"][-1800:]))
+
+    @commands.command()
+    async def profile(self, ctx, seconds: int = 10):
+        """Profiles the running bot for a number of seconds
+
+        Posts the hottest functions and a collapsed stack file that can be
+        turned into a flamegraph"""
+        if self.profiling:
+            return await ctx.send("A profile is already being recorded")
+        seconds = max(min(seconds, 120), 1)
+        self.profiling = True
+        await ctx.send("Profiling for {} seconds...".format(seconds))
+        try:
+            profiler = SamplingProfiler(self.bot.loop)
+            result = await self.bot.loop.run_in_executor(
+                None, profiler.run, seconds)
+        finally:
+            self.profiling = False
+        filename = "profile-{:%Y%m%d-%H%M%S}.folded".format(
+            datetime.datetime.utcnow())
+        file = discord.File(io.BytesIO(result.collapsed().encode("utf-8")),
+                            filename=filename)
+        await ctx.send("```\n{}\n```".format(result.summary()[:1900]),
+                       file=file)
+
+    @commands.group(name="memory")
+    async def memory_group(self, ctx):
+        """Memory diagnostics"""
+        if ctx.invoked_subcommand is None:
+            await ctx.send_help(ctx.command)
+            return
+
+    @memory_group.command(name="census")
+    async def memory_census(self, ctx, limit: int = 25):
+        """Counts live objects by type"""
+        census = await self.bot.loop.run_in_executor(None,
+                                                     memory.object_census,
+                                                     limit)
+        output = "\n".join("{:>9} {}".format(count, name)
+                           for name, count in census)
+        await ctx.send("```\n{}\n```".format(output[:1900]))
+
+    @memory_group.command(name="caches")
+    async def memory_caches(self, ctx):
+        """Shows the size of the bot's and cogs' caches"""
+        sizes = memory.cache_sizes(self.bot)
+        output = "\n".join("{}: {}".format(name, size)
+                           for name, size in sizes.items())
+        await ctx.send("```\n{}\n```".format(output[:1900]))
+
+    @memory_group.command(name="trace")
+    async def memory_trace(self, ctx, on_off: bool, frames: int = 1):
+        """Starts or stops tracemalloc
+
+        Starting it also takes the baseline snapshot for diffs"""
+        if not on_off:
+            self.snapshots.stop()
+            return await ctx.send("Stopped tracing allocations")
+        self.snapshots.start(frames)
+        await self.bot.loop.run_in_executor(None, self.snapshots.mark)
+        await ctx.send("Tracing allocations. Use `memory diff` to see what "
+                       "grew since now")
+
+    @memory_group.command(name="diff")
+    async def memory_diff(self, ctx, group_by: str = "lineno",
+                          limit: int = 15):
+        """Shows the allocation sites that grew since the last snapshot
+
+        group_by can be lineno, filename or traceback"""
+        if not self.snapshots.tracing or not self.snapshots.baseline:
+            return await ctx.send("Start tracing first with `memory trace on`")
+        if group_by not in ("lineno", "filename", "traceback"):
+            return await ctx.send_help(ctx.command)
+        stats = await self.bot.loop.run_in_executor(None, self.snapshots.diff,
+                                                    group_by, limit)
+        output = "\n".join(memory.format_stat(stat) for stat in stats)
+        await ctx.send("```\n{}\n```".format(output[:1900] or "No change"))
+
     @commands.group()
     async def presence(self, ctx):
         """Commands for presence management"""
         if ctx.invoked_subcommand is None:
-            await self.bot.send_cmd_help(ctx)
+            await ctx.send_help(ctx.command)
             return
 
     @presence.group()
@@ -111,7 +435,7 @@ class Owner(commands.Cog):
         """Commands for presence manager"""
         if ctx.invoked_subcommand is None or isinstance(
                 ctx.invoked_subcommand, commands.Group):
-            await self.bot.send_cmd_help(ctx)
+            await ctx.send_help(ctx.command)
             return
 
     @manager.command(name="interval")
@@ -125,18 +449,12 @@ class Owner(commands.Cog):
         between them
         """
         if not maximum:
-            await self.bot.database.set_cog_config(
-                self, {
-                    "presence.interval": interval,
-                    "presence.interval_range": None
-                })
+            await self.set_presence_settings(interval=interval,
+                                             interval_range=None)
             return await ctx.send("Interval set to {} seconds".format(
                 str(interval)))
-        await self.bot.database.set_cog_config(
-            self, {
-                "presence.interval": None,
-                "presence.interval_range": [interval, maximum]
-            })
+        await self.set_presence_settings(interval=None,
+                                         interval_range=[interval, maximum])
         await ctx.send("Interval set to range between {} and {}".format(
             interval, maximum))
 
@@ -144,26 +462,23 @@ class Owner(commands.Cog):
     async def presence_mgr_games(self, ctx, *games):
         """A list of games which will be rotated at interval.
         Separated by spaces, enclosed in double quotes"""
-        await self.bot.database.set_cog_config(self,
-                                               {"presence.games": list(games)})
+        await self.set_presence_settings(games=list(games))
         await ctx.send("Games set")
 
     @manager.command(name="toggle")
     async def presence_mgr_toggle(self, ctx, on_off: bool):
         """Enable or disable presence manager"""
-        await self.bot.database.set_cog_config(self,
-                                               {"presence.enabled": on_off})
-        await ctx.send("Enabled")
+        await self.set_presence_settings(enabled=on_off)
+        await ctx.send("Enabled" if on_off else "Disabled")
 
     @manager.command(name="status")
     async def presence_mgr_status(self, ctx, status):
         """Sets status for presence manager"""
         status = status.lower()
         if status not in STATUSES:
-            await self.bot.send_cmd_help(ctx)
+            await ctx.send_help(ctx.command)
             return
-        await self.bot.database.set_cog_config(self,
-                                               {"presence.status": status})
+        await self.set_presence_settings(status=status)
         await ctx.send("Status changed")
 
     @manager.command(name="type")
@@ -174,16 +489,14 @@ class Owner(commands.Cog):
         """
         activity_type = activity_type.lower()
         if activity_type not in ACTIVITY_TYPES:
-            return await self.bot.send_cmd_help(ctx)
-        await self.bot.database.set_cog_config(
-            self, {"presence.type": activity_type})
+            return await ctx.send_help(ctx.command)
+        await self.set_presence_settings(type=activity_type)
         await ctx.send("Activity type changed")
 
     @manager.command(name="randomize")
     async def presence_mgr_randomize(self, ctx, yes_no: bool):
         """Sets whether to randomize status"""
-        await self.bot.database.set_cog_config(self,
-                                               {"presence.randomize": yes_no})
+        await self.set_presence_settings(randomize=yes_no)
         await ctx.send("Toggled randomization")
 
     @presence.command()
@@ -208,12 +521,12 @@ class Owner(commands.Cog):
                 streamer = "https://www.twitch.tv/{}".format(args[0])
                 game = discord.Game(type=1, url=streamer, name=args[1])
             except IndexError:
-                return await self.bot.send_cmd_help(ctx)
+                return await ctx.send_help(ctx.command)
         else:
             try:
                 game = discord.Game(name=args[0])
             except IndexError:
-                return await self.bot.send_cmd_help(ctx)
+                return await ctx.send_help(ctx.command)
         await self.bot.change_presence(activity=game,
                                        status=current_presence["status"])
         await ctx.send("Done.")
@@ -224,7 +537,7 @@ class Owner(commands.Cog):
         status = status.lower()
         current_presence = self.get_current_presence(ctx)
         if status not in STATUSES:
-            await self.bot.send_cmd_help(ctx)
+            await ctx.send_help(ctx.command)
             return
         await self.bot.change_presence(status=STATUSES[status],
                                        activity=current_presence["game"])
@@ -245,68 +558,30 @@ class Owner(commands.Cog):
         guild = ctx.guild
         if guild is None:
             return {"game": None, "status": None}
-        return {"game": guild.me.activity, "status": guild.me.status}
+        status = guild.me.status
+        if not self.bot.intents.presences and status is discord.Status.offline:
+            # Without the presences intent the bot only sees the presence it
+            # set itself since connecting
+            status = discord.Status.online
+        return {"game": guild.me.activity, "status": status}
+
+    async def set_presence_settings(self, **settings):
+        await self.bot.database.set_cog_config(
+            self, {"presence." + k: v
+                   for k, v in settings.items()})
+        self.presence.update(**settings)
 
     async def presence_manager(self):
-        while self is self.bot.get_cog("Global"):
-            try:
-                doc = await self.bot.database.get_cog_config(self)
-                if not doc:
-                    await asyncio.sleep(10)
-                    continue
-                settings = doc["presence"]
-                if settings["enabled"]:
-                    games = settings.get("games", [])
-                    status = STATUSES[settings["status"]]
-                    activity_type = ACTIVITY_TYPES[settings["type"]]
-                    randomize = settings.get("randomize", False)
-                    interval = settings.get("interval")
-                    if not interval:
-                        interval_range = settings.get("interval_range")
-                        if interval_range:
-                            interval = random.randrange(*interval_range)
-                    if not interval and not interval_range:
-                        await asyncio.sleep(10)
-                        continue
-                    if self.bot.available:
-                        if not games:
-                            game = None
-                        elif randomize:
-                            game = random.choice(games)
-                        else:
-                            try:
-                                game = games[
-                                    self.presence_manager_current_index]
-                                self.presence_manager_current_index += 1
-                            except IndexError:
-                                self.presence_manager_current_index = 0
-                                game = games[0]
-                        activity = discord.Activity(
-                            name=game.format(bot=self.bot), type=activity_type)
-                        await self.bot.change_presence(activity=activity,
-                                                       status=status)
-                    await asyncio.sleep(interval)
-            except Exception as e:
-                log.exception(e)
-                await asyncio.sleep(300)
-                continue
+        await self.bot.database.setup_cog(self,
+                                          {"presence": PRESENCE_DEFAULTS})
+        doc = await self.bot.database.get_cog_config(self)
+        self.presence.update(**doc["presence"])
+        await self.presence.run()
 
 
 async def setup(bot):
     cog = Owner(bot)
-    loop = bot.loop
-    loop.create_task(
-        bot.database.setup_cog(
-            cog, {
-                "presence": {
-                    "interval": 180,
-                    "interval_range": [],
-                    "status": "online",
-                    "type": "playing",
-                    "enabled": False,
-                    "randomize": False,
-                    "games": []
-                }
-            }))
-    loop.create_task(cog.presence_manager())
     await bot.add_cog(cog)
+    bot.tasks.spawn(name="owner:presence",
+                    owner=cog.qualified_name,
+                    factory=cog.presence_manager)
@@ -1,14 +1,22 @@
+import asyncio
+import collections
 import datetime
 import logging
 import re
+import time
 import discord
 from discord import app_commands
 from discord.ext import commands
 from enum import Enum
+from toothy.deferral import GuardedView
 
 log = logging.getLogger(__name__)
 
 
+RECONCILE_WORKERS = 4
+RECONCILE_LOG_INTERVAL = 30
+
+
 class Mode(Enum):
     single = 1
     multiple = 2
@@ -28,6 +36,10 @@ MODE_CHOICES = [
 ]
 
 
+MenuRender = collections.namedtuple("MenuRender",
+                                    "roles options view embed")
+
+
 class RoleSelectError(Exception):
     pass
 
@@ -73,21 +85,20 @@ class RoleMenuDropdown(discord.ui.Select):
         if not interaction.guild.me.guild_permissions.manage_roles:
             await interaction.response.send_message(
                 "I don't have the `Manage Roles` permission.", ephemeral=True)
-        values = [int(value) for value in self.values]
-        roles = [
-            role_info["role"] for role_info in menu.roles
-            if role_info["role"].id in values
-        ]
+        render = menu.render
+        user = interaction.user
+        top_role = interaction.guild.me.top_role
+        values = {int(value) for value in self.values}
         roles = [
-            role for role in roles if role < interaction.guild.me.top_role
+            role for role in render.roles
+            if role.id in values and role < top_role
         ]
         roles_to_add = []
         roles_to_remove = []
         # await interaction.response.defer(ephemeral=True)
-        print(menu.mode)
         if menu.mode == Mode.multiple:
             for role in roles:
-                if role in interaction.user.roles:
+                if user.get_role(role.id):
                     pass
                     # roles_to_remove.append(role)
                 else:
@@ -97,14 +108,13 @@ class RoleMenuDropdown(discord.ui.Select):
                 await interaction.response.send_message(
                     "You need to select a role", ephemeral=True)
             role = roles[0]
-            if role in interaction.user.roles:
+            if user.get_role(role.id):
                 return await interaction.response.send_message(
                     "You already have this role", ephemeral=True)
             roles_to_add.append(role)
             roles_to_remove = [
-                role_doc["role"] for role_doc in menu.roles
-                if role_doc["role"] in interaction.user.roles
-                and role_doc["role"] != role
+                other for other in render.roles
+                if other != role and user.get_role(other.id)
             ]
         if not roles_to_add and not roles_to_remove:
             return await interaction.response.send_message(
@@ -138,15 +148,12 @@ class RoleMenuSelectRolesForRemovalDropdown(discord.ui.Select):
                          max_values=len(options))
 
     async def callback(self, interaction: discord.Interaction):
-        options = [int(value) for value in self.values]
+        options = {int(value) for value in self.values}
+        top_role = interaction.guild.me.top_role
         roles = [
-            role["role"] for role in self.menu.roles
-            if role["role"].id in options
-        ]
-        roles = [
-            role for role in roles
-            if role.position < interaction.guild.me.top_role.position
-            and role in interaction.user.roles
+            role for role in self.menu.render.roles
+            if role.id in options and role.position < top_role.position
+            and interaction.user.get_role(role.id)
         ]
         if not interaction.guild.me.guild_permissions.manage_roles:
             return await interaction.response.edit_message(
@@ -165,7 +172,7 @@ class RoleMenuSelectRolesForRemovalDropdown(discord.ui.Select):
                                                 view=None)
 
 
-class RoleMenuSelectRolesForRemovalView(discord.ui.View):
+class RoleMenuSelectRolesForRemovalView(GuardedView):
 
     def __init__(self, user, menu, options):
         super().__init__(timeout=180)
@@ -182,7 +189,7 @@ class RoleMenuSelectRolesForRemovalView(discord.ui.View):
         return interaction.user == self.user
 
 
-class RoleMenuView(discord.ui.View):
+class RoleMenuView(GuardedView):
 
     def __init__(self, cog, items=[]):
         super().__init__(timeout=None)
@@ -194,24 +201,25 @@ class RoleMenuView(discord.ui.View):
             self.add_item(RoleMenuDropdown())
 
     @classmethod
-    def from_menu(cls, menu):
-        options = []
-        for role_doc in menu.roles:
-            role = role_doc["role"]
-            options.append(
-                discord.SelectOption(label="@" + role.name,
-                                     value=role.id,
-                                     emoji=role_doc["emoji"],
-                                     description=role_doc["description"]))
+    def from_menu(cls, menu, options):
         min_values = 1
-        max_values = len(menu.roles) if menu.mode == Mode.multiple else 1
-        return cls(cog=menu.cog,
+        max_values = len(options) if menu.mode == Mode.multiple else 1
+        view = cls(cog=menu.cog,
                    items=[
-                       RoleMenuDropdown(options,
+                       RoleMenuDropdown(list(options),
                                         placeholder=menu.placeholder,
                                         min_values=min_values,
                                         max_values=max_values)
                    ])
+        if menu.mode == Mode.single or menu.mode == Mode.single_removable:
+            for item in view.children:
+                if isinstance(item, discord.ui.Button):
+                    if (item.label == "Clear all roles"
+                            and menu.mode == Mode.single_removable):
+                        item.label = "Remove role"
+                        continue
+                    view.remove_item(item)
+        return view
 
     async def change_roles(self, interaction, to_add, to_remove):
         pass
@@ -230,9 +238,10 @@ class RoleMenuView(discord.ui.View):
             return await interaction.response.send_message(
                 "I don't have permission to manage roles.", ephemeral=True)
         highest_role = interaction.guild.me.top_role
-        to_remove = list(role_doc["role"] for role_doc in menu.roles
-                         if role_doc["role"] in interaction.user.roles
-                         and role_doc["role"] < highest_role)
+        to_remove = [
+            role for role in menu.render.roles
+            if role < highest_role and interaction.user.get_role(role.id)
+        ]
         if not to_remove:
             return await interaction.response.send_message(
                 "You don't have any roles to remove.", ephemeral=True)
@@ -264,16 +273,13 @@ class RoleMenuView(discord.ui.View):
         if not interaction.guild.me.guild_permissions.manage_roles:
             return await interaction.response.send_message(
                 "I don't have permission to manage roles.", ephemeral=True)
+        render = menu.render
         options = []
         current = []
-        for role in menu.roles:
-            if role["role"] in interaction.user.roles:
-                current.append(role["role"].mention)
-                options.append(
-                    discord.SelectOption(label="@" + role["role"].name,
-                                         value=str(role["role"].id),
-                                         emoji=role["emoji"],
-                                         description=role["description"]))
+        for role, option in zip(render.roles, render.options):
+            if interaction.user.get_role(role.id):
+                current.append(role.mention)
+                options.append(option)
         if not options:
             return await interaction.response.send_message(
                 "You don't have any roles to remove.", ephemeral=True)
@@ -301,21 +307,58 @@ class Menu():
         self.roles = []
         self.placeholder = doc["placeholder"]
         self.description = doc["description"]
-
-        for role_doc in doc["roles"]:
-            role = guild.get_role(role_doc["id"])
+        self.role_docs = doc["roles"]
+        self._render = None
+        self.resolve()
+
+    def resolve(self):
+        """Resolves the menu's roles and emojis, dropping its render"""
+        roles = []
+        for role_doc in self.role_docs:
+            role = self.guild.get_role(role_doc["id"])
             if not role:
                 continue
             emoji = role_doc["emoji"]
             if emoji:
                 if isinstance(emoji, int):
-                    emoji = cog.bot.get_emoji(emoji)
-            self.roles.append({
+                    emoji = self.cog.bot.get_emoji(emoji)
+            roles.append({
                 "role": role,
                 "emoji": emoji,
                 "description": role_doc["description"]
             })
-        self.roles = sorted(self.roles, key=lambda x: x["role"].name)
+        self.roles = sorted(roles, key=lambda x: x["role"].name)
+        self._render = None
+
+    def uses_role(self, role_id):
+        return any(role_doc["id"] == role_id for role_doc in self.role_docs)
+
+    def uses_emojis(self, emoji_ids):
+        return any(role_doc["emoji"] in emoji_ids
+                   for role_doc in self.role_docs)
+
+    @property
+    def render(self):
+        """The menu's MenuRender, compiled on first use"""
+        if self._render is None:
+            self._render = self.compile()
+        return self._render
+
+    def compile(self):
+        roles = tuple(role_doc["role"] for role_doc in self.roles)
+        options = tuple(
+            discord.SelectOption(label="@" + role_doc["role"].name,
+                                 value=str(role_doc["role"].id),
+                                 emoji=role_doc["emoji"],
+                                 description=role_doc["description"])
+            for role_doc in self.roles)
+        embed = discord.Embed(title=self.name,
+                              description=self.description,
+                              color=self.color)
+        return MenuRender(roles=roles,
+                          options=options,
+                          view=RoleMenuView.from_menu(self, options),
+                          embed=embed)
 
     async def update(self):
         if not self.channel:
@@ -329,33 +372,79 @@ class Menu():
                     pass
                 finally:
                     return
+        render = self.render
         message = None
         if self.message_id:
             try:
                 message = await self.channel.fetch_message(self.message_id)
             except discord.HTTPException:
                 pass
-        view = RoleMenuView.from_menu(self)
-        if self.mode == Mode.single or self.mode == Mode.single_removable:
-            for item in view.children:
-                if isinstance(item, discord.ui.Button):
-                    if (item.label == "Clear all roles"
-                            and self.mode == Mode.single_removable):
-                        item.label = "Remove role"
-                        continue
-                    view.remove_item(item)
-        embed = discord.Embed(title=self.name,
-                              description=self.description,
-                              color=self.color)
         if not message:
-            message = await self.channel.send(embed=embed, view=view)
+            message = await self.channel.send(embed=render.embed,
+                                              view=render.view)
             self.message_id = message.id
             await self.cog.db.update_one(
                 {"_id": self.id}, {"$set": {
                     "message_id": self.message_id
                 }})
         else:
-            await message.edit(embed=embed, view=view)
+            await message.edit(embed=render.embed, view=render.view)
+
+
+class MenuIndex:
+    """Prebuilt menus keyed by menu id and message id.
+
+    Menus are loaded a guild at a time, so once a guild is loaded a
+    message that isn't indexed is known not to be a menu. A guild's
+    interactions and commands are handled by the process owning its
+    shard, so the index only has to follow this process's own edits."""
+
+    def __init__(self):
+        self.by_id = {}
+        self.by_message = {}
+        # The message id each menu was indexed under, which update() may
+        # have changed since
+        self.indexed_message = {}
+        self.loaded = set()
+
+    def __len__(self):
+        return len(self.by_id)
+
+    def add(self, menu):
+        self.remove(menu.id)
+        self.by_id[menu.id] = menu
+        if menu.message_id:
+            self.by_message[menu.message_id] = menu
+            self.indexed_message[menu.id] = menu.message_id
+
+    def remove(self, menu_id):
+        menu = self.by_id.pop(menu_id, None)
+        message_id = self.indexed_message.pop(menu_id, None)
+        if menu and self.by_message.get(message_id) is menu:
+            del self.by_message[message_id]
+        return menu
+
+    def reindex(self, menu):
+        """Follows a change of an indexed menu's message id, as updating
+        reposts deleted messages. Menus removed meanwhile stay removed"""
+        if self.by_id.get(menu.id) is menu:
+            self.add(menu)
+
+    def get(self, menu_id):
+        return self.by_id.get(menu_id)
+
+    def get_by_message(self, message_id):
+        return self.by_message.get(message_id)
+
+    def guild_menus(self, guild_id):
+        return [
+            menu for menu in self.by_id.values() if menu.guild.id == guild_id
+        ]
+
+    def drop_guild(self, guild_id):
+        self.loaded.discard(guild_id)
+        for menu in self.guild_menus(guild_id):
+            self.remove(menu.id)
 
 
 class RoleMenu(commands.Cog):
@@ -370,6 +459,14 @@ class RoleMenu(commands.Cog):
         self.bot: commands.AutoShardedBot = bot
         self.listening_to = {}
         self.db = bot.database.db.rolemenus
+        self.menus = MenuIndex()
+        self.reconcile_queue = asyncio.Queue()
+        self.reconcile_pending = set()
+        self.reconciled = set()
+        self.reconcile_stats = collections.Counter()
+        self.menu_guilds = None
+        self._menu_guilds_lock = asyncio.Lock()
+        self._reconcile_logged = 0
 
     async def rolemenu_name_autocomplete(self,
                                          interaction: discord.Interaction,
@@ -403,25 +500,148 @@ class RoleMenu(commands.Cog):
                                         value=str(role["role"].id)))
         return options
 
-    async def update_all_menus(self):
-        cursor = self.db.find({"guild_id": {"$exists": True}})
-        async for doc in cursor:
-            try:
-                menu = Menu(self, self.bot.get_guild(doc["guild_id"]), doc)
-                await menu.update()
-            except Exception:
-                pass
-
     async def cog_load(self) -> None:
-        await self.update_all_menus()
+        state = self.bot.pop_cog_state(self)
+        if state:
+            self.listening_to = state["listening_to"]
         self.bot.add_view(RoleMenuView(self))
+        for index in range(RECONCILE_WORKERS):
+            self.bot.tasks.spawn(name="rolemenu:reconciler:{}".format(index),
+                                 owner=self.qualified_name,
+                                 factory=self.reconcile_worker)
+        # Only set when the extension is loaded after the bot connected
+        for guild in self.bot.guilds:
+            self.queue_reconcile(guild)
+
+    def queue_reconcile(self, guild, *, force=False):
+        """Queues re-rendering a guild's menus, once per guild unless
+        forced. Only guilds of this process's shards are ever seen"""
+        if guild.id in self.reconcile_pending:
+            return
+        if guild.id in self.reconciled and not force:
+            return
+        if (self.menu_guilds is not None
+                and guild.id not in self.menu_guilds):
+            return
+        self.reconcile_pending.add(guild.id)
+        self.reconcile_queue.put_nowait(guild.id)
+        self.bot.metrics.gauge("rolemenu.reconcile.pending",
+                               len(self.reconcile_pending))
+
+    async def reconcile_worker(self):
+        while True:
+            guild_id = await self.reconcile_queue.get()
+            try:
+                await self.reconcile_guild(guild_id)
+            except Exception as e:
+                self.reconcile_stats["guild_failures"] += 1
+                log.exception(
+                    "Failed to reconcile role menus of {}".format(guild_id),
+                    exc_info=e)
+            finally:
+                self.reconcile_pending.discard(guild_id)
+                self.reconcile_queue.task_done()
+                self.bot.metrics.gauge("rolemenu.reconcile.pending",
+                                       len(self.reconcile_pending))
+                self.log_reconcile_progress()
+
+    async def reconcile_guild(self, guild_id):
+        """Loads a guild's menus into the index and re-renders them"""
+        async with self._menu_guilds_lock:
+            if self.menu_guilds is None:
+                # One query tells which guilds have menus at all
+                self.menu_guilds = set(await self.db.distinct("guild_id"))
+        if guild_id not in self.menu_guilds:
+            return
+        guild = self.bot.get_guild(guild_id)
+        if guild is None or guild.unavailable:
+            return
+        await self.load_guild_menus(guild)
+        self.reconciled.add(guild_id)
+        self.reconcile_stats["guilds"] += 1
+        for menu in self.menus.guild_menus(guild_id):
+            try:
+                await menu.update()
+            except NoChannelError:
+                self.reconcile_stats["no_channel"] += 1
+            except discord.HTTPException as e:
+                self.reconcile_stats["failures"] += 1
+                self.bot.metrics.incr("rolemenu.reconcile.failed")
+                log.debug("Failed to update role menu {}: {}".format(
+                    menu.id, e))
+            else:
+                self.reconcile_stats["menus"] += 1
+                self.bot.metrics.incr("rolemenu.reconcile.menus")
+            finally:
+                self.menus.reindex(menu)
+            # Leave REST budget to interactions under load
+            delay = self.bot.governor.pick(0, 0.5, 2)
+            if delay:
+                await asyncio.sleep(delay)
+
+    def log_reconcile_progress(self):
+        now = time.monotonic()
+        if (self.reconcile_pending
+                and now - self._reconcile_logged < RECONCILE_LOG_INTERVAL):
+            return
+        self._reconcile_logged = now
+        stats = self.reconcile_stats
+        log.info("Role menus reconciled: {} menus in {} guilds, {} failed, "
+                 "{} without a channel, {} guilds failed, {} pending".format(
+                     stats["menus"], stats["guilds"], stats["failures"],
+                     stats["no_channel"], stats["guild_failures"],
+                     len(self.reconcile_pending)))
 
     async def cog_unload(self) -> None:
         pass
 
+    def memory_usage(self):
+        return {
+            "listening_to": len(self.listening_to),
+            "menus": len(self.menus),
+            "loaded_guilds": len(self.menus.loaded),
+            "reconcile_pending": len(self.reconcile_pending),
+            "reconciled": len(self.reconciled)
+        }
+
+    def export_state(self):
+        return {"listening_to": self.listening_to}
+
+    async def load_guild_menus(self, guild):
+        cursor = self.db.find({"guild_id": guild.id})
+        async for doc in cursor:
+            self.menus.add(Menu(self, guild, doc))
+        self.menus.loaded.add(guild.id)
+
     async def get_menu_by_message(self, message):
-        doc = await self.db.find_one({"message_id": message.id})
-        return Menu(self, message.guild, doc) if doc else None
+        guild = message.guild
+        if guild.id not in self.menus.loaded:
+            # Concurrent clicks in the same guild share one load
+            name = "rolemenu:load:{}".format(guild.id)
+            task = self.bot.tasks.get(name)
+            if task is None:
+                task = self.bot.tasks.spawn(self.load_guild_menus(guild),
+                                            name=name,
+                                            owner=self.qualified_name)
+            await asyncio.shield(task)
+            if guild.id not in self.menus.loaded:
+                doc = await self.db.find_one({"message_id": message.id})
+                return Menu(self, guild, doc) if doc else None
+        return self.menus.get_by_message(message.id)
+
+    async def save_menu(self, menu_id, guild):
+        """Rebuilds a menu from the database after an edit, renders it and
+        indexes it"""
+        doc = await self.db.find_one({"_id": menu_id})
+        if not doc:
+            self.menus.remove(menu_id)
+            return None
+        menu = Menu(self, guild, doc)
+        try:
+            await menu.update()
+        finally:
+            self.menus.add(menu)
+        return menu
 
     @app_commands.checks.has_permissions(manage_roles=True, manage_guild=True)
     @app_commands.default_permissions(manage_roles=True, manage_guild=True)
@@ -461,7 +681,7 @@ class RoleMenu(commands.Cog):
             color = discord.Color.from_str(color)
         except ValueError:
             return await interaction.response.send_message("Invalid color.")
-        await self.db.insert_one({
+        doc = {
             "message_id": None,
             "name": name,
             "mode": mode,
@@ -471,7 +691,12 @@ class RoleMenu(commands.Cog):
             "color": color.value,
             "placeholder": placeholder,
             "description": description
-        })
+        }
+        result = await self.db.insert_one(doc)
+        doc["_id"] = result.inserted_id
+        self.menus.add(Menu(self, interaction.guild, doc))
+        if self.menu_guilds is not None:
+            self.menu_guilds.add(interaction.guild.id)
         await interaction.response.send_message(
             "Role menu created. It is currently empty, however, and "
             "you'll need to add roles with `/rolemenu role add.`",
@@ -531,10 +756,8 @@ class RoleMenu(commands.Cog):
             modifications["description"] = description
         await interaction.response.defer(ephemeral=True)
         await self.db.update_one({"_id": doc["_id"]}, {"$set": modifications})
-        doc = await self.db.find_one({"_id": doc["_id"]})
         await interaction.followup.send("added thing")
-        menu = Menu(self, interaction.guild, doc)
-        await menu.update()
+        await self.save_menu(doc["_id"], interaction.guild)
         await interaction.followup.send("Role menu updated.", ephemeral=True)
 
     @app_commands.checks.has_permissions(manage_roles=True, manage_guild=True)
@@ -554,6 +777,7 @@ class RoleMenu(commands.Cog):
                 "Role menu with that name does not exist.", ephemeral=True)
         await interaction.response.defer(ephemeral=True)
         await self.db.delete_one({"_id": doc["_id"]})
+        self.menus.remove(doc["_id"])
         await interaction.followup.send("Role menu removed.", ephemeral=True)
 
     role_manipulation_group = app_commands.Group(
@@ -620,10 +844,8 @@ class RoleMenu(commands.Cog):
                 }
             }
         })
-        doc = await self.db.find_one({"_id": doc["_id"]})
         await interaction.followup.send(f"Added {role.mention} to the menu.")
-        menu = Menu(self, interaction.guild, doc)
-        await menu.update()
+        await self.save_menu(doc["_id"], interaction.guild)
 
     @app_commands.checks.has_permissions(manage_roles=True, manage_guild=True)
     @app_commands.checks.bot_has_permissions(manage_roles=True,
@@ -663,21 +885,72 @@ class RoleMenu(commands.Cog):
                                  {"$pull": {
                                      "roles": role_doc
                                  }})
-        doc = await self.db.find_one({"_id": doc["_id"]})
         await interaction.followup.send("Role removed from the menu.")
-        menu = Menu(self, interaction.guild, doc)
-        await menu.update()
-
-    @commands.Cog.listener()
-    async def on_guild_role_update(self, before, after):
-        guild = after.guild
-        if before.name == after.name:
+        await self.save_menu(doc["_id"], interaction.guild)
+
+    async def refresh_menus_with_role(self, role, *, delay=0):
+        await asyncio.sleep(delay)
+        guild = role.guild
+        if guild.id in self.menus.loaded:
+            for menu in self.menus.guild_menus(guild.id):
+                if menu.uses_role(role.id):
+                    menu.resolve()
+                    try:
+                        await menu.update()
+                    finally:
+                        self.menus.reindex(menu)
             return
         # Find all role menus that have the role
-        cursor = self.db.find({"guild_id": guild.id, "roles.id": after.id})
+        cursor = self.db.find({"guild_id": guild.id, "roles.id": role.id})
         async for doc in cursor:
             menu = Menu(self, guild, doc)
             await menu.update()
+            self.menus.add(menu)
+
+    @commands.Cog.listener()
+    async def on_guild_role_update(self, before, after):
+        if before.name == after.name:
+            return
+        delay = self.bot.governor.pick(0, 30, 120)
+        if not delay:
+            return await self.refresh_menus_with_role(after)
+        # Under load renames are coalesced, only the last one is rendered
+        self.bot.tasks.spawn(self.refresh_menus_with_role(after, delay=delay),
+                             name="rolemenu:refresh:{}".format(after.id),
+                             owner=self.qualified_name)
+
+    @commands.Cog.listener()
+    async def on_guild_role_delete(self, role):
+        for menu in self.menus.guild_menus(role.guild.id):
+            if menu.uses_role(role.id):
+                menu.resolve()
+
+    @commands.Cog.listener()
+    async def on_guild_emojis_update(self, guild, before, after):
+        old = {(emoji.id, emoji.name) for emoji in before}
+        new = {(emoji.id, emoji.name) for emoji in after}
+        emoji_ids = {emoji_id for emoji_id, _ in old ^ new}
+        # Menus can use emojis of any guild the bot is in
+        for menu in self.menus.by_id.values():
+            if menu.uses_emojis(emoji_ids):
+                menu.resolve()
+
+    @commands.Cog.listener()
+    async def on_guild_available(self, guild):
+        self.queue_reconcile(guild)
+
+    @commands.Cog.listener()
+    async def on_guild_join(self, guild):
+        self.queue_reconcile(guild, force=True)
+
+    @commands.Cog.listener()
+    async def on_guild_remove(self, guild):
+        self.menus.drop_guild(guild.id)
+        self.reconciled.discard(guild.id)
+
+    @commands.Cog.listener()
+    async def on_guild_unavailable(self, guild):
+        self.menus.drop_guild(guild.id)
 
 
 async def setup(bot):
@@ -1,3 +1,4 @@
+import asyncio
 import collections
 import datetime
 from collections import Counter
@@ -32,6 +33,8 @@ STATS_PIPELINE = [{
         }]
     }
 }]
+# Buffered command records are written once this many have piled up
+MAX_BATCH = 500
 
 
 class Statistics(commands.GroupCog, name="statistics"):
@@ -41,6 +44,7 @@ class Statistics(commands.GroupCog, name="statistics"):
         self.bot = bot
         self.counter = Counter()
         self.db = self.bot.database.db.statistics
+        self.pending = []
 
     @app_commands.checks.cooldown(1, 10, key=lambda i: i.user.id)
     @app_commands.command(name="user")
@@ -61,7 +65,8 @@ class Statistics(commands.GroupCog, name="statistics"):
         data = await self.generate_embed(interaction, data, facets, rank=False)
         await interaction.followup.send(embed=data)
 
-    @app_commands.command(name="server")
+    @app_commands.command(name="server",
+                          extras={"defer_ephemeral": False})
     @app_commands.checks.cooldown(1, 60, key=lambda i: i.guild_id)
     @app_commands.guild_only()
     async def statistics_guild(self, interaction: discord.Interaction):
@@ -78,7 +83,8 @@ class Statistics(commands.GroupCog, name="statistics"):
         await interaction.followup.send(embed=data)
 
     @app_commands.checks.cooldown(1, 3600, key=lambda i: i.user.id)
-    @app_commands.command(name="global")
+    @app_commands.command(name="global",
+                          extras={"defer_ephemeral": False})
     async def statistics_total(self, interaction: discord.Interaction):
         """Total stats of the bot's commands
 
@@ -91,6 +97,34 @@ class Statistics(commands.GroupCog, name="statistics"):
         data = await self.generate_embed(interaction, data, facets, rank=False)
         await interaction.followup.send(embed=data)
 
+    def memory_usage(self):
+        return {"counters": len(self.counter)}
+
+    def export_state(self):
+        return {"counter": self.counter}
+
+    async def cog_load(self):
+        state = self.bot.pop_cog_state(self)
+        if state:
+            self.counter = state["counter"]
+
+    async def cog_unload(self):
+        await self.flush_records()
+
+    async def flush_records(self):
+        """Writes the buffered command records"""
+        records, self.pending = self.pending, []
+        if len(records) == 1:
+            await self.db.commands.insert_one(records[0])
+        elif records:
+            await self.db.commands.insert_many(records, ordered=False)
+
+    async def _delayed_flush(self, delay):
+        # Records buffered during a write are picked up by the next round
+        while self.pending:
+            await asyncio.sleep(delay)
+            await self.flush_records()
+
     async def get_commands_stats(self, cursor, search):
         """Returns ordered dict of commands from cursor
         and search string in DB"""
@@ -116,6 +150,11 @@ class Statistics(commands.GroupCog, name="statistics"):
 
     async def generate_embed(self, ctx, embed, facets, *, rank=True):
         # Get data
+        if not facets["getTop10Commands"]:
+            embed.add_field(name="Total commands used",
+                            value="0",
+                            inline=False)
+            return embed
         total_amount = facets["totalCommandCount"][0]["count"]
         ordered_commands = facets["getTop10Commands"]
         percentages = self.calc_percentage(ordered_commands, total_amount)
@@ -219,7 +258,16 @@ class Statistics(commands.GroupCog, name="statistics"):
             "command": interaction.command.qualified_name,
             "timestamp": interaction.created_at
         }
-        await self.db.commands.insert_one(doc)
+        self.pending.append(doc)
+        # Under load records are buffered and written in one batch later
+        delay = self.bot.governor.pick(0, 5, 20)
+        if delay and len(self.pending) < MAX_BATCH:
+            if not self.bot.tasks.get("statistics:flush"):
+                self.bot.tasks.spawn(self._delayed_flush(delay),
+                                     name="statistics:flush",
+                                     owner="Statistics")
+            return
+        await self.flush_records()
 
 
 async def setup(bot):
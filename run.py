@@ -1,23 +1,37 @@
+import argparse
 import asyncio
 import logging
 import logging.handlers
 import os
+import queue
+from toothy.cluster import ClusterClient
+from toothy.cluster import ClusterSupervisor
+from toothy.logs import JsonFormatter
+from toothy.logs import QueueHandler
+from toothy.logs import RateLimitFilter
 from toothy.toothy import DEBUG
+from toothy.toothy import LOG_SETTINGS
+from toothy.toothy import TOKEN
 from toothy.toothy import Toothy
 
 
-def setup_logging():
-    formatter = logging.Formatter(
-        '%(asctime)s:%(levelname)s:%(name)s: %(message)s')
+def setup_logging(filename="logs/toothy.log"):
+    """Routes all logging through a queue so that file writes and
+    rotation happen on a listener thread instead of the event loop"""
+    if LOG_SETTINGS.get("json", False):
+        formatter = JsonFormatter()
+    else:
+        formatter = logging.Formatter(
+            '%(asctime)s:%(levelname)s:%(name)s: %(message)s')
     logger = logging.getLogger("")
     if DEBUG:
-        logging.basicConfig(level=logging.DEBUG)
+        logger.setLevel(logging.DEBUG)
     else:
         logger.setLevel(logging.INFO)
     logging.getLogger("discord").setLevel(logging.INFO)
     logging.getLogger("discord.http").setLevel(logging.WARNING)
     file_hdlr = logging.handlers.RotatingFileHandler(
-        filename="logs/toothy.log",
+        filename=filename,
         maxBytes=10 * 1024 * 1024,
         encoding="utf-8",
         backupCount=5)
@@ -28,19 +42,71 @@ def setup_logging():
         stderr_hdlr.setLevel(logging.DEBUG)
     else:
         stderr_hdlr.setLevel(logging.ERROR)
-    logger.addHandler(file_hdlr)
-    logger.addHandler(stderr_hdlr)
+    log_queue = queue.SimpleQueue()
+    queue_hdlr = QueueHandler(log_queue)
+    queue_hdlr.addFilter(RateLimitFilter(LOG_SETTINGS.get("limits", {})))
+    logger.addHandler(queue_hdlr)
+    listener = logging.handlers.QueueListener(log_queue,
+                                              file_hdlr,
+                                              stderr_hdlr,
+                                              respect_handler_level=True)
+    listener.start()
+    return listener
 
 
-async def main():
-    bot = Toothy()
+async def main(**kwargs):
+    bot = Toothy(**kwargs)
     print("Logging in to Discord")
     async with bot:
         await bot.start()
 
 
+def run_cluster(cluster_id, shard_ids, shard_count, socket_path):
+    """Entry point of a cluster worker process"""
+    listener = setup_logging("logs/toothy-{}.log".format(cluster_id))
+    cluster = ClusterClient(cluster_id, shard_ids, socket_path)
+    try:
+        asyncio.run(
+            main(shard_ids=shard_ids, shard_count=shard_count,
+                 cluster=cluster))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        listener.stop()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Run Toothy")
+    parser.add_argument(
+        "--clusters",
+        type=int,
+        default=0,
+        help="Run shards in this many worker processes. POSIX only")
+    parser.add_argument("--shards",
+                        type=int,
+                        default=None,
+                        help="Override the recommended shard count")
+    parser.add_argument("--socket",
+                        default="logs/cluster.sock",
+                        help="Unix socket used for cluster IPC")
+    return parser.parse_args()
+
+
 if __name__ == '__main__':
+    args = parse_args()
     if not os.path.exists("logs"):
         os.makedirs("logs")
-    setup_logging()
-    asyncio.run(main())
+    listener = setup_logging()
+    try:
+        if args.clusters:
+            supervisor = ClusterSupervisor(run_cluster,
+                                           TOKEN,
+                                           args.clusters,
+                                           socket_path=args.socket)
+            asyncio.run(supervisor.run(args.shards))
+        else:
+            asyncio.run(main())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        listener.stop()
@@ -0,0 +1,92 @@
+"""Admission scheduler tests. Run from the repository root:
+
+    python -m unittest discover tests"""
+import asyncio
+import unittest
+
+from toothy.admission import AdmissionRejected
+from toothy.admission import AdmissionScheduler
+
+
+class AdmissionSchedulerTest(unittest.IsolatedAsyncioTestCase):
+
+    async def queue(self, admission, key, granted, **kwargs):
+        """Starts a waiter for key that records it in granted once admitted"""
+
+        async def waiter():
+            await admission.acquire(key, **kwargs)
+            granted.append(key)
+
+        task = asyncio.create_task(waiter())
+        # Let the waiter reach the queue
+        await asyncio.sleep(0)
+        return task
+
+    async def test_guild_limit_does_not_block_other_guilds(self):
+        admission = AdmissionScheduler(global_limit=10, guild_limit=2)
+        await admission.acquire("a")
+        await admission.acquire("a")
+        granted = []
+        waiting = await self.queue(admission, "a", granted)
+        self.assertEqual(await admission.acquire("b"), 0.0)
+        self.assertEqual(granted, [])
+        self.assertEqual(admission.queued, 1)
+        admission.release("a")
+        await waiting
+        self.assertEqual(granted, ["a"])
+
+    async def test_guilds_are_served_round_robin(self):
+        admission = AdmissionScheduler(global_limit=1, guild_limit=1)
+        await admission.acquire("a")
+        granted = []
+        tasks = [
+            await self.queue(admission, "a", granted),
+            await self.queue(admission, "a", granted),
+            await self.queue(admission, "b", granted)
+        ]
+        for key in ("a", "a", "b"):
+            admission.release(key)
+            await asyncio.sleep(0)
+        await asyncio.gather(*tasks)
+        # The busy guild queued first, but doesn't get both slots in a row
+        self.assertEqual(granted, ["a", "b", "a"])
+
+    async def test_full_guild_queue_is_rejected(self):
+        admission = AdmissionScheduler(global_limit=1,
+                                       guild_limit=1,
+                                       guild_queue=1)
+        await admission.acquire("a")
+        granted = []
+        waiting = await self.queue(admission, "a", granted)
+        with self.assertRaises(AdmissionRejected):
+            await admission.acquire("a")
+        admission.release("a")
+        await waiting
+        self.assertEqual(granted, ["a"])
+
+    async def test_timed_out_waiter_leaves_the_queue(self):
+        admission = AdmissionScheduler(global_limit=1, guild_limit=1)
+        await admission.acquire("a")
+        with self.assertRaises(asyncio.TimeoutError):
+            await admission.acquire("b", timeout=0.01)
+        self.assertEqual(admission.queued, 0)
+        self.assertNotIn("b", admission.waiting)
+        admission.release("a")
+        # The slot isn't handed to the waiter that gave up
+        self.assertEqual(admission.running, 0)
+        self.assertEqual(await admission.acquire("b"), 0.0)
+
+    async def test_cancelled_waiter_leaves_the_queue(self):
+        admission = AdmissionScheduler(global_limit=1, guild_limit=1)
+        await admission.acquire("a")
+        waiting = await self.queue(admission, "b", [])
+        waiting.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await waiting
+        self.assertEqual(admission.queued, 0)
+        admission.release("a")
+        self.assertEqual(admission.running, 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,70 @@
+"""Load governor tests. Run from the repository root:
+
+    python -m unittest discover tests"""
+import logging
+import types
+import unittest
+
+from toothy.governor import LoadGovernor
+from toothy.metrics import Metrics
+
+
+class GovernorHysteresisTest(unittest.TestCase):
+    """Lag thresholds of 0.1s and 0.4s, recovering below half of them
+    after 60 calm seconds"""
+
+    def setUp(self):
+        # Every tier change logs a warning
+        logger = logging.getLogger("toothy.governor")
+        logger.disabled = True
+        self.addCleanup(setattr, logger, "disabled", False)
+        self.events = []
+        bot = types.SimpleNamespace(
+            metrics=Metrics(),
+            dispatch=lambda event, *args: self.events.append((event, ) + args))
+        self.governor = LoadGovernor(bot,
+                                     lag=(0.1, 0.4),
+                                     latency=(0.5, 1.5),
+                                     recovery=0.5,
+                                     cooldown=60)
+
+    def test_rises_immediately(self):
+        self.assertEqual(self.governor.evaluate(0.2, 0, now=0), 1)
+        self.assertEqual(self.governor.evaluate(0.5, 0, now=1), 2)
+        self.assertEqual(self.events, [("load_tier_change", 0, 1),
+                                       ("load_tier_change", 1, 2)])
+
+    def test_latency_alone_raises_the_tier(self):
+        self.assertEqual(self.governor.evaluate(0, 2.0, now=0), 2)
+
+    def test_stays_up_just_below_the_threshold(self):
+        self.governor.evaluate(0.2, 0, now=0)
+        for now in range(1, 600, 5):
+            self.assertEqual(self.governor.evaluate(0.08, 0, now=now), 1)
+
+    def test_drops_one_tier_per_cooldown(self):
+        self.governor.evaluate(0.5, 0, now=0)
+        self.assertEqual(self.governor.evaluate(0.01, 0, now=10), 2)
+        self.assertEqual(self.governor.evaluate(0.01, 0, now=69), 2)
+        self.assertEqual(self.governor.evaluate(0.01, 0, now=70), 1)
+        self.assertEqual(self.governor.evaluate(0.01, 0, now=129), 1)
+        self.assertEqual(self.governor.evaluate(0.01, 0, now=130), 0)
+        self.assertEqual(self.governor.evaluate(0.01, 0, now=500), 0)
+
+    def test_spike_restarts_the_cooldown(self):
+        self.governor.evaluate(0.2, 0, now=0)
+        self.governor.evaluate(0.01, 0, now=10)
+        # Not enough to rise again, but no longer calm
+        self.governor.evaluate(0.08, 0, now=50)
+        self.assertEqual(self.governor.evaluate(0.01, 0, now=80), 1)
+        self.assertEqual(self.governor.evaluate(0.01, 0, now=139), 1)
+        self.assertEqual(self.governor.evaluate(0.01, 0, now=140), 0)
+
+    def test_pick_uses_the_last_value_beyond_it(self):
+        self.governor.evaluate(0.5, 0, now=0)
+        self.assertEqual(self.governor.pick(1, 2, 3), 3)
+        self.assertEqual(self.governor.pick(1, 2), 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
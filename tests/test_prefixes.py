@@ -0,0 +1,98 @@
+"""Prefix cache tests. Run from the repository root:
+
+    python -m unittest discover tests"""
+import asyncio
+import types
+import unittest
+
+from toothy.metrics import Metrics
+from toothy.prefixes import PrefixResolver
+from toothy.tasks import TaskSupervisor
+
+
+class Guilds:
+    """The subset of the guilds collection the resolver uses"""
+
+    def __init__(self, docs):
+        self.docs = docs
+
+    async def find_one(self, query, projection=None):
+        for doc in self.docs:
+            if doc["_id"] == query["_id"]:
+                return doc
+        return None
+
+
+class Database:
+
+    def __init__(self, bot, docs):
+        self.bot = bot
+        self.guilds = Guilds(docs)
+
+    async def get_guilds_cursor(self, query, batch_size=None):
+        for doc in self.guilds.docs:
+            if doc.get("prefixes"):
+                yield doc
+
+
+class PrefixCacheTest(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.bot = types.SimpleNamespace(user=types.SimpleNamespace(id=1))
+        self.bot.metrics = Metrics()
+        self.bot.tasks = TaskSupervisor(self.bot)
+        self.bot.database = Database(self.bot, [{
+            "_id": 10,
+            "prefixes": ["?"]
+        }, {
+            "_id": 20
+        }])
+        self.resolver = PrefixResolver([">"])
+        self.mentions = ["<@!1> ", "<@1> "]
+
+    async def asyncTearDown(self):
+        await self.bot.tasks.close()
+
+    def message(self, guild_id):
+        guild = types.SimpleNamespace(id=guild_id) if guild_id else None
+        return types.SimpleNamespace(guild=guild)
+
+    async def resolve(self, guild_id):
+        prefixes = self.resolver(self.bot, self.message(guild_id))
+        # Give a background fetch the chance to finish
+        await asyncio.sleep(0)
+        await asyncio.sleep(0)
+        return prefixes
+
+    async def test_loaded_guilds_use_their_prefixes(self):
+        await self.resolver.load(self.bot)
+        self.assertEqual(await self.resolve(10), ["?"] + self.mentions)
+        self.assertEqual(await self.resolve(20), [">"] + self.mentions)
+
+    async def test_global_change_applies_to_uncached_guilds(self):
+        await self.resolver.load(self.bot)
+        await self.resolve(None)
+        self.resolver.global_prefixes = ["!"]
+        self.assertEqual(await self.resolve(None), ["!"] + self.mentions)
+        self.assertEqual(await self.resolve(20), ["!"] + self.mentions)
+        self.assertEqual(await self.resolve(10), ["?"] + self.mentions)
+
+    async def test_global_change_drops_remembered_defaults(self):
+        # Without a complete load, a guild using the global prefixes is
+        # fetched once and then remembered as using them
+        self.resolver.database = self.bot.database
+        await self.resolve(20)
+        self.assertIn(20, self.resolver._cache)
+        self.resolver.global_prefixes = ["!"]
+        self.assertNotIn(20, self.resolver._cache)
+        self.assertEqual(await self.resolve(20), ["!"] + self.mentions)
+
+    async def test_global_change_keeps_custom_prefixes(self):
+        self.resolver.database = self.bot.database
+        await self.resolve(10)
+        self.resolver.global_prefixes = ["!"]
+        self.assertEqual(await self.resolve(10), ["?"] + self.mentions)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,137 @@
+"""Role menu index tests. Run from the repository root:
+
+    python -m unittest discover tests"""
+import types
+import unittest
+
+import discord
+from discord.ext import commands
+
+from bench.fakes import FakeDiscord
+from toothy.metrics import Metrics
+from toothy.tasks import TaskSupervisor
+
+
+class Cursor:
+
+    def __init__(self, docs):
+        self.docs = docs
+
+    async def __aiter__(self):
+        for doc in self.docs:
+            yield doc
+
+
+class Collection:
+    """The subset of a Motor collection the role menu cog uses"""
+
+    def __init__(self, docs):
+        self.docs = docs
+
+    def _matches(self, doc, query):
+        return all(doc.get(key) == value for key, value in query.items())
+
+    def find(self, query):
+        return Cursor([doc for doc in self.docs if self._matches(doc, query)])
+
+    async def find_one(self, query):
+        for doc in self.docs:
+            if self._matches(doc, query):
+                return doc
+        return None
+
+    async def distinct(self, key):
+        return list({doc[key] for doc in self.docs})
+
+    async def update_one(self, query, update):
+        for doc in self.docs:
+            if self._matches(doc, query):
+                doc.update(update.get("$set", {}))
+
+
+class RepostedMenuTest(unittest.IsolatedAsyncioTestCase):
+    """Menus whose message was deleted are reposted under a new id, which
+    the index has to follow"""
+
+    async def asyncSetUp(self):
+        from cogs.rolemenu import RoleMenu
+        bot = commands.AutoShardedBot(command_prefix=">",
+                                      intents=discord.Intents.all(),
+                                      shard_count=1)
+        await bot._async_setup_hook()
+        bot.metrics = Metrics()
+        bot.tasks = TaskSupervisor(bot)
+        bot.governor = types.SimpleNamespace(pick=lambda *values: values[0])
+        self.fake = FakeDiscord(bot)
+        self.fake.install()
+        self.guild = self.fake.guild(members=1, roles=3)
+        self.deleted_message = self.fake.snowflake()
+        self.doc = {
+            "_id": 1,
+            "name": "menu",
+            "mode": 2,
+            "message_id": self.deleted_message,
+            "channel_id": self.guild.text_channels[0].id,
+            "guild_id": self.guild.id,
+            "color": 0,
+            "placeholder": "Pick roles",
+            "description": None,
+            "roles": [{
+                "id": role.id,
+                "emoji": None,
+                "description": None
+            } for role in self.guild.roles[1:-1]]
+        }
+        bot.database = types.SimpleNamespace(db=types.SimpleNamespace(
+            rolemenus=Collection([self.doc])))
+        request = self.fake.request
+
+        async def fetch_deleted(route, **kwargs):
+            if (route.method == "GET"
+                    and route.url.endswith(str(self.deleted_message))):
+                raise discord.NotFound(
+                    types.SimpleNamespace(status=404, reason="Not Found"),
+                    "Unknown Message")
+            return await request(route, **kwargs)
+
+        bot.http.request = fetch_deleted
+        self.bot = bot
+        self.cog = RoleMenu(bot)
+
+    async def asyncTearDown(self):
+        await self.bot.tasks.close()
+
+    def message(self, message_id):
+        return types.SimpleNamespace(id=message_id, guild=self.guild)
+
+    async def test_reconcile_follows_reposted_message(self):
+        await self.cog.reconcile_guild(self.guild.id)
+        menu = self.cog.menus.get(1)
+        self.assertNotEqual(menu.message_id, self.deleted_message)
+        self.assertEqual(self.doc["message_id"], menu.message_id)
+        self.assertIs(
+            await self.cog.get_menu_by_message(self.message(menu.message_id)),
+            menu)
+        self.assertIsNone(await self.cog.get_menu_by_message(
+            self.message(self.deleted_message)))
+
+    async def test_role_refresh_follows_reposted_message(self):
+        await self.cog.load_guild_menus(self.guild)
+        role = self.guild.roles[1]
+        await self.cog.refresh_menus_with_role(role)
+        menu = self.cog.menus.get(1)
+        self.assertNotEqual(menu.message_id, self.deleted_message)
+        self.assertIs(
+            await self.cog.get_menu_by_message(self.message(menu.message_id)),
+            menu)
+
+    async def test_removed_menu_is_not_reindexed(self):
+        await self.cog.load_guild_menus(self.guild)
+        menu = self.cog.menus.get(1)
+        self.cog.menus.remove(1)
+        self.cog.menus.reindex(menu)
+        self.assertIsNone(self.cog.menus.get(1))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,99 @@
+"""Settings file tests. Run from the repository root:
+
+    python -m unittest discover tests"""
+import asyncio
+import json
+import logging
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from toothy.settings import SettingsFile
+
+
+class SettingsFileTest(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.path = os.path.join(self.directory, "settings.json")
+        with open(self.path, encoding="utf-8", mode="w") as f:
+            json.dump({"a": 1, "b": 1}, f)
+
+    def read(self):
+        with open(self.path, encoding="utf-8") as f:
+            return json.load(f)
+
+    def settings_file(self, delay=0.05):
+        settings = SettingsFile(self.path, delay=delay)
+        writes = []
+        replace = settings._replace
+
+        def counting_replace(payload):
+            writes.append(payload)
+            replace(payload)
+
+        settings._replace = counting_replace
+        return settings, writes
+
+    async def test_bursts_are_written_once(self):
+        settings, writes = self.settings_file()
+        await settings.load()
+        settings["a"] = 2
+        settings.update(b=3, c=4)
+        settings["a"] = 5
+        self.assertEqual(self.read(), {"a": 1, "b": 1})
+        await asyncio.sleep(0.2)
+        self.assertEqual(len(writes), 1)
+        self.assertEqual(self.read(), {"a": 5, "b": 3, "c": 4})
+
+    async def test_flush_writes_immediately(self):
+        settings, writes = self.settings_file(delay=60)
+        await settings.load()
+        settings["a"] = 2
+        await settings.flush()
+        self.assertEqual(self.read(), {"a": 2, "b": 1})
+        await settings.flush()
+        self.assertEqual(len(writes), 1)
+
+    async def test_only_changed_keys_are_written(self):
+        first, _ = self.settings_file(delay=60)
+        second, _ = self.settings_file(delay=60)
+        await first.load()
+        await second.load()
+        first["a"] = 2
+        second["b"] = 3
+        await first.flush()
+        await second.flush()
+        self.assertEqual(self.read(), {"a": 2, "b": 3})
+
+    async def test_failed_write_keeps_the_file_and_changes(self):
+        settings, _ = self.settings_file(delay=60)
+        await settings.load()
+        settings["a"] = 2
+        with mock.patch("toothy.settings.os.replace", side_effect=OSError):
+            with self.assertRaises(OSError):
+                await settings.flush()
+        self.assertEqual(self.read(), {"a": 1, "b": 1})
+        settings["b"] = 3
+        await settings.flush()
+        self.assertEqual(self.read(), {"a": 2, "b": 3})
+        # Temporary files are replaced or removed, only the lock is left
+        self.assertEqual(sorted(os.listdir(self.directory)),
+                         ["settings.json", "settings.json.lock"])
+
+    async def test_missing_file_is_written_with_defaults(self):
+        os.unlink(self.path)
+        settings, _ = self.settings_file()
+        logger = logging.getLogger("toothy.settings")
+        with self.assertLogs(logger, "WARNING"):
+            data = await settings.load({"a": 0})
+        self.assertEqual(data, {"a": 0})
+        await settings.flush()
+        self.assertEqual(self.read(), {"a": 0})
+
+
+if __name__ == "__main__":
+    unittest.main()
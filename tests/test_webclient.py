@@ -0,0 +1,109 @@
+"""Web client tests. Run from the repository root:
+
+    python -m unittest discover tests"""
+import asyncio
+import types
+import unittest
+
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+from toothy.metrics import Metrics
+from toothy.webclient import WebClient
+from toothy.webclient import WebClientError
+
+
+class WebClientTest(unittest.IsolatedAsyncioTestCase):
+    """Requests against a local aiohttp server"""
+
+    async def asyncSetUp(self):
+        self.hits = []
+        self.statuses = []
+        app = web.Application()
+        app.router.add_route("*", "/status", self.status)
+        app.router.add_get("/slow", self.slow)
+        self.server = TestServer(app)
+        await self.server.start_server()
+        bot = types.SimpleNamespace(metrics=Metrics())
+        self.client = WebClient(bot, timeout=5, retries=2, backoff=0)
+        self.client.start()
+
+    async def asyncTearDown(self):
+        await self.client.close()
+        await self.server.close()
+
+    async def status(self, request):
+        """Answers with the next queued status, or 200 once they run out"""
+        self.hits.append(request.method)
+        status = self.statuses.pop(0) if self.statuses else 200
+        headers = {}
+        if status == 429:
+            headers["Retry-After"] = "0"
+        if status == 404 and request.query.get("no_store"):
+            headers["Cache-Control"] = "no-store"
+        return web.json_response({"status": status},
+                                 status=status,
+                                 headers=headers)
+
+    async def slow(self, request):
+        self.hits.append(request.method)
+        await asyncio.sleep(1)
+        return web.json_response({})
+
+    def url(self, path):
+        return str(self.server.make_url(path))
+
+    async def test_idempotent_request_is_retried(self):
+        self.statuses = [503, 429]
+        response = await self.client.get(self.url("/status"))
+        self.assertEqual(response.status, 200)
+        self.assertEqual(response.data, {"status": 200})
+        self.assertEqual(len(self.hits), 3)
+
+    async def test_last_response_is_returned_after_retries(self):
+        self.statuses = [503, 503, 503, 503]
+        response = await self.client.get(self.url("/status"))
+        self.assertEqual(response.status, 503)
+        self.assertEqual(len(self.hits), 3)
+
+    async def test_post_is_not_retried(self):
+        self.statuses = [503]
+        response = await self.client.post(self.url("/status"),
+                                          json_body={"a": 1})
+        self.assertEqual(response.status, 503)
+        self.assertEqual(self.hits, ["POST"])
+
+    async def test_deadline_covers_retries(self):
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        with self.assertRaises(WebClientError):
+            await self.client.get(self.url("/slow"), timeout=0.2)
+        self.assertLess(loop.time() - start, 0.9)
+
+    async def test_not_found_is_cached(self):
+        self.statuses = [404]
+        url = self.url("/status")
+        first = await self.client.get(url, cache_ttl=60)
+        second = await self.client.get(url, cache_ttl=60)
+        self.assertEqual(first.status, 404)
+        self.assertIs(second, first)
+        self.assertEqual(len(self.hits), 1)
+
+    async def test_no_store_is_not_cached(self):
+        self.statuses = [404]
+        url = self.url("/status?no_store=1")
+        await self.client.get(url, cache_ttl=60)
+        response = await self.client.get(url, cache_ttl=60)
+        self.assertEqual(response.status, 200)
+        self.assertEqual(len(self.hits), 2)
+
+    async def test_retryable_status_is_not_cached(self):
+        self.statuses = [503, 503, 503]
+        url = self.url("/status")
+        await self.client.get(url, cache_ttl=60)
+        response = await self.client.get(url, cache_ttl=60)
+        self.assertEqual(response.status, 200)
+
+
+if __name__ == "__main__":
+    unittest.main()
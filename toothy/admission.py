@@ -0,0 +1,100 @@
+import asyncio
+import collections
+import time
+
+
+class AdmissionRejected(Exception):
+    pass
+
+
+class AdmissionScheduler:
+    """Limits how many interactions run at once, overall and per guild.
+
+    Interactions over either limit wait in a queue per guild. Whenever a
+    slot frees up, the guilds with waiters are served round-robin, so a
+    single busy guild can't starve the others. A guild whose queue is
+    full has further interactions rejected."""
+
+    def __init__(self,
+                 *,
+                 global_limit=200,
+                 guild_limit=5,
+                 guild_queue=25):
+        self.global_limit = global_limit
+        self.guild_limit = guild_limit
+        self.guild_queue = guild_queue
+        self.running = 0
+        self.running_by_key = collections.Counter()
+        self.waiting = collections.OrderedDict()
+
+    @property
+    def queued(self):
+        return sum(len(waiters) for waiters in self.waiting.values())
+
+    def _can_run(self, key):
+        return (self.running < self.global_limit
+                and self.running_by_key[key] < self.guild_limit)
+
+    def _start(self, key):
+        self.running += 1
+        self.running_by_key[key] += 1
+
+    async def acquire(self, key, *, timeout=None):
+        """Waits for a slot, returning how long that took. Raises
+        AdmissionRejected if the key's queue is full and
+        asyncio.TimeoutError if no slot freed up within timeout"""
+        if key not in self.waiting and self._can_run(key):
+            self._start(key)
+            return 0.0
+        waiters = self.waiting.setdefault(key, collections.deque())
+        if len(waiters) >= self.guild_queue:
+            if not waiters:
+                del self.waiting[key]
+            raise AdmissionRejected(key)
+        future = asyncio.get_running_loop().create_future()
+        waiters.append(future)
+        start = time.monotonic()
+        try:
+            await asyncio.wait_for(asyncio.shield(future), timeout)
+        except BaseException:
+            if future.done() and not future.cancelled():
+                # The slot was granted just as we gave up on it
+                self.release(key)
+            else:
+                future.cancel()
+                self._discard(key, future)
+            raise
+        return time.monotonic() - start
+
+    def _discard(self, key, future):
+        waiters = self.waiting.get(key)
+        if waiters is None:
+            return
+        try:
+            waiters.remove(future)
+        except ValueError:
+            pass
+        if not waiters:
+            del self.waiting[key]
+
+    def release(self, key):
+        self.running -= 1
+        self.running_by_key[key] -= 1
+        if self.running_by_key[key] <= 0:
+            del self.running_by_key[key]
+        self._wake()
+
+    def _wake(self):
+        while self.waiting and self.running < self.global_limit:
+            for key in self.waiting:
+                if self.running_by_key[key] < self.guild_limit:
+                    break
+            else:
+                return
+            waiters = self.waiting.pop(key)
+            future = waiters.popleft()
+            if waiters:
+                # Served guilds go to the back of the line
+                self.waiting[key] = waiters
+            self._start(key)
+            future.set_result(None)
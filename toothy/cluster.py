@@ -0,0 +1,389 @@
+import asyncio
+import itertools
+import json
+import logging
+import multiprocessing
+import os
+import time
+
+import aiohttp
+
+log = logging.getLogger(__name__)
+
+GATEWAY_URL = "https://discord.com/api/v10/gateway/bot"
+IDENTIFY_INTERVAL = 5.0
+# How long a shard waits for the supervisor to allow its IDENTIFY before
+# falling back to spacing them out locally
+IDENTIFY_TIMEOUT = 120.0
+RECONNECT_ATTEMPTS = 5
+
+
+async def fetch_gateway_info(token):
+    """Returns the recommended shard count and identify concurrency"""
+    headers = {"Authorization": "Bot " + token}
+    async with aiohttp.ClientSession() as session:
+        async with session.get(GATEWAY_URL, headers=headers) as r:
+            r.raise_for_status()
+            data = await r.json()
+    return data["shards"], data["session_start_limit"]["max_concurrency"]
+
+
+def split_shards(shard_count, clusters):
+    """Splits shard ids into contiguous, evenly sized ranges"""
+    clusters = max(min(clusters, shard_count), 1)
+    size, extra = divmod(shard_count, clusters)
+    ranges = []
+    start = 0
+    for i in range(clusters):
+        end = start + size + (1 if i < extra else 0)
+        ranges.append(list(range(start, end)))
+        start = end
+    return ranges
+
+
+async def send(writer, message):
+    writer.write(json.dumps(message).encode("utf-8") + b"\n")
+    await writer.drain()
+
+
+class Cluster:
+
+    def __init__(self, cluster_id, shard_ids):
+        self.id = cluster_id
+        self.shard_ids = shard_ids
+        self.process = None
+        self.writer = None
+        self.started = 0
+        self.failures = 0
+        self.restart_at = 0
+
+
+class ClusterSupervisor:
+    """Runs shard ranges in separate processes, restarts them when they
+    exit and relays IPC requests between them over a unix socket.
+
+    target is called in each child process with the cluster id, its shard
+    ids, the total shard count and the socket path."""
+
+    def __init__(self, target, token, clusters, *, socket_path):
+        self.target = target
+        self.token = token
+        self.cluster_count = clusters
+        self.socket_path = socket_path
+        self.clusters = {}
+        self.shard_count = None
+        self.max_concurrency = 1
+        self.closing = False
+        self._pending = {}
+        self._nonces = itertools.count()
+        self._identify_locks = {}
+        self._last_identify = {}
+        self._tasks = set()
+        self._context = multiprocessing.get_context("spawn")
+
+    def _spawn(self, coro):
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    async def run(self, shard_count=None):
+        shard_count_hint, self.max_concurrency = await fetch_gateway_info(
+            self.token)
+        self.shard_count = shard_count or shard_count_hint
+        ranges = split_shards(self.shard_count, self.cluster_count)
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+        server = await asyncio.start_unix_server(self.handle_connection,
+                                                 path=self.socket_path)
+        print("Launching {} clusters for {} shards".format(
+            len(ranges), self.shard_count))
+        for cluster_id, shard_ids in enumerate(ranges):
+            self.clusters[cluster_id] = Cluster(cluster_id, shard_ids)
+            self.start_cluster(self.clusters[cluster_id])
+        try:
+            while not self.closing:
+                await asyncio.sleep(1)
+                self.check_clusters()
+        finally:
+            self.closing = True
+            server.close()
+            for task in list(self._tasks):
+                task.cancel()
+            for cluster in self.clusters.values():
+                if cluster.process and cluster.process.is_alive():
+                    cluster.process.terminate()
+            for cluster in self.clusters.values():
+                if cluster.process:
+                    await asyncio.get_running_loop().run_in_executor(
+                        None, cluster.process.join, 10)
+            if os.path.exists(self.socket_path):
+                os.unlink(self.socket_path)
+
+    def start_cluster(self, cluster):
+        cluster.process = self._context.Process(
+            target=self.target,
+            args=(cluster.id, cluster.shard_ids, self.shard_count,
+                  self.socket_path),
+            name="toothy-cluster-{}".format(cluster.id))
+        cluster.process.start()
+        cluster.started = time.monotonic()
+        log.info("Started cluster {} (shards {}-{}), pid {}".format(
+            cluster.id, cluster.shard_ids[0], cluster.shard_ids[-1],
+            cluster.process.pid))
+
+    def check_clusters(self):
+        now = time.monotonic()
+        for cluster in self.clusters.values():
+            if cluster.process.is_alive():
+                continue
+            if not cluster.restart_at:
+                if now - cluster.started > 60:
+                    cluster.failures = 0
+                cluster.failures += 1
+                delay = min(2**cluster.failures, 60)
+                cluster.restart_at = now + delay
+                log.warning(
+                    "Cluster {} exited with code {}, restarting in {}s".format(
+                        cluster.id, cluster.process.exitcode, delay))
+            elif now >= cluster.restart_at:
+                cluster.restart_at = 0
+                self.start_cluster(cluster)
+
+    async def handle_connection(self, reader, writer):
+        cluster = None
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                message = json.loads(line)
+                op = message["op"]
+                if op == "identify":
+                    cluster = self.clusters[message["cluster"]]
+                    cluster.writer = writer
+                elif op == "request":
+                    self._spawn(self.relay(writer, message))
+                elif op == "reply":
+                    future = self._pending.get(message["nonce"])
+                    if future and not future.done():
+                        future.set_result((message["cluster"],
+                                           message["data"]))
+                elif op == "before_identify":
+                    self._spawn(self.allow_identify(writer, message))
+        except (ConnectionError, ValueError, KeyError) as e:
+            log.warning("Dropping cluster IPC connection", exc_info=e)
+        finally:
+            if cluster and cluster.writer is writer:
+                cluster.writer = None
+            writer.close()
+
+    async def relay(self, origin, message):
+        """Sends a request to every connected cluster and returns the
+        collected replies to the one that asked"""
+        timeout = message.get("timeout", 5)
+        futures = []
+        loop = asyncio.get_running_loop()
+        for cluster in self.clusters.values():
+            if not cluster.writer:
+                continue
+            nonce = next(self._nonces)
+            future = self._pending[nonce] = loop.create_future()
+            futures.append((nonce, future))
+            try:
+                await send(
+                    cluster.writer, {
+                        "op": "query",
+                        "nonce": nonce,
+                        "name": message["name"],
+                        "args": message.get("args", {})
+                    })
+            except ConnectionError:
+                future.cancel()
+        done = set()
+        if futures:
+            done, _ = await asyncio.wait([f for _, f in futures],
+                                         timeout=timeout)
+        results = {}
+        for nonce, future in futures:
+            self._pending.pop(nonce, None)
+            if future in done and not future.cancelled():
+                cluster_id, data = future.result()
+                results[str(cluster_id)] = data
+        await send(origin, {
+            "op": "response",
+            "nonce": message["nonce"],
+            "data": results
+        })
+
+    async def allow_identify(self, writer, message):
+        """Spaces out IDENTIFYs across processes so each rate limit bucket
+        gets at most one per five seconds"""
+        bucket = message["shard_id"] % self.max_concurrency
+        lock = self._identify_locks.setdefault(bucket, asyncio.Lock())
+        async with lock:
+            wait = (self._last_identify.get(bucket, 0) + IDENTIFY_INTERVAL -
+                    time.monotonic())
+            if wait > 0:
+                await asyncio.sleep(wait)
+            self._last_identify[bucket] = time.monotonic()
+        await send(writer, {"op": "response", "nonce": message["nonce"]})
+
+
+class ClusterClient:
+    """A cluster's connection to the supervisor.
+
+    Handlers registered with add_handler answer queries broadcast by any
+    cluster, including this one. When the connection drops, pending
+    requests fail with ConnectionError and the client reconnects; if that
+    keeps failing, on_lost is awaited so the worker can shut down and be
+    restarted by the supervisor."""
+
+    def __init__(self, cluster_id, shard_ids, socket_path):
+        self.id = cluster_id
+        self.shard_ids = shard_ids
+        self.socket_path = socket_path
+        self.handlers = {}
+        self.on_lost = None
+        self._writer = None
+        self._task = None
+        self._tasks = set()
+        self._pending = {}
+        self._nonces = itertools.count()
+
+    def add_handler(self, name, coro):
+        self.handlers[name] = coro
+
+    def _spawn(self, coro):
+        task = asyncio.get_running_loop().create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    async def _open(self):
+        reader, self._writer = await asyncio.open_unix_connection(
+            self.socket_path)
+        await send(self._writer, {"op": "identify", "cluster": self.id})
+        return reader
+
+    async def connect(self):
+        reader = await self._open()
+        self._task = asyncio.get_running_loop().create_task(
+            self._read_loop(reader))
+
+    async def close(self):
+        if self._task:
+            self._task.cancel()
+        for task in list(self._tasks):
+            task.cancel()
+        if self._writer:
+            self._writer.close()
+        self._fail_pending()
+
+    def _fail_pending(self):
+        pending, self._pending = self._pending, {}
+        for future in pending.values():
+            if not future.done():
+                future.set_exception(
+                    ConnectionError("Lost connection to the cluster "
+                                    "supervisor"))
+
+    async def _reconnect(self):
+        for attempt in range(RECONNECT_ATTEMPTS):
+            await asyncio.sleep(min(2**attempt, 30))
+            try:
+                return await self._open()
+            except OSError as e:
+                log.warning("Reconnecting to the cluster supervisor failed: "
+                            "{}".format(e))
+        return None
+
+    async def _read_loop(self, reader):
+        while True:
+            try:
+                line = await reader.readline()
+            except (ConnectionError, ValueError):
+                line = b""
+            if not line:
+                log.error("Lost connection to the cluster supervisor")
+                self._writer.close()
+                self._writer = None
+                self._fail_pending()
+                reader = await self._reconnect()
+                if reader is None:
+                    log.critical("Could not reconnect to the cluster "
+                                 "supervisor, shutting down")
+                    if self.on_lost:
+                        self._spawn(self.on_lost())
+                    return
+                log.info("Reconnected to the cluster supervisor")
+                continue
+            message = json.loads(line)
+            if message["op"] == "query":
+                self._spawn(self._answer(message))
+            elif message["op"] == "response":
+                future = self._pending.pop(message["nonce"], None)
+                if future and not future.done():
+                    future.set_result(message.get("data"))
+
+    async def _answer(self, message):
+        handler = self.handlers.get(message["name"])
+        try:
+            data = await handler(**message["args"]) if handler else None
+        except Exception as e:
+            log.exception("Error in cluster handler {}".format(
+                message["name"]),
+                          exc_info=e)
+            data = None
+        if not self._writer:
+            return
+        try:
+            await send(self._writer, {
+                "op": "reply",
+                "nonce": message["nonce"],
+                "cluster": self.id,
+                "data": data
+            })
+        except ConnectionError:
+            pass
+
+    async def _request(self, message, timeout):
+        if not self._writer:
+            raise ConnectionError("Not connected to the cluster supervisor")
+        nonce = next(self._nonces)
+        future = self._pending[nonce] = (
+            asyncio.get_running_loop().create_future())
+        message["nonce"] = nonce
+        try:
+            await send(self._writer, message)
+            return await asyncio.wait_for(future, timeout)
+        finally:
+            self._pending.pop(nonce, None)
+
+    async def request(self, name, *, timeout=5, **args):
+        """Runs a handler on every cluster. Returns a dict of
+        cluster id -> result"""
+        return await self._request(
+            {
+                "op": "request",
+                "name": name,
+                "args": args,
+                "timeout": timeout
+            }, timeout + 1)
+
+    async def before_identify(self, shard_id):
+        """Waits for the supervisor to allow an IDENTIFY. Returns False if
+        it could not be reached in time, in which case the caller spaces
+        out IDENTIFYs on its own"""
+        try:
+            await self._request({
+                "op": "before_identify",
+                "shard_id": shard_id
+            }, IDENTIFY_TIMEOUT)
+        except (ConnectionError, asyncio.TimeoutError) as e:
+            log.warning("No identify slot from the cluster supervisor for "
+                        "shard {} ({}), using local concurrency".format(
+                            shard_id,
+                            type(e).__name__))
+            return False
+        return True
@@ -45,6 +45,14 @@ class MongoController:
             return None
         return doc.get("prefixes")
 
+    async def set_prefixes(self, guild, prefixes):
+        """Set a guild's custom prefixes. Empty list removes them"""
+        if prefixes:
+            update = {"$set": {"prefixes": list(prefixes)}}
+        else:
+            update = {"$unset": {"prefixes": ""}}
+        await self.guilds.update_one({"_id": guild.id}, update, upsert=True)
+
     async def get_user(self, user, cog=None):
         """Get user. Pass a cog instance in order to return
            cog specific settings"""
@@ -0,0 +1,136 @@
+import asyncio
+import logging
+
+import discord
+
+log = logging.getLogger(__name__)
+
+
+class ModalAfterDeferral(discord.ClientException):
+    """Raised when a handler sends a modal after the guard has deferred
+    its interaction, which Discord doesn't allow"""
+
+
+class GuardedResponse:
+    """Wraps an InteractionResponse and defers it if the handler hasn't
+    responded within budget seconds.
+
+    Once deferred, send_message is redirected to a followup, edit_message
+    to edit_original_response and defer becomes a no-op, so handlers keep
+    working unchanged. Everything else is passed through.
+
+    Commands are deferred ephemerally unless they set defer_ephemeral to
+    False in their extras, as the first followup takes the deferral's
+    visibility. Modals can't follow a deferral, so send_modal raises
+    ModalAfterDeferral instead."""
+
+    def __init__(self, interaction, budget, label=None):
+        self._interaction = interaction
+        self._response = interaction.response
+        self._lock = asyncio.Lock()
+        self.label = label
+        self.rescued = False
+        self._rescue_task = None
+        self._timer = asyncio.get_running_loop().call_later(
+            budget, self._start_rescue)
+
+    def __getattr__(self, name):
+        return getattr(self._response, name)
+
+    def cancel(self):
+        self._timer.cancel()
+
+    def _start_rescue(self):
+        if not self._response.is_done():
+            self._rescue_task = asyncio.get_running_loop().create_task(
+                self._rescue())
+
+    async def _rescue(self):
+        interaction = self._interaction
+        metrics = interaction.client.metrics
+        command = interaction.command
+        if self.label is None:
+            self.label = "command:{}".format(
+                command.qualified_name if command else "unknown")
+        async with self._lock:
+            if self._response.is_done():
+                return
+            try:
+                if interaction.type is discord.InteractionType.component:
+                    await self._response.defer()
+                else:
+                    extras = getattr(command, "extras", {})
+                    await self._response.defer(
+                        thinking=True,
+                        ephemeral=extras.get("defer_ephemeral", True))
+            except discord.NotFound:
+                metrics.incr("interactions.expired")
+                log.warning("{} expired before it could be deferred".format(
+                    self.label))
+                return
+            except discord.HTTPException as e:
+                log.warning("Could not defer {}".format(self.label),
+                            exc_info=e)
+                return
+        self.rescued = True
+        metrics.incr("interactions.rescued")
+        metrics.incr("interactions.rescued." + self.label)
+
+    async def defer(self, **kwargs):
+        async with self._lock:
+            if self.rescued:
+                return
+            return await self._response.defer(**kwargs)
+
+    async def send_modal(self, modal):
+        async with self._lock:
+            if not self.rescued:
+                return await self._response.send_modal(modal)
+        self._interaction.client.metrics.incr("interactions.late_modal")
+        raise ModalAfterDeferral(
+            "{} was deferred before it sent its modal".format(self.label))
+
+    async def send_message(self, content=None, **kwargs):
+        async with self._lock:
+            if not self.rescued:
+                return await self._response.send_message(content, **kwargs)
+        delete_after = kwargs.pop("delete_after", None)
+        message = await self._interaction.followup.send(content,
+                                                        wait=True,
+                                                        **kwargs)
+        if delete_after is not None:
+            await message.delete(delay=delete_after)
+        return message
+
+    async def edit_message(self, **kwargs):
+        async with self._lock:
+            if not self.rescued:
+                return await self._response.edit_message(**kwargs)
+        kwargs.pop("delete_after", None)
+        kwargs.pop("suppress_embeds", None)
+        return await self._interaction.edit_original_response(**kwargs)
+
+
+def guard(interaction, budget, label=None):
+    """Installs a GuardedResponse as interaction.response and returns it.
+    Call cancel on it once the handler returns"""
+    guarded = GuardedResponse(interaction, budget, label)
+    interaction._cs_response = guarded
+    return guarded
+
+
+class GuardedView(discord.ui.View):
+    """View whose component callbacks are covered by the deferral guard"""
+
+    async def _scheduled_task(self, item, interaction):
+        # Generated custom ids are random, so only use ones set explicitly
+        if getattr(item, "_provided_custom_id", False):
+            name = item.custom_id
+        else:
+            name = type(item).__name__
+        label = "component:{}.{}".format(type(self).__name__, name)
+        guarded = guard(interaction, interaction.client.defer_after, label)
+        try:
+            await super()._scheduled_task(item, interaction)
+        finally:
+            guarded.cancel()
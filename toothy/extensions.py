@@ -0,0 +1,227 @@
+import importlib
+import importlib.abc
+import logging
+import sys
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+
+class ImportTimer(importlib.abc.MetaPathFinder):
+    """Records how long modules take to import while installed, like
+    python -X importtime does.
+
+    It finds specs through the rest of sys.meta_path and swaps their
+    loader's class for a subclass that times exec_module, so isinstance
+    checks against the loader keep working."""
+
+    def __init__(self):
+        self.cumulative = {}
+        self.own = {}
+        self._local = threading.local()
+        self._timed_classes = {}
+
+    def __enter__(self):
+        sys.meta_path.insert(0, self)
+        return self
+
+    def __exit__(self, *exc_info):
+        sys.meta_path.remove(self)
+
+    def find_spec(self, fullname, path, target=None):
+        if getattr(self._local, "finding", False):
+            return None
+        self._local.finding = True
+        try:
+            for finder in sys.meta_path:
+                if finder is self or not hasattr(finder, "find_spec"):
+                    continue
+                spec = finder.find_spec(fullname, path, target)
+                if spec is not None:
+                    break
+            else:
+                return None
+        finally:
+            self._local.finding = False
+        loader = spec.loader
+        if loader is not None and not isinstance(loader, type):
+            try:
+                loader.__class__ = self._timed_class(type(loader))
+            except TypeError:
+                pass
+        return spec
+
+    def _timed_class(self, cls):
+        try:
+            return self._timed_classes[cls]
+        except KeyError:
+            pass
+        timer = self
+
+        def exec_module(loader, module):
+            stack = timer._stack()
+            stack.append(0.0)
+            start = time.perf_counter()
+            try:
+                cls.exec_module(loader, module)
+            finally:
+                elapsed = time.perf_counter() - start
+                children = stack.pop()
+                if stack:
+                    stack[-1] += elapsed
+                timer.cumulative[module.__name__] = elapsed
+                timer.own[module.__name__] = elapsed - children
+                # Only time the first execution of a module
+                loader.__class__ = cls
+
+        timed = type(cls.__name__, (cls, ), {"exec_module": exec_module})
+        self._timed_classes[cls] = timed
+        return timed
+
+    def _stack(self):
+        try:
+            return self._local.stack
+        except AttributeError:
+            stack = self._local.stack = []
+            return stack
+
+    def top(self, limit=15):
+        """Returns (module, own seconds, cumulative seconds) for the
+        slowest modules"""
+        slowest = sorted(self.cumulative.items(),
+                         key=lambda item: item[1],
+                         reverse=True)[:limit]
+        return [(name, self.own[name], cumulative)
+                for name, cumulative in slowest]
+
+
+def import_extension(name):
+    """Imports an extension's module, returning it and the time it took.
+    Meant to be run in an executor so heavy dependencies are imported off
+    the event loop. Load the returned module with PreimportedLoader so its
+    body isn't executed a second time"""
+    start = time.perf_counter()
+    module = importlib.import_module(name)
+    return module, time.perf_counter() - start
+
+
+class PreimportedLoader(importlib.abc.Loader):
+    """Loader that hands out a module that was already imported instead of
+    executing it again"""
+
+    def __init__(self, module):
+        self.module = module
+
+    def create_module(self, spec):
+        return self.module
+
+    def exec_module(self, module):
+        pass
+
+
+class DependencyCycle(ValueError):
+    """Raised by dependency_waves. blocked holds the extensions that are
+    part of a cycle or depend on one"""
+
+    def __init__(self, blocked):
+        self.blocked = sorted(blocked)
+        super().__init__("Circular extension dependencies: {}".format(
+            ", ".join(self.blocked)))
+
+
+def dependency_waves(dependencies):
+    """Groups extensions into waves that can be loaded concurrently.
+
+    dependencies maps an extension to the extensions it needs loaded first.
+    Dependencies outside of the mapping are assumed to be satisfied.
+    Raises DependencyCycle on cycles."""
+    remaining = {
+        name: {dep for dep in deps if dep in dependencies}
+        for name, deps in dependencies.items()
+    }
+    waves = []
+    while remaining:
+        wave = sorted(name for name, deps in remaining.items() if not deps)
+        if not wave:
+            raise DependencyCycle(remaining)
+        waves.append(wave)
+        for name in wave:
+            del remaining[name]
+        for deps in remaining.values():
+            deps.difference_update(wave)
+    return waves
+
+
+class ExtensionTiming:
+
+    def __init__(self, name):
+        self.name = name
+        self.import_time = None
+        self.setup_time = None
+        self.error = None
+
+
+class StartupReport:
+    """Timings of the startup phases and of every extension"""
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.phases = {}
+        self.extensions = {}
+        self.modules = []
+        self.peak_rss = None
+        self._phase_start = {}
+
+    def extension(self, name):
+        try:
+            return self.extensions[name]
+        except KeyError:
+            timing = self.extensions[name] = ExtensionTiming(name)
+            return timing
+
+    def begin(self, phase):
+        self._phase_start[phase] = time.monotonic()
+
+    def end(self, phase):
+        self.phases[phase] = time.monotonic() - self._phase_start.pop(phase)
+
+    def mark(self, phase):
+        """Records the time from process start until now"""
+        if phase not in self.phases:
+            self.phases[phase] = time.monotonic() - self.started
+
+    def record_rss(self):
+        try:
+            import resource
+        except ImportError:
+            return
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Linux reports kilobytes, macOS bytes
+        if sys.platform == "darwin":
+            peak /= 1024
+        self.peak_rss = peak / 1024
+
+    def format(self):
+        lines = ["{:<24}{:>9.3f}s".format(phase, duration)
+                 for phase, duration in self.phases.items()]
+        lines.append("{:<24}{:>10}{:>10}".format("extension", "import",
+                                                 "setup"))
+        for timing in sorted(self.extensions.values(),
+                             key=lambda t: -((t.import_time or 0) +
+                                             (t.setup_time or 0))):
+            if timing.error:
+                lines.append("{:<24} failed: {}".format(
+                    timing.name, timing.error))
+                continue
+            lines.append("{:<24}{:>9.3f}s{:>9.3f}s".format(
+                timing.name, timing.import_time or 0, timing.setup_time or 0))
+        if self.modules:
+            lines.append("{:<44}{:>9}{:>9}".format("slowest imports", "self",
+                                                   "total"))
+            for name, own, cumulative in self.modules:
+                lines.append("{:<44}{:>8.3f}s{:>8.3f}s".format(
+                    name[:43], own, cumulative))
+        if self.peak_rss:
+            lines.append("peak RSS: {:.1f} MiB".format(self.peak_rss))
+        return "\n".join(lines)
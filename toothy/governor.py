@@ -0,0 +1,105 @@
+import asyncio
+import logging
+import math
+import time
+
+log = logging.getLogger(__name__)
+
+TIER_NAMES = ("normal", "reduced", "minimal")
+
+
+class LoadGovernor:
+    """Picks a load tier from event loop lag and gateway latency.
+
+    Tier 0 is full behaviour, higher tiers ask features to do less. The
+    tier rises as soon as the recent loop lag p95 or the worst shard
+    latency crosses one of its thresholds. It only drops once both have
+    stayed below recovery times the thresholds for cooldown seconds, so
+    it doesn't flap around a threshold. Changes are dispatched as the
+    load_tier_change event."""
+
+    def __init__(self,
+                 bot,
+                 *,
+                 interval=5,
+                 lag=(0.1, 0.4),
+                 latency=(0.5, 1.5),
+                 recovery=0.5,
+                 cooldown=60):
+        self.bot = bot
+        self.interval = interval
+        self.lag_thresholds = tuple(lag)
+        self.latency_thresholds = tuple(latency)
+        self.recovery = recovery
+        self.cooldown = cooldown
+        self.tier = 0
+        self._calm_since = None
+
+    @property
+    def tier_name(self):
+        return TIER_NAMES[self.tier]
+
+    def pick(self, *values):
+        """Returns the value for the current tier, or the last value for
+        tiers beyond it"""
+        return values[min(self.tier, len(values) - 1)]
+
+    def start(self):
+        self.bot.tasks.spawn(name="toothy:governor",
+                             owner="Toothy",
+                             factory=self.run)
+
+    def recent_lag(self):
+        samples = self.bot.metrics.histograms.get("loop.lag")
+        if not samples:
+            return 0.0
+        count = max(int(self.interval / self.bot.watchdog.interval), 1)
+        recent = sorted(list(samples)[-count:])
+        return recent[min(len(recent) - 1, int(round(0.95 * len(recent))))]
+
+    def worst_latency(self):
+        latencies = [
+            latency for _, latency in self.bot.latencies
+            if not math.isinf(latency) and not math.isnan(latency)
+        ]
+        return max(latencies, default=0.0)
+
+    def target_tier(self, lag, latency, scale=1.0):
+        tier = 0
+        for level, (max_lag, max_latency) in enumerate(
+                zip(self.lag_thresholds, self.latency_thresholds), 1):
+            if lag > max_lag * scale or latency > max_latency * scale:
+                tier = level
+        return tier
+
+    def evaluate(self, lag, latency, now=None):
+        """Updates the tier from a measurement and returns it"""
+        now = time.monotonic() if now is None else now
+        target = self.target_tier(lag, latency)
+        if target > self.tier:
+            self._calm_since = None
+            self._set_tier(target, lag, latency)
+        elif self.target_tier(lag, latency, self.recovery) < self.tier:
+            if self._calm_since is None:
+                self._calm_since = now
+            elif now - self._calm_since >= self.cooldown:
+                self._calm_since = now
+                self._set_tier(self.tier - 1, lag, latency)
+        else:
+            self._calm_since = None
+        return self.tier
+
+    def _set_tier(self, tier, lag, latency):
+        old = self.tier
+        self.tier = tier
+        self.bot.metrics.gauge("load.tier", tier)
+        self.bot.metrics.incr("load.tier_changes")
+        log.warning("Load tier {} -> {} (loop lag {:.3f}s, latency "
+                    "{:.3f}s)".format(TIER_NAMES[old], TIER_NAMES[tier], lag,
+                                      latency))
+        self.bot.dispatch("load_tier_change", old, tier)
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            self.evaluate(self.recent_lag(), self.worst_latency())
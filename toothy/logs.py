@@ -0,0 +1,111 @@
+import copy
+import datetime
+import json
+import logging
+import logging.handlers
+import random
+import threading
+import time
+
+
+class JsonFormatter(logging.Formatter):
+    """Formats records as one JSON object per line"""
+
+    def format(self, record):
+        doc = {
+            "time": datetime.datetime.fromtimestamp(
+                record.created, datetime.timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+            "thread": record.threadName
+        }
+        if record.exc_info:
+            doc["exception"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            doc["exception"] = record.exc_text
+        return json.dumps(doc, default=str)
+
+
+class QueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that keeps a record's message and traceback apart.
+
+    The stock handler merges the traceback into the message and drops
+    exc_info before queueing. This one keeps the message as is and the
+    formatted traceback in exc_text, which both logging.Formatter and
+    JsonFormatter output."""
+
+    _exception_formatter = logging.Formatter()
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.message = record.getMessage()
+        record.msg = record.message
+        record.args = None
+        if record.exc_info:
+            if not record.exc_text:
+                record.exc_text = self._exception_formatter.formatException(
+                    record.exc_info)
+            record.exc_info = None
+        return record
+
+
+class LoggerLimit:
+
+    def __init__(self, rate=None, per=60.0, sample=1.0):
+        self.rate = rate
+        self.per = per
+        self.sample = sample
+        self.window_start = time.monotonic()
+        self.passed = 0
+        self.suppressed = 0
+
+
+class RateLimitFilter(logging.Filter):
+    """Samples and rate limits records from noisy loggers.
+
+    Limits are keyed by logger name and also apply to child loggers.
+    Warnings are only rate limited, never sampled away, and errors always
+    get through. The number of suppressed records is appended to the next
+    record that gets through."""
+
+    def __init__(self, limits):
+        super().__init__()
+        self.limits = {
+            name: LoggerLimit(**settings)
+            for name, settings in limits.items()
+        }
+        self._lock = threading.Lock()
+
+    def get_limit(self, name):
+        while name:
+            try:
+                return self.limits[name]
+            except KeyError:
+                name = name.rpartition(".")[0]
+        return None
+
+    def filter(self, record):
+        limit = self.get_limit(record.name)
+        if limit is None or record.levelno >= logging.ERROR:
+            return True
+        with self._lock:
+            if (record.levelno < logging.WARNING and limit.sample < 1
+                    and random.random() >= limit.sample):
+                limit.suppressed += 1
+                return False
+            if limit.rate is not None:
+                now = time.monotonic()
+                if now - limit.window_start >= limit.per:
+                    limit.window_start = now
+                    limit.passed = 0
+                if limit.passed >= limit.rate:
+                    limit.suppressed += 1
+                    return False
+                limit.passed += 1
+            suppressed, limit.suppressed = limit.suppressed, 0
+        if suppressed:
+            record.msg = "{} [{} similar messages suppressed]".format(
+                record.getMessage(), suppressed)
+            record.args = None
+        return True
@@ -0,0 +1,91 @@
+import collections
+import gc
+import linecache
+import os
+import tracemalloc
+
+
+def object_census(limit=25):
+    """Returns the most common live object types as (type name, count)"""
+    counter = collections.Counter()
+    for obj in gc.get_objects():
+        cls = type(obj)
+        counter["{}.{}".format(cls.__module__, cls.__qualname__)] += 1
+    return counter.most_common(limit)
+
+
+def cache_sizes(bot):
+    """Returns the size of the bot's own caches, followed by whatever the
+    loaded cogs report through their memory_usage method"""
+    view_store = getattr(bot._connection, "_view_store", None)
+    sizes = {
+        "guilds": len(bot.guilds),
+        "users": len(bot.users),
+        "members": sum(len(guild.members) for guild in bot.guilds),
+        "messages": len(bot.cached_messages),
+        "emojis": len(bot.emojis),
+        "voice_clients": len(bot.voice_clients),
+        "persistent_views": len(bot.persistent_views),
+    }
+    web = getattr(bot, "web", None)
+    if web is not None:
+        sizes["web_cache"] = len(web.cache)
+    if view_store is not None:
+        sizes["message_views"] = len(
+            getattr(view_store, "_synced_message_views", ()))
+        sizes["modals"] = len(getattr(view_store, "_modals", ()))
+    for name, cog in bot.cogs.items():
+        report = getattr(cog, "memory_usage", None)
+        if not report:
+            continue
+        for key, value in report().items():
+            sizes["{}.{}".format(name, key)] = value
+    return sizes
+
+
+class SnapshotDiff:
+    """Compares tracemalloc snapshots taken at two points in time"""
+
+    def __init__(self):
+        self.baseline = None
+
+    @property
+    def tracing(self):
+        return tracemalloc.is_tracing()
+
+    def start(self, frames=1):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(frames)
+        self.baseline = None
+
+    def stop(self):
+        tracemalloc.stop()
+        self.baseline = None
+
+    def take(self):
+        snapshot = tracemalloc.take_snapshot()
+        return snapshot.filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, linecache.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+        ))
+
+    def mark(self):
+        """Stores a baseline snapshot to diff against"""
+        self.baseline = self.take()
+
+    def diff(self, group_by="lineno", limit=15):
+        """Returns the allocation sites that grew the most since the
+        baseline, and moves the baseline forward"""
+        current = self.take()
+        stats = current.compare_to(self.baseline, group_by)
+        self.baseline = current
+        return stats[:limit]
+
+
+def format_stat(stat):
+    frame = stat.traceback[0]
+    filename = os.path.join(*frame.filename.split(os.sep)[-2:])
+    return "{:+.1f} KiB ({:+d}) {}:{}".format(stat.size_diff / 1024,
+                                              stat.count_diff, filename,
+                                              frame.lineno)
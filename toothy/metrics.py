@@ -0,0 +1,74 @@
+import collections
+import time
+
+
+class Metrics:
+    """In-process metrics registry.
+
+    Counters and gauges hold a single value, histograms keep a bounded
+    window of the most recent observations so percentiles stay cheap."""
+
+    def __init__(self, window=2048):
+        self.window = window
+        self.started = time.time()
+        self.counters = collections.Counter()
+        self.gauges = {}
+        self.histograms = {}
+
+    def incr(self, name, value=1):
+        self.counters[name] += value
+
+    def gauge(self, name, value):
+        self.gauges[name] = value
+
+    def observe(self, name, value):
+        try:
+            hist = self.histograms[name]
+        except KeyError:
+            hist = self.histograms[name] = collections.deque(
+                maxlen=self.window)
+        hist.append(value)
+
+    def percentiles(self, name, points=(50, 90, 99)):
+        """Returns a dict of percentile -> value for a histogram"""
+        values = sorted(self.histograms.get(name, ()))
+        if not values:
+            return {}
+        last = len(values) - 1
+        return {p: values[min(last, int(round(p / 100 * last)))] for p in points}
+
+    def snapshot(self, prefix=""):
+        """Returns a plain dict of every metric whose name starts with
+        prefix. Histograms are summarised as count, max and percentiles"""
+        result = {}
+        for name, value in self.counters.items():
+            if name.startswith(prefix):
+                result[name] = value
+        for name, value in self.gauges.items():
+            if name.startswith(prefix):
+                result[name] = value
+        for name, values in self.histograms.items():
+            if not name.startswith(prefix) or not values:
+                continue
+            summary = {"count": len(values), "max": max(values)}
+            for p, value in self.percentiles(name).items():
+                summary["p{}".format(p)] = value
+            result[name] = summary
+        return result
+
+    def format(self, prefix=""):
+        lines = []
+        for name, value in sorted(self.snapshot(prefix).items()):
+            if isinstance(value, dict):
+                value = " ".join("{}={}".format(k, _fmt(v))
+                                 for k, v in value.items())
+            else:
+                value = _fmt(value)
+            lines.append("{}: {}".format(name, value))
+        return "\n".join(lines)
+
+
+def _fmt(value):
+    if isinstance(value, float):
+        return "{:.4f}".format(value)
+    return str(value)
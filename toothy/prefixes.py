@@ -0,0 +1,115 @@
+import collections
+import logging
+
+log = logging.getLogger(__name__)
+
+
+class PrefixResolver:
+    """Command prefix callable that never does I/O.
+
+    Global prefixes and the mention forms are built once. Per guild
+    prefixes are bulk loaded into a bounded LRU cache holding the final
+    prefix lists. If every custom prefix fit into the cache, a miss means
+    the guild uses the global prefixes. Otherwise the global prefixes are
+    used while the guild's prefixes are fetched in the background."""
+
+    def __init__(self, global_prefixes, *, max_size=10000):
+        self.max_size = max_size
+        self.database = None
+        self.complete = False
+        self._global_prefixes = list(global_prefixes)
+        self._base = None
+        self._cache = collections.OrderedDict()
+        self._fetching = set()
+
+    @property
+    def global_prefixes(self):
+        return self._global_prefixes
+
+    @global_prefixes.setter
+    def global_prefixes(self, prefixes):
+        old_base = self._base
+        self._global_prefixes = list(prefixes)
+        self._base = None
+        for guild_id in [
+                guild_id for guild_id, cached in self._cache.items()
+                if cached is old_base
+        ]:
+            del self._cache[guild_id]
+
+    def __call__(self, bot, message):
+        guild = message.guild
+        if guild is None:
+            return self.base(bot)
+        try:
+            prefixes = self._cache[guild.id]
+        except KeyError:
+            if not self.complete:
+                self.fetch(guild.id)
+            return self.base(bot)
+        self._cache.move_to_end(guild.id)
+        return prefixes
+
+    def base(self, bot):
+        if self._base is None:
+            if bot.user is None:
+                return self._global_prefixes
+            self._base = self._global_prefixes + self.mentions(bot)
+        return self._base
+
+    def mentions(self, bot):
+        return ["<@!{}> ".format(bot.user.id), "<@{}> ".format(bot.user.id)]
+
+    def _store(self, bot, guild_id, prefixes):
+        self._cache.pop(guild_id, None)
+        if not prefixes:
+            return
+        self._remember(guild_id, list(prefixes) + self.mentions(bot))
+
+    def _remember(self, guild_id, prefixes):
+        self._cache[guild_id] = prefixes
+        if len(self._cache) > self.max_size:
+            self._cache.popitem(last=False)
+            self.complete = False
+
+    async def load(self, bot):
+        """Bulk loads every guild's custom prefixes"""
+        self.database = bot.database
+        self._cache.clear()
+        self.complete = True
+        async for doc in bot.database.get_guilds_cursor(
+            {"prefixes": {"$exists": True, "$ne": []}},
+                batch_size=1000):
+            self._store(bot, doc["_id"], doc["prefixes"])
+        log.info("Loaded custom prefixes of {} guilds".format(
+            len(self._cache)))
+
+    def fetch(self, guild_id):
+        if guild_id in self._fetching or self.database is None:
+            return
+        self._fetching.add(guild_id)
+        self.database.bot.tasks.spawn(
+            self._fetch(guild_id),
+            name="prefixes:fetch:{}".format(guild_id),
+            owner="Toothy")
+
+    async def _fetch(self, guild_id):
+        try:
+            doc = await self.database.guilds.find_one({"_id": guild_id},
+                                                      {"prefixes": 1})
+            bot = self.database.bot
+            if doc and doc.get("prefixes"):
+                self._store(bot, guild_id, doc["prefixes"])
+            elif bot.user is not None:
+                # Remember that the guild uses the global prefixes
+                self._remember(guild_id, self.base(bot))
+        finally:
+            self._fetching.discard(guild_id)
+
+    async def set(self, bot, guild, prefixes):
+        """Persists a guild's prefixes and updates the cache. An empty list
+        reverts the guild to the global prefixes"""
+        await bot.database.set_prefixes(guild, prefixes)
+        self._store(bot, guild.id, prefixes)
+        if not prefixes and bot.user is not None:
+            self._remember(guild.id, self.base(bot))
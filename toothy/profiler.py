@@ -0,0 +1,98 @@
+import asyncio
+import collections
+import os
+import sys
+import threading
+import time
+
+
+def frame_label(frame):
+    code = frame.f_code
+    name = getattr(code, "co_qualname", code.co_name)
+    return "{} ({}:{})".format(name, os.path.basename(code.co_filename),
+                               code.co_firstlineno)
+
+
+class ProfileResult:
+
+    def __init__(self, stacks, samples, duration):
+        self.stacks = stacks
+        self.samples = samples
+        self.duration = duration
+
+    def collapsed(self):
+        """Stacks in collapsed format, as consumed by flamegraph.pl
+        and speedscope"""
+        return "\n".join("{} {}".format(";".join(stack), count)
+                         for stack, count in self.stacks.most_common())
+
+    def top(self, limit=15):
+        """Returns (function, self samples, total samples) for the
+        functions seen most often at the top of a stack"""
+        own = collections.Counter()
+        total = collections.Counter()
+        for stack, count in self.stacks.items():
+            # First element is the thread/task label, not a function
+            frames = stack[1:]
+            if not frames:
+                continue
+            own[frames[-1]] += count
+            for label in set(frames):
+                total[label] += count
+        return [(label, count, total[label])
+                for label, count in own.most_common(limit)]
+
+    def summary(self, limit=15):
+        total = sum(self.stacks.values()) or 1
+        lines = [
+            "{} samples over {:.1f}s".format(self.samples, self.duration),
+            "  self%  total%  function"
+        ]
+        for label, own, cumulative in self.top(limit):
+            lines.append("{:6.1f} {:7.1f}  {}".format(100 * own / total,
+                                                       100 * cumulative / total,
+                                                       label))
+        return "\n".join(lines)
+
+
+class SamplingProfiler:
+    """Statistical profiler that periodically samples the stack of every
+    thread in the process.
+
+    Samples from the event loop thread are labelled with the task that was
+    running at the time, so coroutines show up under their task name."""
+
+    def __init__(self, loop, *, interval=0.005):
+        self.loop = loop
+        self.interval = interval
+
+    def run(self, duration):
+        """Blocks for duration seconds while sampling. Meant to be run in
+        an executor thread"""
+        own_id = threading.get_ident()
+        loop_id = getattr(self.loop, "_thread_id", None)
+        stacks = collections.Counter()
+        samples = 0
+        start = time.monotonic()
+        deadline = start + duration
+        while time.monotonic() < deadline:
+            names = {t.ident: t.name for t in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                if thread_id == loop_id:
+                    task = asyncio.current_task(self.loop)
+                    root = "loop:{}".format(
+                        task.get_name() if task else "<callback>")
+                else:
+                    root = "thread:{}".format(names.get(thread_id, thread_id))
+                stack = []
+                while frame is not None:
+                    stack.append(frame_label(frame))
+                    frame = frame.f_back
+                stack.append(root)
+                stack.reverse()
+                stacks[tuple(stack)] += 1
+            samples += 1
+            time.sleep(self.interval)
+        return ProfileResult(stacks, samples, time.monotonic() - start)
@@ -0,0 +1,31 @@
+import discord
+
+PROFILES = ("default", "lean")
+
+
+def client_options(profile, intents):
+    """Returns the client options of a memory profile.
+
+    default uses the configured intents and discord.py's caching. lean is
+    meant for large guild counts. It drops the members, presences and
+    typing intents, so the member cache only holds the bot itself and
+    members in voice channels, which the music cog needs. Guilds are not
+    chunked and messages are not cached. Role menus keep working as
+    interactions carry the invoking member and its roles."""
+    if profile == "default":
+        return {"intents": intents}
+    if profile != "lean":
+        raise ValueError("Unknown profile {}, expected one of {}".format(
+            profile, ", ".join(PROFILES)))
+    lean = discord.Intents._from_value(intents.value)
+    lean.guilds = True
+    lean.voice_states = True
+    lean.members = False
+    lean.presences = False
+    lean.typing = False
+    return {
+        "intents": lean,
+        "member_cache_flags": discord.MemberCacheFlags.from_intents(lean),
+        "chunk_guilds_at_startup": False,
+        "max_messages": None
+    }
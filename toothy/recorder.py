@@ -0,0 +1,211 @@
+import asyncio
+import gzip
+import hashlib
+import json
+import logging
+import os
+import re
+import time
+
+log = logging.getLogger(__name__)
+
+TRACE_VERSION = 1
+SNOWFLAKE = re.compile(r"^\d{15,21}$")
+# Connection events that can't be replayed without a gateway session
+SKIPPED_EVENTS = frozenset(("READY", "RESUMED"))
+# Integer strings that aren't ids
+PLAIN_NUMBERS = frozenset(("permissions", "app_permissions", "allow", "deny",
+                           "permissions_new", "nonce"))
+# Strings kept as is as they're needed to replay interactions and don't
+# identify anyone
+KEPT_STRINGS = frozenset(("custom_id", "locale", "guild_locale",
+                          "timestamp", "joined_at", "edited_timestamp",
+                          "premium_since", "communication_disabled_until"))
+
+
+class Anonymizer:
+    """Strips identifying data from gateway payloads while keeping their
+    shape.
+
+    Snowflakes are replaced by salted hashes, so the same id maps to the
+    same pseudonym throughout a trace. Other strings are replaced by
+    placeholders of the same length, except for command and option names
+    inside interaction data, which replaying needs."""
+
+    def __init__(self, salt=None):
+        self.salt = salt or os.urandom(16)
+
+    def snowflake(self, value):
+        digest = hashlib.blake2b(str(value).encode(),
+                                 digest_size=8,
+                                 key=self.salt).digest()
+        # Keep it in the range of real snowflakes
+        return str((int.from_bytes(digest, "big") >> 5) | (1 << 58))
+
+    def anonymize(self, event, data):
+        if event == "INTERACTION_CREATE":
+            data = dict(data)
+            interaction_data = data.pop("data", None)
+            data = self._walk(data, None, False)
+            if interaction_data is not None:
+                data["data"] = self._walk(interaction_data, None, True)
+            return data
+        return self._walk(data, None, False)
+
+    def _walk(self, value, key, keep_names):
+        if isinstance(value, dict):
+            # Resolved interaction data is keyed by id and holds the names
+            # of users and roles
+            return {
+                self.snowflake(k) if SNOWFLAKE.match(k) else k:
+                self._walk(v, k, keep_names and k != "resolved")
+                for k, v in value.items()
+            }
+        if isinstance(value, list):
+            return [self._walk(v, key, keep_names) for v in value]
+        if isinstance(value, str):
+            return self._string(value, key, keep_names)
+        if isinstance(value, int) and not isinstance(value, bool):
+            if key and (key == "id" or key.endswith("_id")) and value > 1e14:
+                return int(self.snowflake(value))
+        return value
+
+    def _string(self, value, key, keep_names):
+        if key in KEPT_STRINGS:
+            return value
+        if key == "name" and keep_names:
+            return value
+        if SNOWFLAKE.match(value) and key not in PLAIN_NUMBERS:
+            return self.snowflake(value)
+        if key in PLAIN_NUMBERS or key == "type":
+            return value
+        if key == "token":
+            return "token-" + self.snowflake(value)
+        return "x" * len(value)
+
+
+class TraceRecorder:
+    """Records anonymized gateway dispatches to a gzipped JSON lines file.
+
+    It wraps the connection state's parsers, so events are captured
+    exactly as discord.py receives them. Records are buffered and written
+    in an executor every flush_interval seconds. Recording stops after
+    max_events events.
+
+    path may contain {cluster} and {started}, which are filled in with the
+    cluster id and start time so each process and run gets its own file."""
+
+    def __init__(self,
+                 bot,
+                 *,
+                 path="logs/trace-{cluster}-{started}.jsonl.gz",
+                 events=None,
+                 max_events=1000000,
+                 flush_interval=5,
+                 enabled=True):
+        self.bot = bot
+        self.path = path
+        self.events = frozenset(events) if events else None
+        self.max_events = max_events
+        self.flush_interval = flush_interval
+        self.enabled = enabled
+        self.anonymizer = Anonymizer()
+        self.recorded = 0
+        self.started = None
+        self._buffer = []
+        self._originals = {}
+
+    def start(self):
+        if not self.enabled:
+            return
+        self.started = time.monotonic()
+        started = time.time()
+        cluster = self.bot.cluster.id if self.bot.cluster else 0
+        self.path = self.path.format(
+            cluster=cluster,
+            started=time.strftime("%Y%m%d-%H%M%S", time.gmtime(started)))
+        user = self.bot.user
+        self._buffer.append({
+            "version": TRACE_VERSION,
+            "started": started,
+            "cluster": cluster,
+            # Lets a replay map the bot's own pseudonym to its fake user
+            "user": self.anonymizer.snowflake(user.id) if user else None
+        })
+        parsers = self.bot._connection.parsers
+        for event, parser in list(parsers.items()):
+            if event in SKIPPED_EVENTS:
+                continue
+            if self.events is not None and event not in self.events:
+                continue
+            self._originals[event] = parser
+            parsers[event] = self._wrap(event, parser)
+        self.bot.tasks.spawn(name="toothy:recorder",
+                             owner="Toothy",
+                             factory=self._flush_loop)
+        log.info("Recording gateway events to {}".format(self.path))
+
+    def _wrap(self, event, parser):
+
+        def record(data):
+            if self.recorded < self.max_events:
+                self.recorded += 1
+                try:
+                    self._buffer.append({
+                        "t": round(time.monotonic() - self.started, 4),
+                        "e": event,
+                        "d": self.anonymizer.anonymize(event, data)
+                    })
+                except Exception as e:
+                    log.exception("Failed to record {}".format(event),
+                                  exc_info=e)
+            elif self._originals:
+                log.info("Recorded {} events, stopping".format(
+                    self.recorded))
+                self._restore()
+            return parser(data)
+
+        return record
+
+    def _restore(self):
+        parsers = self.bot._connection.parsers
+        parsers.update(self._originals)
+        self._originals.clear()
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    async def flush(self):
+        if not self._buffer:
+            return
+        records, self._buffer = self._buffer, []
+        await asyncio.get_running_loop().run_in_executor(
+            None, self._write, records)
+
+    def _write(self, records):
+        with gzip.open(self.path, "at", encoding="utf-8") as f:
+            for record in records:
+                f.write(json.dumps(record, separators=(",", ":")))
+                f.write("\n")
+
+    async def stop(self):
+        self._restore()
+        self.bot.tasks.cancel("toothy:recorder")
+        await self.flush()
+
+
+def read_header(path):
+    """Returns the header record of a trace"""
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        return json.loads(f.readline())
+
+
+def read_trace(path):
+    """Yields the records of a trace, skipping its header"""
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        for line in f:
+            record = json.loads(line)
+            if "e" in record:
+                yield record
@@ -0,0 +1,150 @@
+import contextvars
+import logging
+import time
+
+import discord
+
+log = logging.getLogger(__name__)
+
+_current_route = contextvars.ContextVar("toothy_rest_route", default=None)
+
+# discord.http's log messages, matched exactly
+RETRY_FORMAT = ("We are being rate limited. %s %s responded with 429. "
+                "Retrying in %.2f seconds.")
+TOO_LONG_FORMAT = ("We are being rate limited. %s %s responded with 429. "
+                   "Timeout of %.2f was too long, erroring instead.")
+GLOBAL_FORMAT = "Global rate limit has been hit. Retrying in %.2f seconds."
+
+
+class RouteStats:
+    """Counters for one REST route, e.g. PATCH /channels/{channel_id}"""
+
+    __slots__ = ("requests", "errors", "ratelimited", "exhausted",
+                 "retry_after", "remaining", "limit", "bucket")
+
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        self.ratelimited = 0
+        self.exhausted = 0
+        self.retry_after = 0.0
+        self.remaining = None
+        self.limit = None
+        self.bucket = None
+
+
+class RestTracker(logging.Filter):
+    """Instruments the bot's HTTP client per route.
+
+    Requests are counted and timed, including time spent waiting on rate
+    limits, and the remaining budget of their bucket is read afterwards.
+    discord.py retries 429 responses internally and only logs them, so
+    the tracker also filters discord.http's records and attributes them
+    to the route requested by the current task. A global rate limit is
+    logged right after the route's own 429 record, so a route's 429s are
+    only counted once its request ends and global ones aren't counted
+    twice."""
+
+    def __init__(self, bot):
+        super().__init__()
+        self.bot = bot
+        self.metrics = bot.metrics
+        self.routes = {}
+        self.global_ratelimited = 0
+        self._request = None
+
+    def install(self):
+        http = self.bot.http
+        self._request = http.request
+        http.request = self.request
+        logging.getLogger("discord.http").addFilter(self)
+
+    def uninstall(self):
+        if self._request is None:
+            return
+        self.bot.http.request = self._request
+        self._request = None
+        logging.getLogger("discord.http").removeFilter(self)
+
+    def stats(self, route_key):
+        try:
+            return self.routes[route_key]
+        except KeyError:
+            stats = self.routes[route_key] = RouteStats()
+            return stats
+
+    async def request(self, route, *args, **kwargs):
+        stats = self.stats(route.key)
+        stats.requests += 1
+        self.metrics.incr("rest.requests")
+        waits = []
+        token = _current_route.set((route.key, stats, waits))
+        start = time.perf_counter()
+        try:
+            return await self._request(route, *args, **kwargs)
+        except discord.HTTPException as e:
+            stats.errors += 1
+            self.metrics.incr("rest.errors.{}".format(e.status))
+            raise
+        finally:
+            _current_route.reset(token)
+            for retry_after in waits:
+                self._count_ratelimit(route.key, stats, retry_after)
+            self.metrics.observe("rest.latency.{}".format(route.key),
+                                 time.perf_counter() - start)
+            self._read_bucket(route, stats)
+
+    def _read_bucket(self, route, stats):
+        http = self.bot.http
+        bucket = http._bucket_hashes.get(route.key)
+        ratelimit = http._buckets.get("{}:{}".format(
+            bucket or route.key, route.major_parameters))
+        if ratelimit is None:
+            return
+        stats.bucket = bucket
+        stats.remaining = ratelimit.remaining
+        stats.limit = ratelimit.limit
+        self.metrics.gauge("rest.remaining.{}".format(route.key),
+                           ratelimit.remaining)
+        if ratelimit.remaining <= 0:
+            stats.exhausted += 1
+            self.metrics.incr("rest.exhausted.{}".format(route.key))
+
+    def _count_ratelimit(self, route_key, stats, retry_after=None):
+        stats.ratelimited += 1
+        self.metrics.incr("rest.ratelimited.{}".format(route_key))
+        if retry_after is not None:
+            stats.retry_after += retry_after
+            self.metrics.observe("rest.retry_after", retry_after)
+
+    def filter(self, record):
+        message = record.msg
+        current = _current_route.get()
+        if message == RETRY_FORMAT:
+            if current:
+                current[2].append(record.args[-1])
+            else:
+                self._count_ratelimit("unknown", self.stats("unknown"),
+                                      record.args[-1])
+        elif message == TOO_LONG_FORMAT:
+            # discord.py raises RateLimited instead of waiting
+            route_key, stats, _ = current or ("unknown", self.stats("unknown"),
+                                              None)
+            self._count_ratelimit(route_key, stats)
+        elif message == GLOBAL_FORMAT:
+            if current and current[2]:
+                current[2].pop()
+            self.global_ratelimited += 1
+            self.metrics.incr("rest.ratelimited.global")
+            self.metrics.observe("rest.retry_after", record.args[-1])
+        return True
+
+    def report(self, sort="requests", limit=15):
+        """Returns the busiest routes as (route key, stats, p90 latency)"""
+        routes = sorted(self.routes.items(),
+                        key=lambda item: getattr(item[1], sort),
+                        reverse=True)[:limit]
+        return [(key, stats,
+                 self.metrics.percentiles("rest.latency.{}".format(key),
+                                          (90, )).get(90, 0))
+                for key, stats in routes]
@@ -0,0 +1,156 @@
+import asyncio
+import contextlib
+import copy
+import json
+import logging
+import os
+import shutil
+import tempfile
+
+log = logging.getLogger(__name__)
+
+
+@contextlib.contextmanager
+def file_lock(path):
+    """Holds an exclusive lock on path, created if missing, which other
+    processes taking it wait for"""
+    with open(path, mode="a+") as f:
+        try:
+            import fcntl
+        except ImportError:
+            import msvcrt
+            f.seek(0)
+            # Retries for ten seconds before raising OSError
+            msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+            try:
+                yield
+            finally:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+            return
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+class SettingsFile:
+    """A JSON settings file whose parsed contents are kept in memory.
+
+    Changes are flushed after a short delay so bursts of edits result in
+    a single write. Writes happen in an executor, into a temporary file
+    that then replaces the original, so a crash never leaves a truncated
+    file behind. Every cluster process has its own copy of the file, so a
+    write re-reads it and only replaces the keys changed here."""
+
+    def __init__(self, path, data=None, *, delay=1.0):
+        self.path = path
+        self.delay = delay
+        self.data = data
+        self._changed = set()
+        self._flush_task = None
+        self._lock = asyncio.Lock()
+
+    async def load(self, default=None):
+        """Reads the file. Falls back to default, which is then written
+        out, if it's missing or invalid"""
+        loop = asyncio.get_running_loop()
+        try:
+            self.data = await loop.run_in_executor(None, self._read)
+        except (OSError, ValueError) as e:
+            log.warning("Could not read {}, using defaults".format(self.path),
+                        exc_info=e)
+            self.data = dict(default or {})
+            self.schedule_flush(self.data)
+        return self.data
+
+    def _read(self):
+        with open(self.path, encoding="utf-8", mode="r") as f:
+            return json.load(f)
+
+    def _write(self, changes):
+        # Held until the file is replaced, so a process writing at the
+        # same time re-reads it with these changes in
+        with file_lock(self.path + ".lock"):
+            try:
+                data = self._read()
+            except (OSError, ValueError):
+                data = {}
+            data.update(changes)
+            self._replace(json.dumps(data, indent=4, sort_keys=True))
+
+    def _replace(self, payload):
+        # A unique name per write, as several cluster processes may save
+        # the same file at once
+        directory, name = os.path.split(self.path)
+        fd, tmp_path = tempfile.mkstemp(prefix=name + ".",
+                                        suffix=".tmp",
+                                        dir=directory or ".")
+        try:
+            with open(fd, encoding="utf-8", mode="w") as f:
+                f.write(payload)
+                f.flush()
+                os.fsync(f.fileno())
+            try:
+                # mkstemp creates the file readable by the owner only
+                shutil.copymode(self.path, tmp_path)
+            except OSError:
+                pass
+            os.replace(tmp_path, self.path)
+        except BaseException:
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+            raise
+
+    def __getitem__(self, key):
+        return self.data[key]
+
+    def __setitem__(self, key, value):
+        self.data[key] = value
+        self.schedule_flush([key])
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def get(self, key, default=None):
+        return self.data.get(key, default)
+
+    def items(self):
+        return self.data.items()
+
+    def update(self, *args, **kwargs):
+        changes = dict(*args, **kwargs)
+        self.data.update(changes)
+        self.schedule_flush(changes)
+
+    def schedule_flush(self, keys):
+        """Marks keys as changed and flushes them after the delay"""
+        self._changed.update(keys)
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.get_running_loop().create_task(
+                self._delayed_flush())
+
+    async def _delayed_flush(self):
+        await asyncio.sleep(self.delay)
+        try:
+            await self.flush()
+        except Exception as e:
+            log.exception("Failed to write {}".format(self.path), exc_info=e)
+
+    async def flush(self):
+        """Writes pending changes now"""
+        async with self._lock:
+            if not self._changed:
+                return
+            keys, self._changed = self._changed, set()
+            # Copied so later edits can't change them mid-write
+            changes = copy.deepcopy({key: self.data[key] for key in keys})
+            try:
+                await asyncio.get_running_loop().run_in_executor(
+                    None, self._write, changes)
+            except Exception:
+                self._changed |= keys
+                raise
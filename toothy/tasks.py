@@ -0,0 +1,140 @@
+import asyncio
+import collections
+import logging
+import time
+
+log = logging.getLogger(__name__)
+
+
+class SupervisedTask:
+
+    def __init__(self, name, owner, coro, factory, restart):
+        self.name = name
+        self.owner = owner
+        self.coro = coro
+        self.factory = factory
+        self.restart = restart
+        self.restarts = 0
+        self.started = time.monotonic()
+        self.task = None
+
+
+class TaskSupervisor:
+    """Names and tracks long-lived background tasks.
+
+    Every task belongs to an owner, usually a cog's qualified name, so
+    they can be counted and cancelled together. Task names are unique;
+    spawning a task under a name that is still running cancels the old
+    one. Tasks spawned with a factory are restarted with exponential
+    backoff when they crash."""
+
+    def __init__(self, bot, *, leak_threshold=1000, max_backoff=300):
+        self.bot = bot
+        self.leak_threshold = leak_threshold
+        self.max_backoff = max_backoff
+        self.tasks = {}
+        self.live = collections.Counter()
+        self._warned = set()
+
+    def spawn(self, coro=None, *, name, owner, factory=None):
+        """Starts coro, or factory() if given, which is then called again
+        to restart the task after a crash"""
+        if (coro is None) == (factory is None):
+            raise TypeError("Pass either a coroutine or a factory")
+        self.cancel(name)
+        entry = SupervisedTask(name, owner, coro, factory, factory is not None)
+        entry.task = asyncio.get_running_loop().create_task(self._run(entry),
+                                                            name=name)
+        self.tasks[name] = entry
+        self.live[owner] += 1
+        self.bot.metrics.incr("tasks.spawned")
+        self._check_leaks(owner)
+        return entry.task
+
+    async def _run(self, entry):
+        backoff = 1
+        try:
+            while True:
+                coro = entry.coro if entry.coro else entry.factory()
+                entry.coro = None
+                started = time.monotonic()
+                try:
+                    return await coro
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    self.bot.metrics.incr("tasks.crashed")
+                    if not entry.restart:
+                        log.exception("Task {} crashed".format(entry.name),
+                                      exc_info=e)
+                        return
+                    if time.monotonic() - started > 60:
+                        backoff = 1
+                    log.exception("Task {} crashed, restarting in {}s".format(
+                        entry.name, backoff),
+                                  exc_info=e)
+                    entry.restarts += 1
+                    await asyncio.sleep(backoff)
+                    backoff = min(backoff * 2, self.max_backoff)
+        finally:
+            if self.tasks.get(entry.name) is entry:
+                del self.tasks[entry.name]
+                self._forget(entry)
+
+    def get(self, name):
+        entry = self.tasks.get(name)
+        return entry.task if entry else None
+
+    def cancel(self, name):
+        entry = self.tasks.pop(name, None)
+        if not entry:
+            return
+        self._forget(entry)
+        if entry.task is not asyncio.current_task():
+            entry.task.cancel()
+
+    def cancel_owner(self, owner):
+        names = [
+            name for name, entry in self.tasks.items() if entry.owner == owner
+        ]
+        for name in names:
+            self.cancel(name)
+        if names:
+            log.info("Cancelled {} tasks of {}".format(len(names), owner))
+        return len(names)
+
+    async def close(self):
+        tasks = [entry.task for entry in self.tasks.values()]
+        self.tasks.clear()
+        for owner in list(self.live):
+            del self.live[owner]
+            self._check_leaks(owner)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def counts(self):
+        return collections.Counter(entry.owner
+                                   for entry in self.tasks.values())
+
+    def owned_by(self, owner):
+        return [
+            entry for entry in self.tasks.values() if entry.owner == owner
+        ]
+
+    def _forget(self, entry):
+        self.live[entry.owner] -= 1
+        if self.live[entry.owner] <= 0:
+            del self.live[entry.owner]
+        self._check_leaks(entry.owner)
+
+    def _check_leaks(self, owner):
+        count = self.live[owner]
+        self.bot.metrics.gauge("tasks.live." + owner, count)
+        if count > self.leak_threshold:
+            if owner not in self._warned:
+                self._warned.add(owner)
+                log.warning("{} has {} live tasks, possible leak".format(
+                    owner, count))
+        else:
+            self._warned.discard(owner)
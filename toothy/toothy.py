@@ -1,14 +1,34 @@
+import asyncio
 import datetime
+import hashlib
+import importlib.machinery
 import json
 import logging
 import sys
+import time
 
-import aiohttp
 import discord
 from discord.ext import commands
 from discord import app_commands
 
 from .database import MongoController
+from .extensions import DependencyCycle
+from .extensions import ImportTimer
+from .extensions import PreimportedLoader
+from .extensions import StartupReport
+from .extensions import dependency_waves
+from .extensions import import_extension
+from .governor import LoadGovernor
+from .metrics import Metrics
+from .prefixes import PrefixResolver
+from .profiles import client_options
+from .recorder import TraceRecorder
+from .rest import RestTracker
+from .settings import SettingsFile
+from .tasks import TaskSupervisor
+from .tree import ToothyTree
+from .watchdog import LoopWatchdog
+from .webclient import WebClient
 
 log = logging.getLogger(__name__)
 
@@ -24,6 +44,17 @@ try:
         INTENTS = discord.Intents(**data["INTENTS"])
         TEST_GUILD = data["TEST_GUILD"]
         DEBUG = data.get("DEBUG", False)
+        WATCHDOG_SETTINGS = data.get("WATCHDOG", {})
+        LOG_SETTINGS = data.get("LOGGING", {})
+        IMPORT_BUDGET = data.get("IMPORT_BUDGET", 1.0)
+        PREFIX_CACHE_SIZE = data.get("PREFIX_CACHE_SIZE", 10000)
+        TASK_LEAK_THRESHOLD = data.get("TASK_LEAK_THRESHOLD", 1000)
+        ADMISSION_SETTINGS = data.get("ADMISSION", {})
+        DEFER_AFTER = data.get("DEFER_AFTER", 2.0)
+        GOVERNOR_SETTINGS = data.get("GOVERNOR", {})
+        RECORDER_SETTINGS = data.get("RECORDER", {})
+        PROFILE = data.get("PROFILE", "default")
+        WEB_SETTINGS = data.get("WEB", {})
 except Exception:
     print("Config.json is not valid. Make sure you copied the example "
           "and renamed it.")
@@ -36,29 +67,45 @@ if not TOKEN:
 
 class Toothy(commands.AutoShardedBot):
 
-    def __init__(self):
-
-        def prefix_callable(bot, message):
-            prefix = self.global_prefixes
-            return prefix + [
-                "<@!{.user.id}> ".format(self), self.user.mention + " "
-            ]
-
+    def __init__(self, *, cluster=None, **kwargs):
+        self.prefixes = PrefixResolver(data["PREFIXES"],
+                                       max_size=PREFIX_CACHE_SIZE)
+        options = client_options(PROFILE, INTENTS)
+        options.update(kwargs)
         super().__init__(
-            command_prefix=prefix_callable,
+            command_prefix=self.prefixes,
             description=DESCRIPTION,
             owner_id=OWNER_ID,
             case_insensitive=CASE_INSENSITIVE,
-            intents=INTENTS,
-        )
+            tree_cls=ToothyTree,
+            **options)
+        self.profile = PROFILE
+        self.tree.configure(**ADMISSION_SETTINGS)
+        self.defer_after = DEFER_AFTER
         self.database = MongoController(self, DB_SETTINGS)
         self.available = True
-        self.global_prefixes = data["PREFIXES"]
         self.uptime = datetime.datetime.utcnow()
         self.color = discord.Color(COLOR)
         self.session = None
         self.test_guild = TEST_GUILD
         self.uptime = datetime.datetime.utcnow()
+        self.metrics = Metrics()
+        self.rest = RestTracker(self)
+        self.rest.install()
+        self.web = WebClient(self, **WEB_SETTINGS)
+        self.tasks = TaskSupervisor(self, leak_threshold=TASK_LEAK_THRESHOLD)
+        self.watchdog = LoopWatchdog(self, **WATCHDOG_SETTINGS)
+        self.governor = LoadGovernor(self, **GOVERNOR_SETTINGS)
+        self.recorder = None
+        if RECORDER_SETTINGS.get("enabled", False):
+            self.recorder = TraceRecorder(self, **RECORDER_SETTINGS)
+        self.cluster = cluster
+        self.startup = StartupReport()
+        # Modules imported by load_extensions that are yet to be set up
+        self.preimported = {}
+        self.extensions_file = SettingsFile("settings/extensions.json")
+        self.config_file = SettingsFile("settings/config.json", data)
+        self.cog_states = {}
 
         @self.tree.error
         async def on_app_command_error(
@@ -114,28 +161,237 @@ class Toothy(commands.AutoShardedBot):
                 await interaction.followup.send(msg, ephemeral=True)
 
     async def setup_hook(self):
-        self.session = aiohttp.ClientSession(loop=self.loop)
+        self.startup.mark("login")
+        self.watchdog.start()
+        self.governor.start()
+        if self.recorder:
+            self.recorder.start()
+        # Extensions using the session directly share the client's limits
+        self.session = self.web.start()
+        if self.cluster:
+            self.cluster.add_handler("stats", self.cluster_stats)
+            self.cluster.add_handler("reload_extension",
+                                     self.cluster_reload_extension)
+            # The supervisor restarts the worker once it exits
+            self.cluster.on_lost = self.close
+            await self.cluster.connect()
         try:
-            with open("settings/extensions.json", encoding="utf-8",
-                      mode="r") as f:
-                extensions = json.load(f)
-        except Exception:
-            extensions = {"cogs.owner": True}
-        for name, state in extensions.items():
-            if state:
-                try:
-                    await self.load_extension(name)
-                except Exception as e:
-                    log.exception("Failed to load {}".format(name), exc_info=e)
-                    state = False
+            await self.prefixes.load(self)
+        except Exception as e:
+            log.exception("Failed to load guild prefixes", exc_info=e)
+        extensions = await self.extensions_file.load({"cogs.owner": True})
+        self.startup.begin("extensions")
+        await self.load_extensions(
+            [name for name, state in extensions.items() if state])
+        self.startup.end("extensions")
         owner_cog = self.get_cog("Owner")
         if not owner_cog:
             print("Owner cog not loaded, exiting")
             sys.exit(1)
-        with open("settings/extensions.json", encoding="utf-8", mode="w") as f:
-            f.write(json.dumps(extensions, indent=4, sort_keys=True))
+        self.startup.mark("setup_hook done")
+        if self.shard_ids is None or 0 in self.shard_ids:
+            self.tasks.spawn(self.startup_sync(),
+                             name="toothy:command-sync",
+                             owner="Toothy")
+
+    async def load_extensions(self, names):
+        """Loads extensions concurrently.
+
+        Modules are first imported in executor threads, which also reveals
+        their DEPENDENCIES - a list of extensions that have to be loaded
+        before them. Extensions are then set up from those modules in
+        dependency order, each wave concurrently. Extensions with circular
+        dependencies are skipped."""
+        loop = asyncio.get_running_loop()
+        with ImportTimer() as timer:
+            results = await asyncio.gather(
+                *(loop.run_in_executor(None, import_extension, name)
+                  for name in names),
+                return_exceptions=True)
+        self.startup.modules = timer.top()
+        dependencies = {}
+        for name, result in zip(names, results):
+            timing = self.startup.extension(name)
+            if isinstance(result, BaseException):
+                timing.error = "{}: {}".format(type(result).__name__, result)
+                log.error("Failed to import {}".format(name), exc_info=result)
+                continue
+            module, timing.import_time = result
+            if timing.import_time > IMPORT_BUDGET:
+                log.warning("Importing {} took {:.3f}s, over the {}s "
+                            "budget".format(name, timing.import_time,
+                                            IMPORT_BUDGET))
+            dependencies[name] = list(getattr(module, "DEPENDENCIES", ()))
+            self.preimported[name] = module
+        failed = set(names) - set(dependencies)
+        try:
+            waves = dependency_waves(dependencies)
+        except DependencyCycle as e:
+            log.error("Not loading extensions with circular "
+                      "dependencies: {}".format(", ".join(e.blocked)))
+            for name in e.blocked:
+                failed.add(name)
+                self.startup.extension(name).error = "circular dependency"
+                del dependencies[name]
+                self.preimported.pop(name, None)
+            waves = dependency_waves(dependencies)
+        for wave in waves:
+            ready = []
+            for name in wave:
+                missing = failed.intersection(dependencies[name])
+                if missing:
+                    failed.add(name)
+                    self.startup.extension(name).error = (
+                        "dependency {} not loaded".format(", ".join(missing)))
+                    continue
+                ready.append(name)
+            results = await asyncio.gather(
+                *(self._timed_load_extension(name) for name in ready),
+                return_exceptions=True)
+            for name, result in zip(ready, results):
+                if isinstance(result, BaseException):
+                    failed.add(name)
+                    self.startup.extension(name).error = "{}: {}".format(
+                        type(result).__name__, result)
+                    log.exception("Failed to load {}".format(name),
+                                  exc_info=result)
+        self.preimported.clear()
+
+    async def hot_reload_extension(self, name):
+        """Reloads an extension while keeping its cogs' runtime state.
+
+        Cogs opt in by defining export_state, returning anything they want
+        to keep. While it is being handed over, is_handing_over is true
+        for the old cog so cog_unload can skip tearing that state down,
+        and the new cog picks it up with pop_cog_state in cog_load."""
+        for cog in list(self.cogs.values()):
+            export = getattr(cog, "export_state", None)
+            if export and (cog.__module__ == name
+                           or cog.__module__.startswith(name + ".")):
+                self.cog_states[cog.qualified_name] = export()
+        try:
+            await self.reload_extension(name)
+        finally:
+            for cog_name in list(self.cog_states):
+                log.warning("State of {} was not adopted after "
+                            "reload".format(cog_name))
+            self.cog_states.clear()
+
+    async def remove_cog(self, name, **kwargs):
+        cog = self.get_cog(name)
+        handing_over = cog is not None and self.is_handing_over(cog)
+        removed = await super().remove_cog(name, **kwargs)
+        # Tasks of a cog being hot reloaded are handed over with its state
+        if removed is not None and not handing_over:
+            self.tasks.cancel_owner(removed.qualified_name)
+        return removed
+
+    def is_handing_over(self, cog):
+        return cog.qualified_name in self.cog_states
+
+    def pop_cog_state(self, cog):
+        return self.cog_states.pop(cog.qualified_name, None)
+
+    async def _load_from_module_spec(self, spec, key):
+        # Set up modules imported by load_extensions without executing them
+        # again
+        module = self.preimported.pop(key, None)
+        if module is None or sys.modules.get(key) is not module:
+            return await super()._load_from_module_spec(spec, key)
+        preimported = importlib.machinery.ModuleSpec(
+            key, PreimportedLoader(module), origin=spec.origin)
+        try:
+            await super()._load_from_module_spec(preimported, key)
+        finally:
+            module.__spec__ = spec
+
+    async def _timed_load_extension(self, name):
+        start = time.perf_counter()
+        await self.load_extension(name)
+        self.startup.extension(name).setup_time = (time.perf_counter() -
+                                                   start)
+
+    def command_tree_hash(self, guild=None):
+        """Stable hash of the command payloads that a sync would upload"""
+        commands = sorted(self.tree.get_commands(guild=guild),
+                          key=lambda c: (type(c).__name__, c.name))
+        payload = json.dumps([c.to_dict(self.tree) for c in commands],
+                             sort_keys=True)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    async def sync_command_tree(self, guild=None, *, force=False):
+        """Syncs the command tree of the guild, or the global one if guild
+        is None, unless it's unchanged since the last sync.
+        Without a guild, the test guild's own commands are synced too.
+        Returns whether anything was synced."""
+        if guild is None:
+            targets = [None]
+            if self.test_guild:
+                test_guild = discord.Object(id=self.test_guild)
+                if self.tree.get_commands(guild=test_guild):
+                    targets.append(test_guild)
+        else:
+            targets = [guild]
+        doc = await self.database.configs.find_one(
+            {"cog_name": "Toothy"}, {"command_tree_hashes": 1})
+        hashes = (doc or {}).get("command_tree_hashes", {})
+        synced = False
+        for target in targets:
+            key = "global" if target is None else str(target.id)
+            digest = self.command_tree_hash(target)
+            if not force and hashes.get(key) == digest:
+                continue
+            await self.tree.sync(guild=target)
+            await self.database.configs.update_one(
+                {"cog_name": "Toothy"},
+                {"$set": {
+                    "command_tree_hashes." + key: digest
+                }},
+                upsert=True)
+            log.info("Synced {} command tree".format(key))
+            synced = True
+        return synced
+
+    async def startup_sync(self):
+        try:
+            await self.sync_command_tree()
+        except Exception as e:
+            log.exception("Failed to sync command tree", exc_info=e)
+
+    @property
+    def global_prefixes(self):
+        return self.prefixes.global_prefixes
+
+    @global_prefixes.setter
+    def global_prefixes(self, prefixes):
+        self.prefixes.global_prefixes = prefixes
+
+    async def before_identify_hook(self, shard_id, *, initial=False):
+        if self.cluster and await self.cluster.before_identify(shard_id):
+            return
+        await super().before_identify_hook(shard_id, initial=initial)
+
+    async def cluster_stats(self):
+        return {
+            "guilds": len(self.guilds),
+            "users": len(self.users),
+            "shards": len(self.shards),
+            "latency": self.latency,
+            "voice_clients": len(self.voice_clients)
+        }
+
+    async def cluster_reload_extension(self, name):
+        try:
+            await self.hot_reload_extension(name)
+        except Exception as e:
+            return "{}: {}".format(type(e).__name__, e)
+        return "Reloaded"
 
     async def on_ready(self):
+        if "ready" not in self.startup.phases:
+            self.startup.mark("ready")
+            self.startup.record_rss()
+            log.info("Startup report:\n{}".format(self.startup.format()))
         print("Toothy ready")
         print("Serving {} guilds".format(len(self.guilds)))
 
@@ -149,16 +405,20 @@ class Toothy(commands.AutoShardedBot):
 
     async def close(self):
         await super().close()
-        if self.session:
-            await self.session.close()
+        self.rest.uninstall()
+        self.watchdog.stop()
+        if self.recorder:
+            await self.recorder.stop()
+        await self.tasks.close()
+        await self.web.close()
+        if self.cluster:
+            await self.cluster.close()
+        await self.extensions_file.flush()
+        await self.config_file.flush()
 
     def save_config(self):
-        with open("settings/config.json", encoding="utf-8", mode="r") as f:
-            data = json.load(f)
-        data["DESCRIPTION"] = (DESCRIPTION, )
-        data["PREFIXES"] = self.global_prefixes
-        with open("settings/config.json", encoding="utf-8", mode="w") as f:
-            f.write(json.dumps(data, indent=4, sort_keys=True))
+        self.config_file.update(DESCRIPTION=DESCRIPTION,
+                                PREFIXES=self.global_prefixes)
 
     async def start(self):
         await super().start(TOKEN)
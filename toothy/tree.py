@@ -0,0 +1,104 @@
+import asyncio
+import logging
+
+import discord
+from discord import app_commands
+
+from .admission import AdmissionRejected
+from .admission import AdmissionScheduler
+from .deferral import guard
+
+log = logging.getLogger(__name__)
+
+
+class ToothyTree(app_commands.CommandTree):
+    """Command tree that admits interactions through an
+    AdmissionScheduler before dispatching them.
+
+    Autocomplete is low priority: it is shed outright while the event loop
+    lags behind by more than shed_lag seconds and dropped if it can't be
+    admitted within autocomplete_timeout, as Discord stops waiting for the
+    choices shortly after anyway. Commands are covered by the deferral
+    guard from before they are queued, so a long wait still gets deferred,
+    and are turned away if no slot frees up within command_timeout."""
+
+    def __init__(self, client, **kwargs):
+        super().__init__(client, **kwargs)
+        self.admission = AdmissionScheduler()
+        self.shed_lag = 0.5
+        self.autocomplete_timeout = 2.0
+        self.command_timeout = 60.0
+
+    def configure(self,
+                  *,
+                  shed_lag=0.5,
+                  autocomplete_timeout=2.0,
+                  command_timeout=60.0,
+                  **admission_settings):
+        self.shed_lag = shed_lag
+        self.autocomplete_timeout = autocomplete_timeout
+        self.command_timeout = command_timeout
+        self.admission = AdmissionScheduler(**admission_settings)
+
+    async def _call(self, interaction):
+        metrics = self.client.metrics
+        autocomplete = (
+            interaction.type is discord.InteractionType.autocomplete)
+        if autocomplete and self.client.watchdog.lag > self.shed_lag:
+            metrics.incr("interactions.shed")
+            await self._respond_busy(interaction)
+            return
+        key = interaction.guild_id or interaction.user.id
+        guarded = None
+        if autocomplete:
+            timeout = self.autocomplete_timeout
+        else:
+            timeout = self.command_timeout
+            guarded = guard(interaction, self.client.defer_after)
+        admission = self.admission
+        try:
+            waited = await admission.acquire(key, timeout=timeout)
+        except AdmissionRejected:
+            metrics.incr("interactions.rejected")
+            log.warning("Rejected interaction in {}, queue full".format(key))
+            await self._turn_away(interaction, guarded)
+            return
+        except asyncio.TimeoutError:
+            metrics.incr("interactions.shed")
+            if guarded:
+                log.warning("Timed out queueing interaction in {}".format(key))
+                await self._turn_away(interaction, guarded)
+            return
+        except BaseException:
+            if guarded:
+                guarded.cancel()
+            raise
+        finally:
+            metrics.gauge("interactions.in_flight", admission.running)
+            metrics.gauge("interactions.queued", admission.queued)
+        metrics.observe("interactions.queue_delay", waited)
+        try:
+            await super()._call(interaction)
+        finally:
+            if guarded:
+                guarded.cancel()
+            admission.release(key)
+
+    async def _turn_away(self, interaction, guarded):
+        # A deferral already under way holds the response lock, so the
+        # message below goes out as a followup after it
+        if guarded:
+            guarded.cancel()
+        await self._respond_busy(interaction)
+
+    async def _respond_busy(self, interaction):
+        try:
+            if interaction.type is discord.InteractionType.autocomplete:
+                await interaction.response.autocomplete([])
+            else:
+                await interaction.response.send_message(
+                    "Too many commands are running in this server right "
+                    "now. Please try again in a moment.",
+                    ephemeral=True)
+        except discord.HTTPException:
+            pass
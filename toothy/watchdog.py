@@ -0,0 +1,76 @@
+import asyncio
+import collections
+import datetime
+import logging
+import sys
+import threading
+import time
+import traceback
+
+log = logging.getLogger(__name__)
+
+
+class LoopWatchdog:
+    """Measures event loop lag and samples the stack of blocking callbacks.
+
+    A heartbeat coroutine records how late each of its wakeups is. A
+    separate thread watches the heartbeat, and when it stops for longer
+    than the threshold, grabs the loop thread's current frame so the
+    offending callback can be found."""
+
+    def __init__(self, bot, *, interval=0.5, threshold=0.25):
+        self.bot = bot
+        self.interval = interval
+        self.threshold = threshold
+        self.lag = 0.0
+        self.stalls = collections.deque(maxlen=25)
+        self._last_beat = time.monotonic()
+        self._loop_thread_id = None
+        self._thread = None
+        self._stop = threading.Event()
+
+    def start(self):
+        self._loop_thread_id = threading.get_ident()
+        self._last_beat = time.monotonic()
+        self._stop.clear()
+        self.bot.tasks.spawn(name="toothy:watchdog",
+                             owner="Toothy",
+                             factory=self._beat)
+        self._thread = threading.Thread(target=self._watch,
+                                        name="toothy-watchdog",
+                                        daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self.bot.tasks.cancel("toothy:watchdog")
+
+    async def _beat(self):
+        while True:
+            start = time.monotonic()
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            self.lag = max(now - start - self.interval, 0.0)
+            self._last_beat = now
+            self.bot.metrics.observe("loop.lag", self.lag)
+
+    def _watch(self):
+        reported = None
+        while not self._stop.wait(self.threshold / 2):
+            beat = self._last_beat
+            blocked = time.monotonic() - beat - self.interval
+            if blocked < self.threshold or beat == reported:
+                continue
+            reported = beat
+            frame = sys._current_frames().get(self._loop_thread_id)
+            if frame is None:
+                continue
+            stack = "".join(traceback.format_stack(frame))
+            self.stalls.append({
+                "time": datetime.datetime.now(datetime.timezone.utc),
+                "blocked": blocked,
+                "stack": stack
+            })
+            self.bot.metrics.incr("loop.stalls")
+            log.warning("Event loop blocked for over {:.3f}s, currently in:"
+                        "\n{}".format(blocked, stack))
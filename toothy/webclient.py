@@ -0,0 +1,257 @@
+import asyncio
+import collections
+import json
+import logging
+import random
+import re
+import time
+
+import aiohttp
+from yarl import URL
+
+log = logging.getLogger(__name__)
+
+IDEMPOTENT_METHODS = frozenset(("GET", "HEAD", "OPTIONS", "PUT", "DELETE"))
+RETRY_STATUSES = frozenset((429, 500, 502, 503, 504))
+# Statuses that are cacheable by default per RFC 7231. A 404 tells as much
+# as a 200 for lookups like SponsorBlock's, where most videos have none
+CACHEABLE_STATUSES = frozenset((200, 203, 204, 300, 301, 404, 405, 410,
+                                414, 501))
+MAX_AGE = re.compile(r"max-age=(\d+)")
+
+Response = collections.namedtuple("Response", "status headers data")
+
+
+class WebClientError(Exception):
+    """A request failed after exhausting its retries or deadline"""
+
+    def __init__(self, host, message):
+        super().__init__("{}: {}".format(host, message))
+        self.host = host
+
+
+class HostBusy(WebClientError):
+    """Too many requests are already waiting on the host"""
+
+
+class HostLimit:
+
+    def __init__(self, concurrency, queue):
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.queue = queue
+        self.waiting = 0
+        self.in_flight = 0
+
+
+class WebClient:
+    """Shared HTTP client for third-party APIs.
+
+    Each host gets a concurrency cap and a bounded queue, so a slow API
+    fails fast instead of piling up coroutines. Requests have a deadline
+    covering queueing and retries. Idempotent requests are retried with
+    jittered exponential backoff on connection errors, timeouts, 429 and
+    5xx responses. GET responses, including negative ones like 404, can be
+    cached for cache_ttl seconds, shortened by the response's
+    Cache-Control header."""
+
+    def __init__(self,
+                 bot,
+                 *,
+                 timeout=10,
+                 retries=2,
+                 backoff=0.5,
+                 per_host=8,
+                 host_queue=50,
+                 connections=100,
+                 dns_ttl=300,
+                 cache_size=1000):
+        self.bot = bot
+        self.metrics = bot.metrics
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.per_host = per_host
+        self.host_queue = host_queue
+        self.connections = connections
+        self.dns_ttl = dns_ttl
+        self.cache_size = cache_size
+        self.cache = collections.OrderedDict()
+        self.hosts = {}
+        self.session = None
+
+    def start(self):
+        connector = aiohttp.TCPConnector(limit=self.connections,
+                                         limit_per_host=self.per_host,
+                                         ttl_dns_cache=self.dns_ttl)
+        self.session = aiohttp.ClientSession(connector=connector)
+        return self.session
+
+    async def close(self):
+        if self.session:
+            await self.session.close()
+
+    def host_limit(self, host):
+        try:
+            return self.hosts[host]
+        except KeyError:
+            limit = self.hosts[host] = HostLimit(self.per_host,
+                                                 self.host_queue)
+            return limit
+
+    async def get(self, url, **kwargs):
+        return await self.request("GET", url, **kwargs)
+
+    async def post(self, url, **kwargs):
+        return await self.request("POST", url, **kwargs)
+
+    async def request(self,
+                      method,
+                      url,
+                      *,
+                      params=None,
+                      headers=None,
+                      json_body=None,
+                      data=None,
+                      timeout=None,
+                      retries=None,
+                      cache_ttl=0):
+        """Returns a Response whose data is the decoded JSON body, or the
+        text if it isn't JSON. Raises WebClientError if no response was
+        received within the deadline"""
+        url = URL(url)
+        if params:
+            url = url.update_query(params)
+        host = url.host
+        cacheable = method == "GET" and cache_ttl > 0
+        if cacheable:
+            cached = self._cached(str(url))
+            if cached is not None:
+                self.metrics.incr("web.cache_hits")
+                return cached
+        if retries is None:
+            retries = self.retries if method in IDEMPOTENT_METHODS else 0
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + (timeout or self.timeout)
+        limit = self.host_limit(host)
+        if not limit.semaphore.locked():
+            await limit.semaphore.acquire()
+        elif limit.waiting >= limit.queue:
+            self.metrics.incr("web.busy.{}".format(host))
+            raise HostBusy(host, "{} requests queued".format(limit.waiting))
+        else:
+            limit.waiting += 1
+            try:
+                await asyncio.wait_for(limit.semaphore.acquire(),
+                                       deadline - loop.time())
+            except asyncio.TimeoutError:
+                self.metrics.incr("web.errors.{}".format(host))
+                raise WebClientError(host,
+                                     "timed out waiting for a connection")
+            finally:
+                limit.waiting -= 1
+        limit.in_flight += 1
+        self.metrics.gauge("web.in_flight.{}".format(host), limit.in_flight)
+        try:
+            response = await self._attempts(method, url, host, deadline,
+                                            retries, headers, json_body, data)
+        finally:
+            limit.in_flight -= 1
+            limit.semaphore.release()
+            self.metrics.gauge("web.in_flight.{}".format(host),
+                               limit.in_flight)
+        if cacheable and response.status in CACHEABLE_STATUSES:
+            self._store(str(url), response, cache_ttl)
+        return response
+
+    async def _attempts(self, method, url, host, deadline, retries, headers,
+                        json_body, data):
+        loop = asyncio.get_running_loop()
+        attempt = 0
+        error = "deadline exceeded"
+        while True:
+            remaining = deadline - loop.time()
+            # A ClientTimeout of 0 or less would disable the timeout
+            if remaining <= 0:
+                self.metrics.incr("web.errors.{}".format(host))
+                raise WebClientError(host, error)
+            start = time.perf_counter()
+            self.metrics.incr("web.requests.{}".format(host))
+            retry_after = None
+            try:
+                async with self.session.request(
+                        method,
+                        url,
+                        headers=headers,
+                        json=json_body,
+                        data=data,
+                        timeout=aiohttp.ClientTimeout(
+                            total=remaining)) as resp:
+                    body = await resp.text()
+                    response = Response(resp.status, resp.headers,
+                                        _decode(resp, body))
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                error = "{}: {}".format(type(e).__name__, e)
+                response = None
+            else:
+                error = "status {}".format(response.status)
+                if response.status == 429:
+                    retry_after = _retry_after(response.headers)
+            finally:
+                self.metrics.observe("web.latency.{}".format(host),
+                                     time.perf_counter() - start)
+            if response is not None and response.status not in RETRY_STATUSES:
+                return response
+            self.metrics.incr("web.errors.{}".format(host))
+            delay = retry_after
+            if delay is None:
+                delay = self.backoff * 2**attempt * random.uniform(0.5, 1.5)
+            if attempt >= retries or loop.time() + delay >= deadline:
+                if response is not None:
+                    return response
+                raise WebClientError(host, error)
+            attempt += 1
+            self.metrics.incr("web.retries.{}".format(host))
+            log.debug("Retrying {} {} in {:.2f}s after {}".format(
+                method, url, delay, error))
+            await asyncio.sleep(delay)
+
+    def _cached(self, key):
+        try:
+            expires, response = self.cache[key]
+        except KeyError:
+            return None
+        if expires <= time.monotonic():
+            del self.cache[key]
+            return None
+        self.cache.move_to_end(key)
+        return response
+
+    def _store(self, key, response, ttl):
+        cache_control = response.headers.get("Cache-Control", "")
+        if "no-store" in cache_control or "no-cache" in cache_control:
+            return
+        match = MAX_AGE.search(cache_control)
+        if match:
+            ttl = min(ttl, int(match.group(1)))
+        if ttl <= 0:
+            return
+        self.cache[key] = (time.monotonic() + ttl, response)
+        self.cache.move_to_end(key)
+        while len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+
+
+def _decode(resp, body):
+    if not body or "json" not in (resp.content_type or ""):
+        return body or None
+    try:
+        return json.loads(body)
+    except ValueError:
+        return body
+
+
+def _retry_after(headers):
+    try:
+        return float(headers["Retry-After"])
+    except (KeyError, ValueError):
+        return None